@@ -3,6 +3,7 @@
 import argparse
 import sys
 import icfp
+import icfp_peria
 
 def command():
     parser = argparse.ArgumentParser()
@@ -10,6 +11,7 @@ def command():
     parser.add_argument('--no-translate', action='store_false', dest='translate', help='Do not translate ICFP to human readable text.')
     parser.add_argument('--no-communicate', action='store_false', dest='communicate')
     parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output.')
+    parser.add_argument('--trace-sample', type=icfp.positive_int, default=icfp_peria.TRACE_SAMPLE, help='With -v, trace every N-th rewriting step (default: %(default)s).')
     args = parser.parse_args()
 
     verbose = False
@@ -18,9 +20,10 @@ def command():
         lines.append(line)
     command = '\n'.join(lines).strip()
     if args.communicate:
-        response = icfp.communicate(command, verbose=args.verbose, send_translate=args.send_translate, recv_translate=args.translate)
+        response = icfp.communicate(command, verbose=args.verbose, send_translate=args.send_translate, recv_translate=args.translate,
+                                    trace_sample=args.trace_sample)
     else:
-        response = icfp.icfp2ascii(command, verbose=args.verbose)
+        response = icfp.icfp2ascii(command, verbose=args.verbose, trace_sample=args.trace_sample)
     print(response)
 
 
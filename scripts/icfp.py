@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 import re
+import sys
 import requests
 
+import icfp_backends
+import icfp_cache
 import icfp_peria
+from icfp_codec import decrypt, encrypt
 
 # https://boundvariable.space/communicate
 URL_DOMAIN = "boundvariable.space"
@@ -12,69 +17,121 @@ TOKEN = os.environ["SANMA_TOKEN"]
 HEADERS = {"Authorization": f"Bearer {TOKEN}"}
 
 
-def communicate(ascii_command, verbose=False, send_translate=True, recv_translate=True):
+def communicate(ascii_command, verbose=False, send_translate=True, recv_translate=True, trace_sample=icfp_peria.TRACE_SAMPLE):
     if send_translate:
-        icfp_command = 'S' + encrypt(ascii_command)
+        icfp_command = b'S' + encrypt(ascii_command.encode())
     else:
         icfp_command = ascii_command
     response = requests.post(f"https://{URL_DOMAIN}/communicate",
                             data=icfp_command,
                             headers=HEADERS)
-    response = response.text
+    # The raw bytes are parsed directly; .text would guess the charset of the whole body first.
+    response = response.content
     if verbose:
-        print("ICFP response: ", response, file=sys.stderr)
+        print("ICFP response: ", response.decode(), file=sys.stderr)
     if recv_translate:
-        response = icfp2ascii(response, verbose)
-    return response
+        return icfp2ascii(response, verbose, trace_sample=trace_sample)
+    return response.decode()
 
 
-def icfp2ascii(icfp, verbose=False):
-    return icfp_peria.icfp2ascii(icfp, verbose)
+def icfp2ascii(icfp, verbose=False, backend=None, trace_sample=icfp_peria.TRACE_SAMPLE):
+    '''
+    backend: icfp_backends.BACKENDS の名前。省略時は環境変数 ICFP_BACKEND、なければ 'auto'
+      'auto': 起動時の計測で一番速かったもの (rewriter は選ばない)
+      'machine': CEK machine (icfp_machine)
+      'closure': Pythonのクロージャにコンパイルして実行 (icfp_closure)
+      'rewriter': 置換による書き換え (icfp_peria)。遅いので名前で指定したときだけ使う
+      'external': 環境変数 ICFP_EVALUATOR のコマンド (C++ の評価器など)
+    環境変数 ICFP_CACHE にパス (~/.cache/icfp/results.sqlite3 など) を指定すると、結果が icfp_cache で保存され、
+    同じプログラムは評価せずに返す。指定しなければ毎回評価する。
+    verbose: 書き換えの trace_sample ステップごとに、木の大きさなどを JSON 行で stderr に出す (icfp_peria.Trace)
+    '''
+    if verbose:
+        # Only the rewriter can trace each reduction step.
+        trace = icfp_peria.Trace(sys.stderr, sample=trace_sample)
+        try:
+            return icfp_peria.icfp2ascii(icfp, trace=trace)
+        except Exception:
+            trace.print_recent()
+            raise
+    result = icfp_cache.evaluate(icfp, backend)
+    return result.value if type(result) is icfp_peria.String else str(result)
+
+def positive_int(text):
+    # argparse の type。--trace-sample など 1 以上の数を取るオプション用
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be a positive integer: {text}')
+    return value
+
+def evaluate(icfp, backend=None, cross_check=False):
+    '''
+    icfpを評価して Integer / String / Boolean のノードを返す。
+    backend は icfp2ascii と同じ。cross_check=True なら使える全バックエンドで評価し、結果が違えば
+    icfp_backends.BackendMismatch を投げる。
+    '''
+    return icfp_backends.evaluate(icfp, backend, cross_check)
 
-def reduce_extended_icfp(extended_icfp, main='main'):
+# Extended ICFP: a line "name := tokens" defines |name|, and a token $name is replaced with the definition.
+DEFINITION = re.compile(r'^\s*([a-zA-Z0-9_]+)\s*:=\s*(.*)$')
+REFERENCE = re.compile(r'\$([a-zA-Z0-9_]+)')
+
+def parse_definitions(extended_icfp):
     '''
-    myfunc := L! U- v!
-    main := B$ $myfunc I#
-    みたいなのを入力として、B$ L! U- v! I# を出力する
-    両脇にスペースのある()は消す
+    定義ごとのトークン列を返す。単独の ( と ) は読みやすさのためのものなので捨てる。
     '''
-    vardict = {}
+    definitions = {}
     for line in extended_icfp.splitlines():
         line = line.strip()
         if len(line) == 0 or line[0] == '#':
             continue
-        mo = re.match(r'^\s*([a-zA-Z0-9_]+)\s*:=\s*(.*)$', line)
+        mo = DEFINITION.match(line)
         if mo is None:
             raise ValueError(f'invalid line: "{line}"')
         name, value = mo.groups()
-        vardict[name] = value
-
-    def resolve(s):
-        for name, value in vardict.items():
-            s = re.sub(r'\$' + name + r'\b', value, s)
-        return s
+        definitions[name] = [token for token in value.split() if token != '(' and token != ')']
+    return definitions
 
-    def resolve_all(s):
-        step = resolve(re.sub(r'(^| )[()]($| )', ' ', s).strip())
-        if step == s:
-            return step
-        return resolve_all(step)
-
-    return resolve_all(vardict[main])
-
-mapping = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!\"#$%&'()*+,-./:;<=>?@[\\]^_`|~ \n"
-crypt_map = {}
-
-def decrypt(s):
-    return ''.join(mapping[ord(c) - 33] for c in s)
-
-def encrypt(s):
-    global crypt_map
-    if len(crypt_map) == 0:
-        for i in range(len(mapping)):
-            crypt_map[mapping[i]] = i
-
-    return ''.join(chr(crypt_map[c] + 33) for c in s)
+def reduce_extended_icfp(extended_icfp, main='main'):
+    '''
+    myfunc := L! U- v!
+    main := B$ $myfunc I#
+    みたいなのを入力として、B$ L! U- v! I# を出力する
+    両脇にスペースのある()は消す
+    各定義は一度だけ展開し、使われるたびに展開済みの文字列を使う。定義の順序は問わない。
+    循環する定義や未定義の $name は ValueError にする。
+    '''
+    definitions = parse_definitions(extended_icfp)
+    if main not in definitions:
+        raise ValueError(f'undefined: ${main}')
+    # Definitions are expanded in topological order: a definition after all the ones it refers to.
+    expanded = {}
+    # Definitions being expanded, each with the iterator of its remaining tokens.
+    stack = [(main, iter(definitions[main]))]
+    visiting = {main}
+    while stack:
+        name, tokens = stack[-1]
+        for token in tokens:
+            mo = REFERENCE.fullmatch(token)
+            if mo is None or mo.group(1) in expanded:
+                continue
+            reference = mo.group(1)
+            if reference not in definitions:
+                raise ValueError(f'undefined: {token} in {name}')
+            if reference in visiting:
+                raise ValueError(f'cyclic definition: {token} in {name}')
+            visiting.add(reference)
+            stack.append((reference, iter(definitions[reference])))
+            break
+        else:
+            parts = []
+            for token in definitions[name]:
+                mo = REFERENCE.fullmatch(token)
+                parts.append(token if mo is None else expanded[mo.group(1)])
+            expanded[name] = ' '.join(parts)
+            visiting.discard(name)
+            stack.pop()
+    return expanded[main]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Registry of ICFP evaluators.
+#
+# Each backend takes a program (str or bytes), and optionally an icfp_peria.Stats
+# to fill, and returns a Boolean, Integer or String node of icfp_peria, or the
+# node of a lambda.  evaluate() dispatches by
+# name.  'auto' picks the fastest available backend, ranked by probe() the
+# first time it is needed: every backend runs a small program, and those that
+# fail or give a wrong answer are left out.  cross_check=True runs every
+# available backend and raises BackendMismatch if they disagree.
+#
+# The rewriter is slow and its substitution does not avoid variable capture,
+# so it is never picked by 'auto' nor used by cross_check; it runs only when
+# asked for by name.
+#
+# The 'external' backend runs the command in $ICFP_EVALUATOR (e.g. a C++
+# build) with the program on stdin, and reads the result as one ICFP token
+# (T, F, I..., S...) on stdout.  It is available only when the variable is set.
+
+from pathlib import Path
+import os
+import shlex
+import subprocess
+import sys
+import time
+import unittest
+
+import icfp_closure
+import icfp_machine
+import icfp_peria
+from icfp_peria import Boolean, Integer, String, I_encode
+
+# Environment variables: the backend used by default, and the command of the external backend.
+BACKEND_VARIABLE = 'ICFP_BACKEND'
+EVALUATOR_VARIABLE = 'ICFP_EVALUATOR'
+
+# sum(1..40) through the Y combinator, for probe().  Kept small so that probing takes milliseconds.
+PROBE_PROGRAM = ('B$ B$ L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v# '
+                 f'L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I" I{I_encode(40)}')
+PROBE_RESULT = 40 * 41 // 2
+
+
+class BackendMismatch(ValueError):
+    pass
+
+
+class Backend(object):
+    # |auto|: whether 'auto' and cross_check may use the backend.
+    def __init__(self, name, evaluate, available=None, auto=True):
+        self.name = name
+        self.evaluate = evaluate
+        self.available = available or (lambda: True)
+        self.auto = auto
+
+
+# Backends by name, in the order they are preferred when probe() has not ranked them.
+BACKENDS = {}
+
+
+def register(name, evaluate, available=None, auto=True):
+    global ranking
+    BACKENDS[name] = Backend(name, evaluate, available, auto)
+    ranking = None
+
+
+def run_external(program, stats=None):
+    command = shlex.split(os.environ[EVALUATOR_VARIABLE])
+    if type(program) is str:
+        program = program.encode()
+    result = subprocess.run(command, input=program, capture_output=True, check=True)
+    return icfp_peria.parse_source(result.stdout.strip())
+
+
+register('machine', lambda program, stats=None: icfp_machine.evaluate(program, True, stats))
+register('closure', icfp_closure.evaluate)
+register('rewriter', lambda program, stats=None: icfp_peria.compile(program, stats=stats), auto=False)
+register('external', run_external, lambda: bool(os.environ.get(EVALUATOR_VARIABLE)))
+
+# Names of the available backends for 'auto', fastest first, or None until probe() runs.
+ranking = None
+
+
+def probe():
+    # Ranks the available backends for 'auto' by the time of PROBE_PROGRAM.
+    global ranking
+    times = {}
+    for name, backend in BACKENDS.items():
+        if not backend.auto or not backend.available():
+            continue
+        start = time.perf_counter()
+        try:
+            result = backend.evaluate(PROBE_PROGRAM)
+        except Exception as e:
+            print(f'Backend {name} failed the probe: {e!r}', file=sys.stderr)
+            continue
+        if type(result) is not Integer or result.value != PROBE_RESULT:
+            print(f'Backend {name} failed the probe: {result}', file=sys.stderr)
+            continue
+        times[name] = time.perf_counter() - start
+    ranking = sorted(times, key=times.get)
+    return ranking
+
+
+def backend_names(backend):
+    if backend == 'auto':
+        names = ranking if ranking is not None else probe()
+        if not names:
+            raise ValueError('No backend is available')
+        return names
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend: {backend}')
+    if not BACKENDS[backend].available():
+        raise ValueError(f'Backend is not available: {backend}')
+    return [backend]
+
+
+def resolve(backend=None):
+    # The name of the backend that evaluate() uses for |backend|.
+    if backend is None:
+        backend = os.environ.get(BACKEND_VARIABLE, 'auto')
+    return backend_names(backend)[0]
+
+
+def evaluate(program, backend=None, cross_check=False, stats=None):
+    '''
+    Evaluates |program| with |backend|: a name in BACKENDS, or 'auto' for the fastest one.  The
+    default is $ICFP_BACKEND, or 'auto'.  With |cross_check|, every backend that 'auto' may pick
+    also evaluates the program and BackendMismatch is raised unless all the results agree.  |stats| is an
+    icfp_peria.Stats to fill; the external backend leaves it empty.
+    '''
+    name = resolve(backend)
+    if stats is None:
+        result = BACKENDS[name].evaluate(program)
+    else:
+        result = BACKENDS[name].evaluate(program, stats)
+    if cross_check:
+        expected = comparable(result)
+        for other in backend_names('auto'):
+            if other == name:
+                continue
+            actual = comparable(BACKENDS[other].evaluate(program))
+            if actual != expected:
+                raise BackendMismatch(f'{name} returned {expected}, but {other} returned {actual}')
+    return result
+
+
+def comparable(node):
+    # Literals are compared by value.  Lambdas are not compared, since their parameters may be renamed.
+    t = type(node)
+    if t is Boolean or t is Integer or t is String:
+        return (t.__name__, node.value)
+    return ('function',)
+
+
+def restore_ranking(names):
+    # For the tests, which change the ranking.
+    global ranking
+    ranking = names
+
+
+class TestBackends(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    TEST_DATA_DIR = SCRIPT_DIR / 'test_data'
+
+    def test_language(self):
+        icfp = (self.TEST_DATA_DIR / 'language_test.icfp').read_text().strip()
+        for name in ('machine', 'closure', 'rewriter'):
+            result = evaluate(icfp, name)
+            self.assertEqual(result.value, "Self-check OK, send `solve language_test 4w3s0m3` to claim points for it")
+
+    def test_auto(self):
+        names = probe()
+        self.assertEqual(set(names) & {'machine', 'closure', 'rewriter'}, {'machine', 'closure'})
+        self.assertEqual(evaluate('B+ I# I$', 'auto').value, 5)
+        self.assertEqual(evaluate('B+ I# I$', cross_check=True).value, 5)
+        stats = icfp_peria.Stats()
+        self.assertEqual(evaluate('B$ L# B+ v# v# I$', 'closure', stats=stats).value, 6)
+        self.assertEqual(stats.beta, 1)
+        with self.assertRaises(ValueError):
+            evaluate('B+ I# I$', 'nonexistent')
+
+    def test_cross_check(self):
+        self.addCleanup(restore_ranking, ranking)
+        register('broken', lambda program: Integer(0))
+        self.addCleanup(BACKENDS.pop, 'broken')
+        self.assertEqual(evaluate('B+ I# I$', 'broken').value, 0)
+        self.assertNotIn('broken', probe())
+        # A backend failing the probe is still compared.
+        ranking.append('broken')
+        with self.assertRaises(BackendMismatch):
+            evaluate('B+ I# I$', 'machine', cross_check=True)
+
+    def test_external(self):
+        # A stand-in for a compiled evaluator: prints 1337 whatever the program is.
+        command = shlex.join([sys.executable, '-c', 'import sys; sys.stdin.read(); print("I/6")'])
+        previous = os.environ.get(EVALUATOR_VARIABLE)
+        os.environ[EVALUATOR_VARIABLE] = command
+        try:
+            self.assertEqual(evaluate('B+ I# I$', 'external').value, 1337)
+        finally:
+            if previous is None:
+                del os.environ[EVALUATOR_VARIABLE]
+            else:
+                os.environ[EVALUATOR_VARIABLE] = previous
+        with self.assertRaises(ValueError):
+            evaluate('B+ I# I$', 'external')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Persistent cache of evaluation results.
+#
+# Results are kept in an SQLite database, keyed by the SHA-256 of VERSION and
+# the program with its whitespace normalized (tokens joined by single spaces).
+# A Boolean, Integer or String result is stored as its ICFP token, with the
+# statistics of the evaluation as JSON.  Lambdas are not stored.
+#
+# The database is bounded by |max_bytes| of stored tokens: the least recently
+# used entries are evicted first.
+#
+# The cache is opt-in: icfp.icfp2ascii() uses the database at $ICFP_CACHE
+# (e.g. ~/.cache/icfp/results.sqlite3, DEFAULT_PATH) only when it is set and
+# not empty, and evaluates every program otherwise.
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import icfp_backends
+import icfp_peria
+from icfp_codec import I_encode, encrypt
+from icfp_peria import Boolean, Integer, String
+
+# Bumped whenever a change of the evaluators may change results, so that older entries are not used.
+VERSION = 1
+
+CACHE_VARIABLE = 'ICFP_CACHE'
+DEFAULT_PATH = Path.home() / '.cache' / 'icfp' / 'results.sqlite3'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def normalize(program):
+    if type(program) is str:
+        program = program.encode('latin-1')
+    return b' '.join(program.split())
+
+
+def key(program):
+    return hashlib.sha256(b'%d\n' % VERSION + normalize(program)).hexdigest()
+
+
+def token(node):
+    # The ICFP token of a literal, or None for a lambda.
+    t = type(node)
+    if t is Boolean:
+        return b'T' if node.value else b'F'
+    if t is Integer:
+        return b'I' + I_encode(node.value).encode()
+    if t is String:
+        return b'S' + encrypt(str(node.value).encode('latin-1'))
+    return None
+
+
+class Entry(object):
+    # A cached |result| node and the |stats| (a dict) of the evaluation that computed it.
+    __slots__ = ('result', 'stats')
+
+    def __init__(self, result, stats):
+        self.result = result
+        self.stats = stats
+
+
+class ResultCache(object):
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                    '(key TEXT PRIMARY KEY, token BLOB, stats TEXT, size INTEGER, used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, program):
+        # Returns an Entry, or None.
+        k = key(program)
+        with self.connection:
+            row = self.connection.execute('SELECT token, stats FROM results WHERE key = ?', (k,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), k))
+        return Entry(icfp_peria.parse_source(row[0]), json.loads(row[1]))
+
+    def put(self, program, result, stats):
+        # Stores |result| unless it is a lambda.  |stats| is a JSON-serializable dict.
+        data = token(result)
+        if data is None or len(data) > self.max_bytes:
+            return
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                    (key(program), data, json.dumps(stats, sort_keys=True), len(data), time.time()))
+            self.evict()
+
+    def evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for k, size in self.connection.execute('SELECT key, size FROM results ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((k,))
+            total -= size
+        self.connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+# The cache of default_cache(), opened on first use.
+_default = None
+
+
+def default_cache():
+    # The ResultCache at $ICFP_CACHE, or None if it is unset or empty.
+    global _default
+    path = os.environ.get(CACHE_VARIABLE)
+    if not path:
+        return None
+    if _default is None or _default.path != Path(path):
+        _default = ResultCache(path)
+    return _default
+
+
+def evaluate(program, backend=None, cache=None, stats=None):
+    '''
+    icfp_backends.evaluate() through |cache| (default_cache() if None).  The stored statistics
+    are the backend and the time of the evaluation, and |stats| (an icfp_peria.Stats to fill,
+    which slows down evaluation) if given.  A hit returns the stored result without evaluating,
+    and leaves |stats| untouched.
+    '''
+    if cache is None:
+        cache = default_cache()
+        if cache is None:
+            return icfp_backends.evaluate(program, backend, stats=stats)
+    entry = cache.get(program)
+    if entry is not None:
+        return entry.result
+    name = icfp_backends.resolve(backend)
+    start = time.perf_counter()
+    result = icfp_backends.evaluate(program, name, stats=stats)
+    record = {'backend': name, 'seconds': time.perf_counter() - start}
+    if stats is not None:
+        record['stats'] = stats.as_dict()
+    cache.put(program, result, record)
+    return result
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(Path(self.directory.name) / 'results.sqlite3')
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_lookup(self):
+        self.assertIsNone(self.cache.get('B+ I# I$'))
+        stats = icfp_peria.Stats()
+        self.assertEqual(evaluate('B+ I# I$', 'machine', self.cache, stats).value, 5)
+        entry = self.cache.get(' B+  I#\nI$\n')
+        self.assertEqual(type(entry.result), Integer)
+        self.assertEqual(entry.result.value, 5)
+        self.assertEqual(entry.stats['backend'], 'machine')
+        self.assertEqual(entry.stats['stats']['operators'], {'B+': 1})
+        self.assertEqual(evaluate(b'B+ I# I$', cache=self.cache).value, 5)
+        for program, value in (('S' + 'B%,,/}Q/2,$_' * 1000, 'Hello World!' * 1000), ('B< I! I"', True),
+                               ('I' + '~' * 10000, 94 ** 10000 - 1)):
+            evaluate(program, 'closure', self.cache)
+            entry = self.cache.get(program)
+            self.assertEqual(entry.result.value, value)
+        # Lambdas are not stored.
+        evaluate('L# v#', 'machine', self.cache)
+        self.assertIsNone(self.cache.get('L# v#'))
+        self.assertEqual(len(self.cache), 4)
+
+    def test_hit(self):
+        # A hit does not evaluate: a result stored by hand is returned as is.
+        self.cache.put('B+ I# I$', Integer(6), {})
+        self.assertEqual(evaluate('B+ I# I$', cache=self.cache).value, 6)
+
+    def test_version(self):
+        global VERSION
+        self.cache.put('B+ I# I$', Integer(5), {})
+        VERSION += 1
+        try:
+            self.assertIsNone(self.cache.get('B+ I# I$'))
+        finally:
+            VERSION -= 1
+        self.assertIsNotNone(self.cache.get('B+ I# I$'))
+
+    def test_eviction(self):
+        # Each entry takes 101 bytes, so three fit.
+        self.cache.max_bytes = 303
+        for i in range(3):
+            self.cache.put(f'I{I_encode(i)}', String(chr(97 + i) * 100), {})
+            time.sleep(0.01)
+        self.assertIsNotNone(self.cache.get('I!'))
+        time.sleep(0.01)
+        self.cache.put('I$', String('d' * 100), {})
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('I"'))
+        self.assertEqual(self.cache.get('I!').result.value, 'a' * 100)
+        self.cache.put('I%', String('e' * 400), {})
+        self.assertIsNone(self.cache.get('I%'))
+
+    def test_opt_in(self):
+        global _default
+        previous = os.environ.pop(CACHE_VARIABLE, None)
+        try:
+            self.assertIsNone(default_cache())
+            os.environ[CACHE_VARIABLE] = ''
+            self.assertIsNone(default_cache())
+            os.environ[CACHE_VARIABLE] = str(Path(self.directory.name) / 'default.sqlite3')
+            self.assertEqual(evaluate('B+ I# I$').value, 5)
+            self.assertIsNotNone(default_cache().get('B+ I# I$'))
+        finally:
+            if _default is not None:
+                _default.close()
+                _default = None
+            if previous is None:
+                os.environ.pop(CACHE_VARIABLE, None)
+            else:
+                os.environ[CACHE_VARIABLE] = previous
+
+
+if __name__ == '__main__':
+    unittest.main()
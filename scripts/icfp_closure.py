@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+# Compiles ICFP into nested Python closures.
+#
+# Every node of a CompactAST becomes a Python function that takes an
+# environment and returns a value.  Integers, strings and booleans are Python
+# values, and an ICFP lambda becomes a Function.  Arguments are passed as they
+# are when they are literals, lambdas or variables, and are wrapped in a
+# memoizing Thunk otherwise, which gives the same results as call-by-name.
+#
+# Applications in tail position return a (function, argument) tuple instead of
+# calling, and the caller loops over them, so loops written with the Y/Z
+# combinators do not grow the Python stack.  Other recursion does, so programs
+# run in a thread with a large stack (run_deep).  Recursion deeper than
+# RECURSION_LIMIT, like the 9 * 10^9 nested calls of efficiency3, still raises
+# RecursionError.
+
+from pathlib import Path
+import sys
+import threading
+import unittest
+
+import icfp_compact
+import icfp_peria
+import icfp_rope
+from icfp_peria import Boolean, Integer, String, icfp2int, int2icfp
+from icfp_rope import Rope, TEXT, concat
+from icfp_compact import (LIT, VAR, LAM, IF, APPLY, LAZY_APPLY, STRICT_APPLY,
+                          UNARY, BINARY, UNARY_OPERATORS, BINARY_OPERATORS, ENCODED)
+
+STACK_SIZE = 512 * 1024 * 1024
+RECURSION_LIMIT = 1000000
+
+
+def icfp2ascii(icfp):
+    result = evaluate(icfp)
+    return result.value if type(result) is String else str(result)
+
+
+def evaluate(icfp, stats=None):
+    # |stats| is an icfp_peria.Stats to fill.
+    if stats is None:
+        ast = icfp_compact.parse(icfp)
+        code = compile_ast(ast)
+        return reify(ast, run_deep(lambda: run(code)))
+    with stats.phase('parse'):
+        ast = icfp_compact.parse(icfp)
+    with stats.phase('compile'):
+        code = compile_ast(ast, stats)
+    stats.peak_size = max(stats.peak_size, len(ast))
+    with stats.phase('evaluate'):
+        return reify(ast, run_deep(lambda: run(code)))
+
+
+class Function(object):
+    # An ICFP lambda.  |node| is the index of the lambda in the CompactAST.
+    __slots__ = ('body', 'env', 'node')
+
+    def __init__(self, body, env, node):
+        self.body = body
+        self.env = env
+        self.node = node
+
+
+class Thunk(object):
+    __slots__ = ('code', 'env', 'value')
+
+    def __init__(self, code, env):
+        self.code = code
+        self.env = env
+        self.value = None
+
+    def force(self):
+        if self.code is not None:
+            self.value = self.code(self.env)
+            self.code = self.env = None
+        return self.value
+
+
+def run(code, env=None):
+    value = code(env)
+    while type(value) is tuple:
+        f, x = value
+        value = f.body((x, f.env))
+    return value
+
+
+def reify(ast, value):
+    t = type(value)
+    if t is bool:
+        return Boolean(value)
+    if t is int:
+        return Integer(value)
+    if t is str or t is Rope:
+        return String(str(value))
+    return ast.node(value.node)
+
+
+# Guards the stack size and recursion limit changed by run_deep(), and counts its running threads.
+deep_lock = threading.Lock()
+deep_threads = 0
+# The recursion limit before the first of the running threads started.
+saved_recursion_limit = None
+
+
+def run_deep(fn):
+    # Runs |fn| in a thread with a large stack and recursion limit.  The stack size applies to
+    # the threads started while it is set, so it is restored as soon as the thread has started.
+    # The recursion limit is per interpreter, so it stays raised only while such threads run.
+    global deep_threads, saved_recursion_limit
+    result = []
+
+    def target():
+        try:
+            result.append((True, fn()))
+        except BaseException as e:
+            result.append((False, e))
+
+    thread = threading.Thread(target=target)
+    with deep_lock:
+        if deep_threads == 0:
+            saved_recursion_limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(max(saved_recursion_limit, RECURSION_LIMIT))
+        deep_threads += 1
+        old_stack_size = threading.stack_size(STACK_SIZE)
+        try:
+            thread.start()
+        except BaseException:
+            end_deep()
+            raise
+        finally:
+            threading.stack_size(old_stack_size)
+    try:
+        thread.join()
+    finally:
+        with deep_lock:
+            end_deep()
+    ok, value = result[0]
+    if not ok:
+        raise value
+    return value
+
+
+def end_deep():
+    # Called with deep_lock held when a thread of run_deep() ends.
+    global deep_threads
+    deep_threads -= 1
+    if deep_threads == 0:
+        sys.setrecursionlimit(saved_recursion_limit)
+
+
+def compile_ast(ast, stats=None):
+    # Builds the closures from the last node, so that operands are always built first.
+    # With |stats|, the closures also count into it, which makes them slower.
+    kind, right, arg = ast.kind, ast.right, ast.arg
+    n = len(kind)
+
+    # Whether the value of each node is the value of the enclosing lambda body.
+    tail = bytearray(n)
+    tail[0] = 1
+    for i in range(n):
+        code = kind[i]
+        if code == LAM:
+            tail[i + 1] = 1
+        elif code == IF and tail[i]:
+            tail[right[i]] = tail[arg[i]] = 1
+
+    built = [None] * n
+    for i in range(n - 1, -1, -1):
+        code = kind[i]
+        if code == LIT:
+            value = ast.literals[arg[i]]
+            built[i] = encoded_code(ast, arg[i]) if type(value) in ENCODED else literal_code(value)
+        elif code == VAR:
+            built[i] = variable_code(arg[i], right[i])
+        elif code == LAM:
+            body = built[i + 1]
+            if stats is not None:
+                body = reduction_code(stats, body)
+            built[i] = lambda_code(body, i)
+        elif code == IF:
+            true_branch, false_branch = built[right[i]], built[arg[i]]
+            if stats is not None:
+                true_branch = counter_code(stats.branches, 'then', true_branch)
+                false_branch = counter_code(stats.branches, 'else', false_branch)
+            built[i] = if_code(built[i + 1], true_branch, false_branch)
+        elif code == APPLY or code == LAZY_APPLY:
+            argument = argument_code(ast, right[i], built[right[i]])
+            built[i] = apply_code(built[i + 1], argument, tail[i])
+        elif code == STRICT_APPLY:
+            built[i] = apply_code(built[i + 1], built[right[i]], tail[i])
+        elif code >= BINARY:
+            op = BINARY_OPERATORS[code - BINARY]
+            built[i] = binary_code(op, built[i + 1], built[right[i]], literal(ast, i + 1), literal(ast, right[i]))
+        else:
+            built[i] = unary_code(UNARY_OPERATORS[code - UNARY], built[i + 1])
+        if stats is not None and code >= UNARY:
+            key = 'B' + BINARY_OPERATORS[code - BINARY] if code >= BINARY else 'U' + UNARY_OPERATORS[code - UNARY]
+            built[i] = counter_code(stats.operators, key, built[i])
+    return built[0]
+
+
+def counter_code(counter, key, code):
+    def counted(env):
+        counter[key] += 1
+        return code(env)
+    return counted
+
+
+def literal(ast, i):
+    # A literal still encoded is returned as is: it is not an absorbing element anyway.
+    return ast.literals[ast.arg[i]] if ast.kind[i] == LIT else None
+
+
+def reduction_code(stats, body):
+    def counted(env):
+        stats.reduction()
+        return body(env)
+    return counted
+
+
+def literal_code(value):
+    return lambda env: value
+
+
+def encoded_code(ast, i):
+    # A literal still encoded, decoded when first evaluated.
+    return lambda env: ast.value(i)
+
+
+def variable_code(k, parameter):
+    if k < 0:
+        def unbound(env):
+            raise ValueError(f'Unbound variable: x{parameter}')
+        return unbound
+    if k == 0:
+        def variable0(env):
+            x = env[0]
+            return x.force() if type(x) is Thunk else x
+        return variable0
+    if k == 1:
+        def variable1(env):
+            x = env[1][0]
+            return x.force() if type(x) is Thunk else x
+        return variable1
+
+    def variable(env):
+        for _ in range(k):
+            env = env[1]
+        x = env[0]
+        return x.force() if type(x) is Thunk else x
+    return variable
+
+
+def lambda_code(body, node):
+    return lambda env: Function(body, env, node)
+
+
+def argument_code(ast, i, code):
+    # Returns a closure that makes the argument without evaluating it.
+    kind = ast.kind[i]
+    if (kind == LIT and type(ast.literals[ast.arg[i]]) not in ENCODED) or kind == LAM:
+        return code
+    if kind == VAR:
+        k = ast.arg[i]
+        if k >= 0:
+            def variable(env):
+                for _ in range(k):
+                    env = env[1]
+                return env[0]
+            return variable
+    return lambda env: Thunk(code, env)
+
+
+def apply_code(function, argument, tail):
+    if tail:
+        def tail_call(env):
+            f = function(env)
+            if type(f) is not Function:
+                raise ValueError(f'Applying a non-function: {f}')
+            return (f, argument(env))
+        return tail_call
+
+    def call(env):
+        f = function(env)
+        if type(f) is not Function:
+            raise ValueError(f'Applying a non-function: {f}')
+        value = f.body((argument(env), f.env))
+        while type(value) is tuple:
+            f, x = value
+            value = f.body((x, f.env))
+        return value
+    return call
+
+
+def if_code(condition, true_branch, false_branch):
+    def branch(env):
+        c = condition(env)
+        if c is True:
+            return true_branch(env)
+        if c is False:
+            return false_branch(env)
+        raise ValueError(f'Condition is not a boolean: {c}')
+    return branch
+
+
+def unary_code(op, x):
+    if op == '-':
+        return lambda env: -x(env)
+    if op == '!':
+        return lambda env: not x(env)
+    if op == '#':
+        return lambda env: icfp2int(str(x(env)))
+    if op == '$':
+        return lambda env: int2icfp(x(env))
+    raise ValueError(f'Unknown unary operator: {op}')
+
+
+def binary_code(op, x, y, x_literal, y_literal):
+    # Same shortcuts as BinaryOperator.optimize for literal absorbing elements.
+    if op == '*' and ((type(x_literal) is int and x_literal == 0) or (type(y_literal) is int and y_literal == 0)):
+        return literal_code(0)
+    if op == '&' and (x_literal is False or y_literal is False):
+        return literal_code(False)
+    if op == '|' and (x_literal is True or y_literal is True):
+        return literal_code(True)
+
+    if op == '+':
+        return lambda env: x(env) + y(env)
+    if op == '-':
+        return lambda env: x(env) - y(env)
+    if op == '*':
+        return lambda env: x(env) * y(env)
+    if op == '/':
+        def divide(env):
+            a, b = x(env), y(env)
+            q = abs(a) // abs(b)
+            return -q if (a < 0) != (b < 0) else q
+        return divide
+    if op == '%':
+        def modulo(env):
+            a, b = x(env), y(env)
+            q = abs(a) // abs(b)
+            if (a < 0) != (b < 0):
+                q = -q
+            return a - q * b
+        return modulo
+    if op == '<':
+        return lambda env: x(env) < y(env)
+    if op == '>':
+        return lambda env: x(env) > y(env)
+    if op == '=':
+        def equal(env):
+            a, b = x(env), y(env)
+            return (type(a) is type(b) or type(a) in TEXT and type(b) in TEXT) and a == b
+        return equal
+    if op == '|':
+        return lambda env: x(env) or y(env)
+    if op == '&':
+        return lambda env: x(env) and y(env)
+    if op == '.':
+        return lambda env: concat(x(env), y(env))
+    if op == 'T':
+        def take(env):
+            n = x(env)
+            return icfp_rope.take(n, y(env))
+        return take
+    if op == 'D':
+        def drop(env):
+            n = x(env)
+            return icfp_rope.drop(n, y(env))
+        return drop
+    raise ValueError(f'Unknown binary operator: {op}')
+
+
+class TestClosure(unittest.TestCase):
+    def test_icfp2ascii(self):
+        data = [
+            ("T", "True"), # Boolean
+            ("F", "False"),
+            ("I/6", "1337"), # Integer
+            ("SB%,,/}Q/2,$_", "Hello World!"), # String
+            ("U- I$", "-3"), # Unary operator
+            ("U! T", "False"),
+            ("U# S4%34", "15818151"),
+            ("U$ I4%34", "test"),
+            ("B+ I# I$", "5"), # Binary operator
+            ("B- I$ I#", "1"),
+            ("B* I$ I#", "6"),
+            ("B/ U- I( I#", "-3"),
+            ("B% U- I( I#", "-1"),
+            ("B< I$ I#", "False"),
+            ("B> I$ I#", "True"),
+            ("B= I$ I#", "False"),
+            ("B| T F", "True"),
+            ("B& T F", "False"),
+            ("B. S4% S34", "test"),
+            ("BT I$ S4%34", "tes"),
+            ("BD I$ S4%34", "t"),
+            ("B$ L! B+ v! v! I#", "4"), # (v0 => v0 + v0)(2) == 4
+            ("B$ L# U- v# I%", "-4"),
+            ("B$ L! B+ v! B$ L# U- v# I$ I% ", "1"),
+            ("? T I! I#", "0"),
+            ("? F I! I#", "2"),
+            ('B$ B$ L# L$ v# B. SB%,,/ S}Q/2,$_ IK', "Hello World!"),
+            ('B$ L# B$ L" B+ v" v" B* I$ I# v8', "12"),
+            ('B$ B$ B$ B$ L$ L$ L$ L# v$ I" I# I$ I%', "3"),
+            ('B! L# B+ v# v# I$', "6"),
+        ]
+        for icfp, expect in data:
+            self.assertEqual(icfp2ascii(icfp), expect)
+
+    def test_tail_calls(self):
+        # A loop through the Y combinator runs with the default recursion limit.  The accumulator is strict.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% L& ? B= v% I! v& B! B$ v$ B- v% I" B+ v& v%'
+        icfp = f'B$ B$ B$ {y} {body} I{icfp_peria.I_encode(10000)} I!'
+        self.assertEqual(run(compile_ast(icfp_compact.parse(icfp))), 10000 * 10001 // 2)
+
+    def test_lazy_literals(self):
+        # A long literal passed but not used is never decoded.
+        digits = '~' * 100
+        ast = icfp_compact.parse(f'B$ L" I# I{digits}')
+        self.assertEqual(run(compile_ast(ast)), 2)
+        self.assertIsNotNone(ast.literals[1].encoded)
+        self.assertEqual(evaluate(f'B- I{digits} I"').value, 94 ** 100 - 2)
+
+    def test_deep_recursion(self):
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I"'
+        icfp = f'B$ B$ {y} {body} I{icfp_peria.I_encode(100000)}'
+        limit, stack_size = sys.getrecursionlimit(), threading.stack_size()
+        self.assertEqual(icfp2ascii(icfp), str(100000 * 100001 // 2))
+        # The settings are restored, also when the deep threads overlap.
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(icfp2ascii(icfp))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [str(100000 * 100001 // 2)] * 2)
+        self.assertEqual((sys.getrecursionlimit(), threading.stack_size()), (limit, stack_size))
+
+    def test_long_string(self):
+        # A path of 20000 moves built one move at a time (R for even k, L for odd k), then
+        # cut with T and D.  Concatenation does not copy the path built so far.
+        n = 20000
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% ? B= v% I! S B. B! v$ B- v% I" ? B= B% v% I# I! SL SF'
+        path = f'B$ B$ {y} {body} I{icfp_peria.I_encode(n)}'
+        expected = ''.join('R' if k % 2 == 0 else 'L' for k in range(1, n + 1))
+        self.assertEqual(icfp2ascii(path), expected)
+        icfp = f'B. BT I& {path} BD I{icfp_peria.I_encode(n - 5)} {path}'
+        self.assertEqual(icfp2ascii(icfp), expected[:5] + expected[-5:])
+        self.assertEqual(icfp2ascii(f'B= {path} B. {path} S'), 'True')
+
+    def test_no_rewriting(self):
+        # The same reductions as the rewriter, which walks the whole tree once per reduction.  The
+        # closures are built once, and evaluation takes no rewriting step.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% L& ? B= v% I! v& B$ B$ v$ B- v% I" B+ v& v%'
+        icfp = f'B$ B$ B$ {y} {body} I{icfp_peria.I_encode(300)} I!'
+        rewriter = icfp_peria.Stats()
+        self.assertEqual(icfp_peria.compile(icfp, stats=rewriter).value, 300 * 301 // 2)
+        closure = icfp_peria.Stats()
+        self.assertEqual(evaluate(icfp, closure).value, 300 * 301 // 2)
+        self.assertEqual((closure.beta, closure.operators), (rewriter.beta, rewriter.operators))
+        self.assertEqual(rewriter.steps, rewriter.beta + 1)
+        self.assertEqual(closure.steps, 0)
+
+    def test_stats(self):
+        # sum(4..1) through the Y combinator.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        icfp = f'B$ B$ {y} L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I" I%'
+        stats = icfp_peria.Stats()
+        self.assertEqual(evaluate(icfp, stats).value, 10)
+        self.assertEqual(stats.beta, 16)
+        self.assertEqual(stats.operators, {'B=': 5, 'B-': 4, 'B+': 4})
+        self.assertEqual(stats.branches, {'then': 1, 'else': 4})
+        with self.assertRaises(icfp_peria.BudgetExceeded):
+            evaluate(icfp, icfp_peria.Stats(budget=15))
+
+
+class TestEnd2End(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    TEST_DATA_DIR = SCRIPT_DIR / 'test_data'
+
+    def test_language(self):
+        with open(self.TEST_DATA_DIR / 'language_test.icfp') as f:
+            icfp = f.read().strip()
+        result = evaluate(icfp)
+        self.assertTrue(type(result) is String)
+        self.assertEqual(result.value, "Self-check OK, send `solve language_test 4w3s0m3` to claim points for it")
+
+    def test_lambdaman6(self):
+        with open(self.TEST_DATA_DIR / 'lambdaman6_test.icfp') as f:
+            icfp = f.read().strip()
+        result = evaluate(icfp)
+        self.assertEqual(type(result), String)
+        self.assertEqual(result.value, 'L' + '.' * 199)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Base-94 integer and string codec shared by the ICFP modules.
+#
+# Digit-at-a-time conversion (value = value * 94 + d, or repeated % 94 and
+# //= 94) is quadratic in the number of digits.  Here digits are combined
+# pairwise with precomputed powers 94**(2**k), and split top-down by the same
+# powers, so the cost is dominated by a few big multiplications.
+#
+# CPython's long division is quadratic, so large splits divide with Barrett
+# reduction: the reciprocal of each power is computed once by Newton's method
+# with multiplications only.
+#
+# Digits are handled as bytes of digit values 0..93, converted to and from the
+# I body (chr(d + 33)) and the S body alphabet with bytes.translate.
+# decode() also takes digits in other bases, e.g. the moves of a path.
+#
+# S bodies are converted to and from text with one bytes.translate call too,
+# using tables built at import.  decrypt() and encrypt() take str or bytes
+# (e.g. a network payload) and return the same type.
+
+import sys
+import time
+import unittest
+
+# The S body alphabet: digit d is mapping[d].
+mapping = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!\"#$%&'()*+,-./:;<=>?@[\\]^_`|~ \n"
+
+# bytes.translate tables between characters and digit values.  Characters
+# outside the alphabet become INVALID.
+INVALID = 255
+_ASCII_TO_DIGIT = bytes(c - 33 if 33 <= c < 127 else INVALID for c in range(256))
+_DIGIT_TO_ASCII = bytes(range(33, 127)) + bytes(256 - 94)
+_TEXT_TO_DIGIT = bytearray([INVALID] * 256)
+for _d, _c in enumerate(mapping.encode()):
+    _TEXT_TO_DIGIT[_c] = _d
+_TEXT_TO_DIGIT = bytes(_TEXT_TO_DIGIT)
+_DIGIT_TO_TEXT = mapping.encode() + bytes(256 - 94)
+# Digit values to the digits of int(s, base) for base <= 36.
+_DIGIT_TO_ALNUM = b'0123456789abcdefghijklmnopqrstuvwxyz' + bytes(256 - 36)
+# S body to text and back.  Characters with no counterpart become b'\0', which
+# neither side produces otherwise.
+DECRYPT_TABLE = bytes(33) + mapping.encode() + bytes(256 - 127)
+ENCRYPT_TABLE = bytes(range(256)).translate(_TEXT_TO_DIGIT).translate(_DIGIT_TO_ASCII)
+
+# Numbers of at most this many digits are converted one digit at a time.
+SMALL_DIGITS = 64
+# Divisors of at most this many bits are divided with divmod().
+SMALL_BITS = 4096
+
+# POWERS[k] == 94 ** (2 ** k), extended on demand.  RADIX_POWERS has the same lists for other bases.
+POWERS = [94]
+RADIX_POWERS = {94: POWERS}
+# Barrett reciprocals of POWERS[k], computed on demand.
+RECIPROCALS = {}
+
+
+def power(k, base=94):
+    powers = RADIX_POWERS.get(base)
+    if powers is None:
+        powers = RADIX_POWERS[base] = [base]
+    while len(powers) <= k:
+        powers.append(powers[-1] * powers[-1])
+    return powers[k]
+
+
+def reciprocal(p):
+    # floor(4 ** b / p) with b = p.bit_length(), by Newton's method on the top half of |p|.
+    b = p.bit_length()
+    if b <= SMALL_BITS:
+        return (1 << 2 * b) // p
+    k = b // 2 + 2
+    r = reciprocal(p >> (b - k)) << (b - k)
+    r += (r * ((1 << 2 * b) - p * r)) >> (2 * b)
+    e = (1 << 2 * b) - p * r
+    while e < 0:
+        r -= 1
+        e += p
+    while e >= p:
+        r += 1
+        e -= p
+    return r
+
+
+def split(x, k):
+    # divmod(x, power(k)) for x < power(k + 1).
+    p = power(k)
+    b = p.bit_length()
+    if b <= SMALL_BITS:
+        return divmod(x, p)
+    r = RECIPROCALS.get(k)
+    if r is None:
+        r = RECIPROCALS[k] = reciprocal(p)
+    q = (x * r) >> (2 * b)
+    x -= q * p
+    while x >= p:
+        q += 1
+        x -= p
+    return q, x
+
+
+def decode(digits, base=94):
+    # |digits| is a bytes-like object of digit values below |base|, the most significant first.
+    if len(digits) <= SMALL_DIGITS:
+        value = 0
+        for d in digits:
+            value = value * base + d
+        return value
+    if base & (base - 1) == 0 and base <= 32:
+        # int() converts from a power-of-two base in linear time.
+        return int(bytes(digits).translate(_DIGIT_TO_ALNUM), base)
+    # Chunks of SMALL_DIGITS (2 ** 6) digits are converted one digit at a time, then combined pairwise.
+    digits = bytes(-len(digits) % SMALL_DIGITS) + bytes(digits)
+    values = []
+    for i in range(0, len(digits), SMALL_DIGITS):
+        value = 0
+        for d in digits[i:i + SMALL_DIGITS]:
+            value = value * base + d
+        values.append(value)
+    k = 6
+    while len(values) > 1:
+        if len(values) % 2:
+            values.insert(0, 0)
+        p = power(k, base)
+        values = [high * p + low for high, low in zip(values[0::2], values[1::2])]
+        k += 1
+    return values[0]
+
+
+def encode(value):
+    # Returns the digit values of |value| as bytes, the most significant first.  b'' for 0.
+    if value < 0:
+        raise ValueError(f'Negative value: {value}')
+    k = 0
+    while power(k) <= value:
+        k += 1
+    digits = bytearray()
+    if k <= 6:
+        # Fewer than 2 ** 6 digits.
+        while value:
+            value, d = divmod(value, 94)
+            digits.append(d)
+        digits.reverse()
+        return bytes(digits)
+    # value < power(k), i.e. it has at most 2 ** k digits.
+    stack = [(value, k)]
+    while stack:
+        x, k = stack.pop()
+        if k <= 6:
+            chunk = bytearray(1 << k)
+            for i in range((1 << k) - 1, -1, -1):
+                x, chunk[i] = divmod(x, 94)
+            digits += chunk
+        else:
+            high, low = split(x, k - 1)
+            stack.append((low, k - 1))
+            stack.append((high, k - 1))
+    return bytes(digits.lstrip(b'\0'))
+
+
+def check(digits, body):
+    if INVALID in digits:
+        raise ValueError(f'Invalid base-94 digit in {body[:80]!r}')
+    return digits
+
+
+def translate(s, table, error):
+    data = s.encode('latin-1') if type(s) is str else s
+    result = data.translate(table)
+    if 0 in result:
+        c = chr(data[result.index(0)])
+        raise ValueError(f'Cannot {error} {c!r} in {s[:80]!r}')
+    return result.decode('latin-1') if type(s) is str else result
+
+
+def decrypt(s):
+    # S body to text.
+    return translate(s, DECRYPT_TABLE, 'decrypt')
+
+
+def encrypt(text):
+    # Text to an S body.
+    return translate(text, ENCRYPT_TABLE, 'encrypt')
+
+
+def asc2int(body):
+    # I body (or L / v parameter), a str or bytes, to an integer.
+    if type(body) is str:
+        body = body.encode('latin-1')
+    return decode(check(body.translate(_ASCII_TO_DIGIT), body))
+
+
+def int2asc(value):
+    # Integer to an I body.  '' for 0.
+    if value <= 0:
+        return ''
+    return encode(value).translate(_DIGIT_TO_ASCII).decode('ascii')
+
+
+def I_decode(icfp):
+    return asc2int(icfp)
+
+
+def I_encode(value):
+    # Same as int2asc(), but 0 is '!'.
+    return int2asc(value) or '!'
+
+
+def icfp2int(icfp):
+    # Decoded S text, read as base-94 digits of the S alphabet (U#).
+    return decode(check(icfp.encode('latin-1').translate(_TEXT_TO_DIGIT), icfp))
+
+
+def int2icfp(value):
+    # Integer to S text (U$).  '' for 0.
+    if value <= 0:
+        return ''
+    return encode(value).translate(_DIGIT_TO_TEXT).decode('ascii')
+
+
+# Digits of the benchmark run by --benchmark.
+BENCHMARK_DIGITS = 10 ** 6
+
+
+def benchmark(digits):
+    # Seconds to I_encode and to I_decode an integer of |digits| base-94 digits.
+    value = 94 ** digits - 12345
+    start = time.perf_counter()
+    body = I_encode(value)
+    encoded = time.perf_counter()
+    decoded_value = I_decode(body)
+    decoded = time.perf_counter()
+    if len(body) != digits or decoded_value != value:
+        raise AssertionError(f'The round trip of {digits} digits failed')
+    return encoded - start, decoded - encoded
+
+
+class TestCodec(unittest.TestCase):
+    def test_small(self):
+        self.assertEqual(I_decode('!'), 0)
+        self.assertEqual(I_decode('/6'), 1337)  # from the rules
+        self.assertEqual(I_encode(0), '!')
+        self.assertEqual(I_encode(1337), '/6')
+        self.assertEqual(int2asc(0), '')
+        self.assertEqual(icfp2int('test'), 15818151)
+        self.assertEqual(int2icfp(15818151), 'test')
+        self.assertEqual(int2icfp(0), '')
+
+    def test_round_trip(self):
+        for n in (1, 63, 64, 65, 127, 128, 129, 1000, 4097, 12345):
+            value = 94 ** n - 1
+            body = I_encode(value)
+            self.assertEqual(body, '~' * n)
+            self.assertEqual(I_decode(body), value)
+            value = 7 ** (n * 2) + 12345
+            self.assertEqual(I_decode(I_encode(value)), value)
+            self.assertEqual(icfp2int(int2icfp(value)), value)
+            self.assertEqual(I_encode(94 ** n), '"' + '!' * n)
+
+    def test_same_as_digit_loop(self):
+        value = 3 ** 20000 + 5
+        digits = []
+        x = value
+        while x:
+            digits.append(chr(x % 94 + 33))
+            x //= 94
+        self.assertEqual(I_encode(value), ''.join(reversed(digits)))
+
+    def test_radix(self):
+        for base in (2, 4, 9, 16, 94):
+            for n in (1, 64, 65, 1000):
+                digits = bytes((i * 7 + n) % base for i in range(n))
+                value = 0
+                for d in digits:
+                    value = value * base + d
+                self.assertEqual(decode(digits, base), value)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            asc2int('ab c')
+        with self.assertRaises(ValueError):
+            icfp2int('tab\t')
+        with self.assertRaises(ValueError):
+            encode(-1)
+
+    def test_crypt(self):
+        self.assertEqual(decrypt('B%,,/}Q/2,$_'), 'Hello World!')  # from the rules
+        self.assertEqual(encrypt('Hello World!'), 'B%,,/}Q/2,$_')
+        self.assertEqual(decrypt(b'B%,,/}Q/2,$_'), b'Hello World!')
+        self.assertEqual(encrypt(b'Hello World!'), b'B%,,/}Q/2,$_')
+        self.assertEqual(decrypt(''.join(map(chr, range(33, 127)))), mapping)
+        self.assertEqual(encrypt(mapping), ''.join(map(chr, range(33, 127))))
+        for text in ('{', '\t', 'caf\xe9'):
+            with self.assertRaises(ValueError):
+                encrypt(text)
+        for body in (' ', '\x80'):
+            with self.assertRaises(ValueError):
+                decrypt(body)
+
+    def test_benchmark(self):
+        # 10^5 digits take a fraction of a second, not minutes.  Run this module with --benchmark
+        # for 10^6.
+        encode_time, decode_time = benchmark(10 ** 5)
+        self.assertLess(encode_time, 3)
+        self.assertLess(decode_time, 3)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--benchmark':
+        # python icfp_codec.py --benchmark [<digits>]
+        digits = int(sys.argv[2]) if len(sys.argv) >= 3 else BENCHMARK_DIGITS
+        encode_time, decode_time = benchmark(digits)
+        print(f'{digits} digits: encode {encode_time:.2f}s, decode {decode_time:.2f}s')
+    else:
+        unittest.main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+# Compact AST for ICFP.
+#
+# A program is stored in preorder in parallel arrays instead of one Python
+# object per node.  The first operand of node i is always node i + 1, so only
+# the second and third operands need to be stored:
+#
+#   kind[i]   opcode (see below)
+#   right[i]  B/?: index of the second operand
+#             L/v: the parameter number in the source (only kept for printing)
+#   arg[i]    literal: index into |literals|
+#             v: de Bruijn index (0 is the innermost lambda), -1 if free
+#             ?: index of the false branch
+#
+# |literals| holds the values of T, F, I and S.  parse() keeps long I and S
+# literals encoded, as icfp_peria nodes of lazy_literal() (types in ENCODED),
+# and value() decodes one when the program first uses it.
+#
+# Variables refer to their binder by de Bruijn index, so the evaluator never
+# compares parameter names and cannot capture variables.
+
+from array import array
+from collections import deque
+import copy
+from pathlib import Path
+import tracemalloc
+import unittest
+
+import icfp_peria
+from icfp_peria import (Boolean, Integer, String, UnaryOperator, BinaryOperator, If,
+                        LambdaEvaluator, StrictEvaluator, LoopCall, Lambda, Variable, decode, scan, tokenize)
+
+# Opcodes.
+LIT = 0             # T, F, I, S
+VAR = 1
+LAM = 2
+IF = 3
+APPLY = 4           # B$ (call-by-name)
+LAZY_APPLY = 5      # B~ (call-by-need)
+STRICT_APPLY = 6    # B! (call-by-value)
+UNARY_OPERATORS = '-!#$'
+BINARY_OPERATORS = '+-*/%<>=|&.TD'
+UNARY = 8           # U- is UNARY, U! is UNARY + 1, ...
+BINARY = 16         # B+ is BINARY, B- is BINARY + 1, ...
+
+APPLY_CODES = {'$': APPLY, '~': LAZY_APPLY, '!': STRICT_APPLY}
+
+# Types of the entries of CompactAST.literals that are not decoded yet.
+ENCODED = (Integer, String)
+
+
+def arity(code):
+    if code == IF:
+        return 3
+    if code >= BINARY or APPLY <= code <= STRICT_APPLY:
+        return 2
+    if code >= UNARY or code == LAM:
+        return 1
+    return 0
+
+
+class CompactAST(object):
+    __slots__ = ('kind', 'right', 'arg', 'literals')
+
+    def __init__(self, kind=None, right=None, arg=None, literals=None):
+        self.kind = array('B') if kind is None else kind
+        self.right = array('i') if right is None else right
+        self.arg = array('i') if arg is None else arg
+        self.literals = [] if literals is None else literals
+
+    def __len__(self):
+        return len(self.kind)
+
+    def value(self, i):
+        # The value of literals[i], decoded and stored on first use.
+        value = self.literals[i]
+        if type(value) in ENCODED:
+            value = self.literals[i] = value.value
+        return value
+
+    def nbytes(self):
+        # Memory used by the node arrays (literal values are not included).
+        return sum(a.itemsize * len(a) for a in (self.kind, self.right, self.arg))
+
+    @staticmethod
+    def parse(tokens):
+        return CompactAST.build(decode(tokens))
+
+    @staticmethod
+    def build(pairs):
+        # |pairs| are (indicator, value) from icfp_peria.scan() or decode().
+        builder = Builder()
+        for indicator, value in pairs:
+            if indicator == 'T':
+                done = builder.add(LIT, literal=True)
+            elif indicator == 'F':
+                done = builder.add(LIT, literal=False)
+            elif indicator == 'I' or indicator == 'S':
+                # |value| may be a node of lazy_literal().
+                done = builder.add(LIT, literal=value)
+            elif indicator == 'v':
+                done = builder.add(VAR, parameter=value)
+            elif indicator == 'L':
+                done = builder.add(LAM, parameter=value)
+            elif indicator == 'U':
+                done = builder.add(UNARY + operator_index(UNARY_OPERATORS, value))
+            elif indicator == 'B':
+                code = APPLY_CODES.get(value)
+                if code is None:
+                    code = BINARY + operator_index(BINARY_OPERATORS, value)
+                done = builder.add(code)
+            elif indicator == '?':
+                done = builder.add(IF)
+            else:
+                raise ValueError(f'Unknown indicator [{indicator}]: {value}')
+            if done:
+                return builder.ast
+        raise ValueError('Unexpected end of the program')
+
+    @staticmethod
+    def from_ast(node):
+        # Converts an icfp_peria AST.  The StrictEvaluator nodes of accelerate_loops() become
+        # plain applications; its LoopCall nodes have no compact form.
+        builder = Builder()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            t = type(node)
+            if t is Boolean:
+                builder.add(LIT, literal=node.value)
+            elif t is Integer or t is String:
+                # Literals still encoded stay so.
+                builder.add(LIT, literal=copy.copy(node) if node.encoded is not None else node.value)
+            elif t is Variable:
+                builder.add(VAR, parameter=node.parameter)
+            elif t is Lambda:
+                builder.add(LAM, parameter=node.parameter)
+                stack.append(node.definition)
+            elif t is UnaryOperator:
+                builder.add(UNARY + operator_index(UNARY_OPERATORS, node.operator))
+                stack.append(node.value)
+            elif t is LambdaEvaluator or t is StrictEvaluator or t is BinaryOperator:
+                code = APPLY_CODES.get(node.operator)
+                if code is None:
+                    code = BINARY + operator_index(BINARY_OPERATORS, node.operator)
+                builder.add(code)
+                stack.append(node.right)
+                stack.append(node.left)
+            elif t is If:
+                builder.add(IF)
+                stack.append(node.false_branch)
+                stack.append(node.true_branch)
+                stack.append(node.condition)
+            elif t is LoopCall:
+                raise ValueError(f'Cannot convert a loop of accelerate_loops(): {node}; convert the AST before accelerating it')
+            else:
+                raise ValueError(f'Unknown node: {node}')
+        return builder.ast
+
+    def end(self, i):
+        # Returns the index next to the last node of the subtree at |i|.
+        kind = self.kind
+        pending = 1
+        while pending:
+            pending += arity(kind[i]) - 1
+            i += 1
+        return i
+
+    def node(self, i=0):
+        # Materializes the subtree at |i| as icfp_peria nodes.  Nodes are
+        # built from the last one so that every operand already exists.
+        kind, right, arg, literals = self.kind, self.right, self.arg, self.literals
+        built = {}
+        for j in range(self.end(i) - 1, i - 1, -1):
+            code = kind[j]
+            if code == LIT:
+                value = literals[arg[j]]
+                t = type(value)
+                if t in ENCODED:
+                    node = copy.copy(value)
+                else:
+                    node = Boolean(value) if t is bool else Integer(value) if t is int else String(value)
+            elif code == VAR:
+                node = Variable(right[j])
+            elif code == LAM:
+                node = Lambda(right[j], built.pop(j + 1))
+            elif code == IF:
+                node = If(built.pop(j + 1), built.pop(right[j]), built.pop(arg[j]))
+            elif code == APPLY:
+                node = LambdaEvaluator(built.pop(j + 1), built.pop(right[j]))
+            elif code == LAZY_APPLY or code == STRICT_APPLY:
+                op = '~' if code == LAZY_APPLY else '!'
+                node = BinaryOperator(op, built.pop(j + 1), built.pop(right[j]))
+            elif code >= BINARY:
+                node = BinaryOperator(BINARY_OPERATORS[code - BINARY], built.pop(j + 1), built.pop(right[j]))
+            else:
+                node = UnaryOperator(UNARY_OPERATORS[code - UNARY], built.pop(j + 1))
+            built[j] = node
+        return built[i]
+
+
+class Builder(object):
+    # Appends nodes in preorder and links each operand to its parent.
+    def __init__(self):
+        self.ast = CompactAST()
+        self.scope = []     # Parameters of the enclosing lambdas, innermost last.
+        self.stack = []     # [node index, number of finished operands, arity]
+
+    def add(self, code, parameter=0, literal=None):
+        # Returns True when the whole program is complete.
+        ast, scope, stack = self.ast, self.scope, self.stack
+        i = len(ast.kind)
+        if stack:
+            parent = stack[-1]
+            if parent[1] == 1:
+                ast.right[parent[0]] = i
+            elif parent[1] == 2:
+                ast.arg[parent[0]] = i
+        value = 0
+        if code == LIT:
+            value = len(ast.literals)
+            ast.literals.append(literal)
+        elif code == VAR:
+            value = -1
+            for depth in range(len(scope) - 1, -1, -1):
+                if scope[depth] == parameter:
+                    value = len(scope) - 1 - depth
+                    break
+        ast.kind.append(code)
+        ast.right.append(parameter)
+        ast.arg.append(value)
+
+        n = arity(code)
+        if n:
+            if code == LAM:
+                scope.append(parameter)
+            stack.append([i, 0, n])
+            return False
+        while stack:
+            parent = stack[-1]
+            parent[1] += 1
+            if parent[1] < parent[2]:
+                return False
+            stack.pop()
+            if ast.kind[parent[0]] == LAM:
+                scope.pop()
+        return True
+
+
+def operator_index(operators, op):
+    i = operators.find(op)
+    if len(op) != 1 or i < 0:
+        raise ValueError(f'Unknown operator: {op}')
+    return i
+
+
+def parse(icfp):
+    # |icfp| is a str, bytes, memoryview or mmap.
+    return CompactAST.build(scan(icfp, lazy=True))
+
+
+class TestCompactAST(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    ROOT_DIR = SCRIPT_DIR.parent
+    PROBLEMS_DIR = ROOT_DIR / 'data' / 'courses' / 'efficiency' / 'problems'
+
+    def test_layout(self):
+        # 0:B$ 1:L# 2:? 3:B< 4:v# 5:I# 6:U- 7:v# 8:v" 9:I$
+        ast = parse('B$ L# ? B< v# I# U- v# v" I$')
+        self.assertEqual(list(ast.kind), [APPLY, LAM, IF, BINARY + 5, VAR, LIT, UNARY, VAR, VAR, LIT])
+        self.assertEqual(ast.right[0], 9)   # the argument of B$
+        self.assertEqual(ast.right[2], 6)   # the true branch
+        self.assertEqual(ast.arg[2], 8)     # the false branch
+        self.assertEqual(ast.arg[4], 0)     # v# is bound by the innermost lambda
+        self.assertEqual(ast.arg[8], -1)    # v" is free
+        self.assertEqual(ast.literals, [2, 3])
+        self.assertEqual(ast.end(1), 9)
+
+    def test_de_bruijn(self):
+        # \x1. \x2. \x1. x2 x1: the inner x1 shadows the outer one.
+        ast = parse('L" L# L" B$ v# v"')
+        self.assertEqual([ast.arg[i] for i in (4, 5)], [1, 0])
+
+    def test_round_trip(self):
+        icfp = 'B$ L# ? B< v# I# U- v# B. S4% S34 B~ L" v" B! L" B+ v" I" T'
+        ast = icfp_peria.parse(tokenize(icfp))
+        self.assertEqual(str(parse(icfp).node()), str(ast))
+        self.assertEqual(str(CompactAST.from_ast(ast).node()), str(ast))
+
+    def test_accelerated(self):
+        # (\f. f (f 1)) (\x. x + x) has StrictEvaluator nodes, which are applications.
+        plain = icfp_peria.parse(tokenize('B$ L! B$ v! B$ v! I" L! B+ v! v!'))
+        ast = icfp_peria.accelerate_loops(plain)
+        self.assertIs(type(ast), StrictEvaluator)
+        compact = CompactAST.from_ast(ast)
+        self.assertEqual(compact.kind[0], APPLY)
+        self.assertEqual(str(compact.node()), str(plain))
+        # A fixpoint over a counter becomes a LoopCall, which is rejected.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        ast = icfp_peria.accelerate_loops(icfp_peria.parse(tokenize(f'B$ B$ {y} L$ L% ? B= v% I! I" B+ I" B$ v$ B- v% I" I+')))
+        with self.assertRaisesRegex(ValueError, 'accelerate_loops'):
+            CompactAST.from_ast(ast)
+
+    def test_lazy_literals(self):
+        # Long literals stay encoded until value() is asked for, also through node() and from_ast().
+        digits = '~' * 100
+        ast = parse(f'B+ I" I{digits}')
+        self.assertEqual(ast.literals[0], 1)
+        self.assertIsNotNone(ast.literals[1].encoded)
+        self.assertIsNotNone(ast.node(2).encoded)
+        self.assertIsNotNone(CompactAST.from_ast(ast.node()).literals[1].encoded)
+        self.assertEqual(ast.value(1), 94 ** 100 - 1)
+        self.assertEqual(ast.literals[1], 94 ** 100 - 1)
+
+    def test_deep_program(self):
+        depth = 200000
+        ast = parse('B+ I" ' * depth + 'I!')
+        self.assertEqual(len(ast), 2 * depth + 1)
+        self.assertEqual(ast.end(0), len(ast))
+        self.assertEqual(type(ast.node(2 * depth - 2)), BinaryOperator)
+
+    def test_memory(self):
+        # The compact form takes less than 1/5 of the memory of icfp_peria nodes.
+        with open(self.PROBLEMS_DIR / 'efficiency10.icfp') as f:
+            icfp = f.read().strip()
+        tokens = list(tokenize(icfp))
+
+        def traced_size(f):
+            tracemalloc.start()
+            result = f()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return result, size
+
+        _, peria_size = traced_size(lambda: icfp_peria.parse(deque(tokens)))
+        _, compact_size = traced_size(lambda: CompactAST.parse(tokens))
+        self.assertLess(compact_size * 5, peria_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,17 @@
+import contextlib
+import io
 import os
+import random
 import re
 import sys
 import unittest
+import unittest.mock
 import collections
+from operator import itemgetter
+import icfp_cache
+import icfp_codec
 from icfp import icfp2ascii, reduce_extended_icfp
-from icfp_peria import encrypt, I_encode
+from icfp_codec import decrypt, encrypt, I_encode
 
 program = '''
 # 'LRUD'[i % 4]
@@ -120,6 +127,7 @@ class RLE(object):
         self.chars = chars
         assert '$' not in chars # to use as the sentinel
         self.rev = dict((c, i) for i, c in enumerate(chars))
+        self.run_pattern = re.compile('|'.join(re.escape(c) + '+' for c in chars))
 
     @staticmethod
     def find_max_run_length(path):
@@ -138,44 +146,55 @@ class RLE(object):
             i += 1
         return max_run_length
 
+    def runs(self, path):
+        '''pathを同じ文字の並び (ラン) に分けて、(ランの長さ, 文字の番号) のリストを返す'''
+        runs = self.run_pattern.findall(path)
+        lengths = list(map(len, runs))
+        if sum(lengths) != len(path):
+            raise ValueError(f'path has a character not in {self.chars!r}')
+        return list(zip(lengths, map(self.rev.__getitem__, map(itemgetter(0), runs))))
+
     def rle_encode(self, path, run_bits=None):
         '''RRRRLLUUDDのようなpathをRLEエンコードする。方向は2ビット、ラン長さは盤面から決める固定ビット。
         (固定ビット長, ラン数, 圧縮後数値) を返す
         下位ビットがpath[0]に対応する'''
+        return self.pack_runs(self.runs(path), run_bits)
+
+    def pack_runs(self, runs, run_bits=None):
+        '''runs() のランを固定長のフィールドに詰めて (固定ビット長, ラン数, 圧縮後数値) を返す。
+        フィールドを上位から2進の文字列として並べ、最後に一度だけ int(..., 2) で整数にするので、pathの長さに線形。'''
         if run_bits is None:
-            max_run_length = RLE.find_max_run_length(path)
+            max_run_length = max((run_length for run_length, _ in runs), default=0)
             run_bits = 1
             while max_run_length >= 2**run_bits:
                 run_bits += 1
         max_possible_run_length = 2**run_bits - 1
-
-        result = 0
-        i = 0
-        run_length = 0
-        num_runs = 0
-        path = path[::-1] + '$' # sentinel
-        while i < len(path):
-            if (i == 0 or path[i - 1] == path[i]) and run_length < max_possible_run_length:
-                # continue
-                run_length += 1
-            else:
-                # emit. note that the sentinel path[i] == '$' also comes here.
-                c = self.rev[path[i - 1]]
-                result = result * (2**(run_bits + self.bits)) + (run_length << self.bits) + c
-                num_runs += 1
-                run_length = 1
-            i += 1
-        return run_bits, num_runs, result
+        width = run_bits + self.bits
+
+        # 同じ (長さ, 文字) のランは同じビット列になる。
+        # 長すぎるランは max_possible_run_length ずつに分け、余りを下位 (pathの先頭側) に置く。
+        fields = {}
+        counts = {}
+        for run in set(runs):
+            run_length, c = run
+            n, rest = divmod(run_length - 1, max_possible_run_length)
+            fields[run] = (format((max_possible_run_length << self.bits) + c, f'0{width}b') * n
+                           + format((rest + 1 << self.bits) + c, f'0{width}b'))
+            counts[run] = n + 1
+        bits = ''.join(map(fields.__getitem__, reversed(runs)))
+        return run_bits, sum(map(counts.__getitem__, runs)), int(bits, 2) if bits else 0
 
     def rle_encode_optimal(self, path):
         '''最短になるようなmax_run_lengthを探す'''
-        max_run_length = RLE.find_max_run_length(path)
+        # ランの切れ目は一度だけ求めて、すべての run_bits で使い回す
+        runs = self.runs(path)
+        max_run_length = max((run_length for run_length, _ in runs), default=0)
         max_run_bits = 1
         while max_run_length >= 2**max_run_bits:
             max_run_bits += 1
         results = []
         for run_bits in range(2, max_run_bits + 1):
-            _, num_runs, result = self.rle_encode(path, run_bits=run_bits)
+            _, num_runs, result = self.pack_runs(runs, run_bits=run_bits)
             results.append((result, num_runs, run_bits))
         results.sort() # smallest result = shortest.
         result, num_runs, run_bits = results[0]
@@ -225,6 +244,17 @@ class RLE(object):
         print(f'[RLE]ENCODED PATH(LENGTH={len(arg)}): {arg}')
         print()
         preamble = encrypt(f'solve {problem}{problem_num} ')
+        print(f'[RLE] CHARS = {self.chars}')
+        print(f'[RLE] 2_POW_CHAR_BITS = {2 ** self.bits}')
+        print(f'[RLE] SIZE_RUN_LENGTH = {2**run_bits}')
+        print(f'[RLE] SIZE_RUN = {2**(self.bits + run_bits)}')
+        func = self.decoder(run_bits)
+        result = f'B. S{preamble} B$ B$ {func} I{I_encode(num_runs)} {arg}'
+        print(f'[RLE]COMPRESSED({len(result)}):', result)
+        return result
+
+    def decoder(self, run_bits):
+        '''B$ B$ <decoder> I<ラン数> I<圧縮後数値> がpathになるICFPの関数を返す'''
         SIZE_RUN_LENGTH = 2**run_bits
         SIZE_RUN = 2**(self.bits + run_bits)
         header = f'''
@@ -233,14 +263,7 @@ class RLE(object):
         SIZE_RUN_LENGTH := I{I_encode(SIZE_RUN_LENGTH)}
         SIZE_RUN := I{I_encode(SIZE_RUN)}
         '''
-        print(f'[RLE] CHARS = {self.chars}')
-        print(f'[RLE] 2_POW_CHAR_BITS = {2 ** self.bits}')
-        print(f'[RLE] SIZE_RUN_LENGTH = {SIZE_RUN_LENGTH}')
-        print(f'[RLE] SIZE_RUN = {SIZE_RUN}')
-        func = reduce_extended_icfp(header + program, 'rle_decode')
-        result = f'B. S{preamble} B$ B$ {func} I{I_encode(num_runs)} {arg}'
-        print(f'[RLE]COMPRESSED({len(result)}):', result)
-        return result
+        return reduce_extended_icfp(header + program, 'rle_decode')
 
 lambdaman_rle = RLE(2, 'LRUD')
 spaceship_rle = RLE(4, '123456789')
@@ -267,10 +290,8 @@ class BaseX(object):
             return self.chars[path_int % self.alphabets] + self.encode_recursive(n_chars - 1, path_int // self.alphabets)
 
     def decode(self, base4_str):
-        result = 0
-        for c in base4_str[::-1]:
-            result = result * self.alphabets + self.rev[c]
-        return result
+        '''base4_str[0] が最下位の桁。桁を bytes にして icfp_codec.decode でまとめて整数にする'''
+        return icfp_codec.decode(bytes(map(self.rev.__getitem__, reversed(base4_str))), self.alphabets)
 
     def compress_solution(self, problem, problem_num, path):
         '''lambdamanの回答であるpath(RRRUUDLD..みたいなやつ)に評価されるような短いICFPを生成する
@@ -284,20 +305,284 @@ class BaseX(object):
         print(f'[BASEX]ENCODED PATH(LENGTH={len(arg)}): {arg}')
         print()
         preamble = encrypt(f'solve {problem}{problem_num} ')
-        header = f'''
-        CHARS := S{encrypt(self.chars)}
-        N_CHARS := I{I_encode(self.alphabets)}
-        '''
         print(f'[BASEX] CHARS = {self.chars}')
         print(f'[BASEX] N_CHARS = {self.alphabets}')
-        func = reduce_extended_icfp(header + program, 'basex_decode')
+        func = self.decoder()
         result = f'B. S{preamble} B$ B$ {func} I{I_encode(len(path))} {arg}'
         print(f'[BASEX]COMPRESSED({len(result)}):', result)
         return result
 
+    def decoder(self):
+        '''B$ B$ <decoder> I<文字数> I<圧縮後数値> がpathになるICFPの関数を返す'''
+        header = f'''
+        CHARS := S{encrypt(self.chars)}
+        N_CHARS := I{I_encode(self.alphabets)}
+        '''
+        return reduce_extended_icfp(header + program, 'basex_decode')
+
 lambdaman_base4 = BaseX('LRUD')
 spaceship_base9 = BaseX('123456789')
 
+lz_program = '''
+# LZ77: 整数 i の下位ビットから順に、1文字 (リテラル) か、それまでに展開した文字列 a の部分文字列 (コピー) を読む。
+# 最上位の 1 は番兵。
+# lz_decodegen = lambda g: (lambda a: (lambda i: a if i == 1 else
+#     g(a + CHARS[i // 2 % 2_POW_CHAR_BITS])(i // LITERAL_SIZE) if i % 2 == 0 else
+#     g(a + a[i // 2 % OFFSET_SIZE:][:i // LENGTH_SHIFT % LENGTH_SIZE])(i // COPY_SIZE)))
+# 引数は B! で先に評価する。名前呼びだと a と i の式が呼び出しごとに伸びていく。
+# using
+#   vg
+#   va
+#   vi
+# require
+#   $CHARS
+#   $2_POW_CHAR_BITS
+#   $LITERAL_SIZE
+#   $OFFSET_SIZE
+#   $LENGTH_SHIFT
+#   $LENGTH_SIZE
+#   $COPY_SIZE
+lz_decodegen := Lg ( La ( Li ? ( B= vi I" ) ( va ) ( ? ( B= B% vi I# I! ) ( B! B! vg ( B. va BT I" BD B% B/ vi I# $2_POW_CHAR_BITS $CHARS ) ( B/ vi $LITERAL_SIZE ) ) ( B! B! vg ( B. va BT B% B/ vi $LENGTH_SHIFT $LENGTH_SIZE BD B% B/ vi I# $OFFSET_SIZE va ) ( B/ vi $COPY_SIZE ) ) ) ) )
+lz_decode := B$ $Y $lz_decodegen
+'''
+
+class LZ77(object):
+    '''pathの中で前に出てきた部分文字列をコピーとして参照する。通路の往復や同じ掃き方の繰り返しが短くなる。
+    トークンは下位ビットから順に
+      リテラル: 0, 文字 (bitsビット)
+      コピー:   1, 開始位置 (offset_bitsビット), 長さ (length_bitsビット)
+    コピー元は展開済みの部分に収まる (重ならない) ものに限る。'''
+    # 同じ k-gram の出現位置のうち、一致を調べる最近のものの数
+    CHAIN = 16
+
+    def __init__(self, bits, chars):
+        self.bits = bits
+        self.chars = chars
+        self.rev = dict((c, i) for i, c in enumerate(chars))
+
+    def parse(self, path, offset_bits, length_bits):
+        '''貪欲に最長一致を取って、(0, 文字番号) か (1, 開始位置, 長さ) のリストを返す'''
+        literal_width = 1 + self.bits
+        copy_width = 1 + offset_bits + length_bits
+        # これより短いコピーはリテラルの並びより長くなる
+        k = copy_width // literal_width + 1
+        max_length = 2**length_bits - 1
+        tokens = []
+        index = collections.defaultdict(list)
+        pos = 0
+        while pos < len(path):
+            best_length, best_offset = 0, 0
+            key = path[pos:pos + k]
+            if len(key) == k and k <= max_length:
+                for q in reversed(index.get(key, ())[-self.CHAIN:]):
+                    limit = min(max_length, pos - q, len(path) - pos)
+                    if limit < k or limit <= best_length:
+                        continue
+                    # path[q:q + lo] == path[pos:pos + lo] が成り立つ最大の lo を二分探索
+                    lo, hi = k, limit
+                    while lo < hi:
+                        mid = (lo + hi + 1) // 2
+                        if path[q + lo:q + mid] == path[pos + lo:pos + mid]:
+                            lo = mid
+                        else:
+                            hi = mid - 1
+                    if lo > best_length:
+                        best_length, best_offset = lo, q
+            if best_length >= k:
+                tokens.append((1, best_offset, best_length))
+                end = pos + best_length
+            else:
+                tokens.append((0, self.rev[path[pos]]))
+                end = pos + 1
+            for i in range(pos, end):
+                index[path[i:i + k]].append(i)
+            pos = end
+        return tokens
+
+    def lz_encode(self, path, length_bits):
+        '''(開始位置のビット数, 長さのビット数, 圧縮後数値) を返す。下位ビットが path[0] 側'''
+        offset_bits = max(1, len(path).bit_length())
+        fields = []
+        for token in reversed(self.parse(path, offset_bits, length_bits)):
+            if token[0] == 0:
+                fields.append(format(token[1] << 1, f'0{1 + self.bits}b'))
+            else:
+                _, offset, length = token
+                fields.append(format((length << offset_bits + 1) + (offset << 1) + 1, f'0{1 + offset_bits + length_bits}b'))
+        # 先頭の '1' が番兵
+        return offset_bits, length_bits, int('1' + ''.join(fields), 2)
+
+    def lz_encode_optimal(self, path):
+        '''最短になるような length_bits を探す'''
+        results = []
+        for length_bits in range(3, max(4, len(path).bit_length() + 1)):
+            offset_bits, _, result = self.lz_encode(path, length_bits)
+            results.append((result, offset_bits, length_bits))
+        result, offset_bits, length_bits = min(results)
+        return offset_bits, length_bits, result
+
+    def lz_decode(self, offset_bits, length_bits, lz_int):
+        '''lz_decodegen と同じことをPythonで。ビット列を下位から読む'''
+        bits = bin(lz_int)[3:]
+        pos = len(bits)
+        result = ''
+        while pos > 0:
+            if bits[pos - 1] == '0':
+                result += self.chars[int(bits[pos - 1 - self.bits:pos - 1], 2)]
+                pos -= 1 + self.bits
+            else:
+                offset = int(bits[pos - 1 - offset_bits:pos - 1], 2)
+                length = int(bits[pos - 1 - offset_bits - length_bits:pos - 1 - offset_bits], 2)
+                result += result[offset:offset + length]
+                pos -= 1 + offset_bits + length_bits
+        return result
+
+    def decoder(self, offset_bits, length_bits):
+        '''B! B! <decoder> S I<圧縮後数値> がpathになるICFPの関数を返す'''
+        header = f'''
+        CHARS := S{encrypt(self.chars)}
+        2_POW_CHAR_BITS := I{I_encode(2 ** self.bits)}
+        LITERAL_SIZE := I{I_encode(2 ** (1 + self.bits))}
+        OFFSET_SIZE := I{I_encode(2 ** offset_bits)}
+        LENGTH_SHIFT := I{I_encode(2 ** (1 + offset_bits))}
+        LENGTH_SIZE := I{I_encode(2 ** length_bits)}
+        COPY_SIZE := I{I_encode(2 ** (1 + offset_bits + length_bits))}
+        '''
+        return reduce_extended_icfp(header + program + lz_program, 'lz_decode')
+
+    def compress_solution(self, problem, problem_num, path):
+        '''lambdamanの回答であるpath(RRRUUDLD..みたいなやつ)に評価されるような短いICFPを生成する
+        path: RULDで構成された文字列
+        returns: ICFPの式で、評価するとpathになる
+        '''
+        offset_bits, length_bits, encoded_int = self.lz_encode_optimal(path)
+        print(f'[LZ]ORIGINAL PATH LENGTH: {len(path)}')
+        arg = 'I' + I_encode(encoded_int)
+        print(f'[LZ]ENCODED PATH(LENGTH={len(arg)}) OFFSET_BITS={offset_bits} LENGTH_BITS={length_bits}')
+        preamble = encrypt(f'solve {problem}{problem_num} ')
+        result = f'B. S{preamble} B! B! {self.decoder(offset_bits, length_bits)} S {arg}'
+        print(f'[LZ]COMPRESSED({len(result)}):', result)
+        return result
+
+lambdaman_lz = LZ77(2, 'LRUD')
+spaceship_lz = LZ77(4, '123456789')
+
+relative_program = '''
+# 相対方向: 記号 s[0] の番号 (ICFPの文字コード) だけ直前の向き p から回した向きの文字を出す。
+# rel_decodegen = lambda r: (lambda p: (lambda s: '' if s == '' else
+#     (lambda k: CHARS[k] + r(k)(s[1:]))((p + int(s[0])) % N_CHARS)))
+# 最初の向きは CHARS[0]。
+# using
+#   vr
+#   vp
+#   vs
+#   vk
+# require
+#   $CHARS
+#   $N_CHARS
+rel_decodegen := Lr ( Lp ( Ls ? ( B= vs S ) ( S ) ( B! Lk ( B. ( BT I" BD vk $CHARS ) ( B! B! vr vk BD I" vs ) ) ( B% B+ vp U# BT I" vs $N_CHARS ) ) ) )
+rel_decode := B$ B$ $Y $rel_decodegen I!
+'''
+
+class Relative(object):
+    '''pathを直前の動きからの相対的な記号列にしてから、RLE・BaseX・LZ77で詰める。
+    記号 k は「直前の向きの番号 + k (mod 文字数)」の向き。
+    lambdamanは時計回りに URDL と並べるので a:直進 b:右 c:後ろ d:左 になり、渦巻きや蛇行が同じ記号の並びになる。
+    spaceshipは加速の番号の差で、同じ加速の続きが a になる。
+    記号はICFPの文字コードが 0, 1, 2.. の a, b, c.. なので、ICFPでは U# で番号に戻せる。'''
+    SYMBOLS = 'abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, bits, chars):
+        self.bits = bits
+        self.chars = chars
+        self.rev = dict((c, i) for i, c in enumerate(chars))
+        self.symbols = self.SYMBOLS[:len(chars)]
+        self.rle = RLE(bits, self.symbols)
+        self.basex = BaseX(self.symbols)
+        self.lz = LZ77(bits, self.symbols)
+
+    def to_relative(self, path):
+        '''path[0] は chars[0] からの相対'''
+        n = len(self.chars)
+        indices = [0] + [self.rev[c] for c in path]
+        return ''.join(self.symbols[(b - a) % n] for a, b in zip(indices, indices[1:]))
+
+    def to_absolute(self, relative):
+        '''rel_decodegen と同じことをPythonで'''
+        n = len(self.chars)
+        result = []
+        k = 0
+        for s in relative:
+            k = (k + self.symbols.index(s)) % n
+            result.append(self.chars[k])
+        return ''.join(result)
+
+    def encode(self, path, packer):
+        '''相対記号列を packer ('rle', 'basex', 'lz') で詰めて、その記号列に評価される式を返す'''
+        relative = self.to_relative(path)
+        if packer == 'rle':
+            run_bits, num_runs, encoded_int = self.rle.rle_encode_optimal(relative)
+            return f'B$ B$ {self.rle.decoder(run_bits)} I{I_encode(num_runs)} I{I_encode(encoded_int)}'
+        if packer == 'basex':
+            encoded_int = self.basex.decode(relative)
+            return f'B$ B$ {self.basex.decoder()} I{I_encode(len(relative))} I{I_encode(encoded_int)}'
+        if packer == 'lz':
+            offset_bits, length_bits, encoded_int = self.lz.lz_encode_optimal(relative)
+            return f'B! B! {self.lz.decoder(offset_bits, length_bits)} S I{I_encode(encoded_int)}'
+        raise ValueError(f'Unknown packer: {packer}')
+
+    def decoder(self):
+        '''B! <decoder> <相対記号列> がpathになるICFPの関数を返す'''
+        header = f'''
+        CHARS := S{encrypt(self.chars)}
+        N_CHARS := I{I_encode(len(self.chars))}
+        '''
+        return reduce_extended_icfp(header + program + relative_program, 'rel_decode')
+
+    def compress_solution(self, problem, problem_num, path, packer='rle'):
+        '''lambdamanの回答であるpath(RRRUUDLD..みたいなやつ)に評価されるような短いICFPを生成する
+        path: RULDで構成された文字列
+        returns: ICFPの式で、評価するとpathになる
+        '''
+        print(f'[REL]ORIGINAL PATH LENGTH: {len(path)}')
+        preamble = encrypt(f'solve {problem}{problem_num} ')
+        if not path:
+            return f'S{preamble}'
+        result = f'B. S{preamble} B! {self.decoder()} {self.encode(path, packer)}'
+        print(f'[REL]COMPRESSED({len(result)}, {packer}):', result)
+        return result
+
+lambdaman_relative = Relative(2, 'URDL')
+spaceship_relative = Relative(4, '123456789')
+
+# benchmark() で比べる圧縮。(名前, 圧縮する関数(問題名, 番号, path))
+BENCHMARK_ENCODERS = (
+    ('base4', lambdaman_base4.compress_solution),
+    ('rle', lambdaman_rle.compress_solution),
+    ('lz', lambdaman_lz.compress_solution),
+    ('rel+base4', lambda problem, num, path: lambdaman_relative.compress_solution(problem, num, path, 'basex')),
+    ('rel+rle', lambda problem, num, path: lambdaman_relative.compress_solution(problem, num, path, 'rle')),
+    ('rel+lz', lambda problem, num, path: lambdaman_relative.compress_solution(problem, num, path, 'lz')),
+)
+SOLUTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'courses', 'lambdaman', 'solutions')
+
+def benchmark(solutions_dir=SOLUTIONS_DIR):
+    '''solutions_dir の "solve lambdamanN <path>" の回答をすべての圧縮で縮めて、問題ごとの長さを返す。
+    {ファイル名 (拡張子なし): {圧縮の名前: 長さ}}。長さには元の回答 ('raw') も入る'''
+    results = {}
+    for filename in sorted(os.listdir(solutions_dir)):
+        with open(os.path.join(solutions_dir, filename)) as f:
+            mo = re.fullmatch(r'solve (lambdaman)(\d+) ([LRUD]+)', f.read().strip())
+        if mo is None:
+            continue
+        problem, num, path = mo.groups()
+        lengths = {'raw': len(f'S{encrypt(mo.group(0))}')}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, compress in BENCHMARK_ENCODERS:
+                lengths[name] = len(compress(problem, int(num), path))
+        results[os.path.splitext(filename)[0]] = lengths
+    return results
+
 class TestLambdamanDangomushi(unittest.TestCase):
     def test_decode(self):
         dangomushi = LambdamanDangomushi(4)
@@ -308,6 +593,12 @@ class TestLambdamanDangomushi(unittest.TestCase):
         self.assertEqual(dangomushi.decode(run_bits=5, num_runs=2, rle_int=0b00010_1_01110_0), 'RRRRDDDDLLLLUU' + 'LL') # CW U->CCW L
 
 class TestICFPCompression(unittest.TestCase):
+    def setUp(self):
+        # Evaluate every program through icfp2ascii, instead of reading results cached by icfp_cache.
+        patcher = unittest.mock.patch.dict(os.environ, {icfp_cache.CACHE_VARIABLE: ''})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_rle(self):
         self.assertEqual(lambdaman_rle.rle_encode('RRUU'), (2, 2, 0b1010_1001))
         self.assertEqual(lambdaman_rle.rle_encode('RRUU'), (2, 2, 0b1010_1001))
@@ -318,6 +609,68 @@ class TestICFPCompression(unittest.TestCase):
         num_bits, num_runs, rle_int = lambdaman_rle.rle_encode(path)
         self.assertEqual(lambdaman_rle.rle_decode_recursive(num_bits, num_runs, rle_int), path)
 
+    def test_encode_long_path(self):
+        # 1M moves of spaceship.  The path is split into runs once, and every run_bits is tried on
+        # the same runs.
+        rng = random.Random(0)
+        path = ''.join(rng.choice('123456789') * rng.randint(1, 5) for _ in range(400000))[:10**6]
+        with unittest.mock.patch.object(spaceship_rle, 'runs', wraps=spaceship_rle.runs) as runs:
+            run_bits, num_runs, rle_int = spaceship_rle.rle_encode_optimal(path)
+        self.assertEqual(runs.call_count, 1)
+        base9_int = spaceship_base9.decode(path)
+        # The low digits are the start of the path.
+        head = spaceship_rle.rle_decode(run_bits, 10, rle_int % 2**(10 * (run_bits + spaceship_rle.bits)))
+        self.assertEqual(head, path[:len(head)])
+        self.assertEqual(spaceship_base9.encode(100, base9_int % 9**100), path[:100])
+        self.assertLessEqual(num_runs, len(path))
+
+    def test_lz(self):
+        rng = random.Random(0)
+        sweeps = [''.join(rng.choice('LRUD') * rng.randint(1, 6) for _ in range(8)) for _ in range(30)]
+        path = ''.join(rng.choice(sweeps) for _ in range(300))
+        offset_bits, length_bits, lz_int = lambdaman_lz.lz_encode_optimal(path)
+        self.assertEqual(lambdaman_lz.lz_decode(offset_bits, length_bits, lz_int), path)
+        self.assertLess(lz_int.bit_length(), lambdaman_rle.rle_encode_optimal(path)[2].bit_length())
+        result = icfp2ascii(lambdaman_lz.compress_solution('lambdaman', 4, path))
+        self.assertEqual(result, f'solve lambdaman4 {path}')
+        for path in ('', 'L', 'LRLRLRLRLRLR', '5' * 100):
+            lz = spaceship_lz if path.startswith('5') else lambdaman_lz
+            self.assertEqual(lz.lz_decode(*lz.lz_encode_optimal(path)), path)
+        path = ''.join(rng.choice(sweeps) for _ in range(25000))[:100000]
+        offset_bits, length_bits, lz_int = lambdaman_lz.lz_encode_optimal(path)
+        self.assertEqual(lambdaman_lz.lz_decode(offset_bits, length_bits, lz_int), path)
+        # Each of the 100k positions looks up its k-gram, compares at most CHAIN earlier matches by
+        # binary search over the length, and indexes what it covers: linear in the path, not quadratic.
+        class Counting(str):
+            reads = 0
+            def __getitem__(self, key):
+                Counting.reads += 1
+                return str.__getitem__(self, key)
+        lambdaman_lz.parse(Counting(path), offset_bits, length_bits)
+        self.assertLessEqual(Counting.reads, len(path) * (3 + 2 * LZ77.CHAIN * length_bits))
+
+    def test_relative(self):
+        # Clockwise from U: R is a right turn, then straight twice.
+        self.assertEqual(lambdaman_relative.to_relative('RRRDDDLLLUUU'), 'baabaabaabaa')
+        # A serpentine turns right twice, then left twice.
+        self.assertEqual(lambdaman_relative.to_relative('RRDLLDRR'), 'babbadda')
+        self.assertEqual(lambdaman_relative.to_absolute('baabaabaabaa'), 'RRRDDDLLLUUU')
+        path = 'RRRRDDLLLLDDRRRRDDLLLLUUUUUUUU' * 3
+        for packer in ('rle', 'basex', 'lz'):
+            result = icfp2ascii(lambdaman_relative.compress_solution('lambdaman', 5, path, packer))
+            self.assertEqual(result, f'solve lambdaman5 {path}')
+        path = '1235789' * 10 + '5' * 20
+        self.assertEqual(spaceship_relative.to_absolute(spaceship_relative.to_relative(path)), path)
+        self.assertEqual(icfp2ascii(spaceship_relative.compress_solution('spaceship', 2, path, 'rle')), f'solve spaceship2 {path}')
+        with self.assertRaises(ValueError):
+            spaceship_relative.encode(path, 'huffman')
+
+    def test_benchmark(self):
+        results = benchmark()
+        self.assertIn('lambdaman16', results)
+        for lengths in results.values():
+            self.assertEqual(set(lengths), {'raw'} | set(name for name, _ in BENCHMARK_ENCODERS))
+
     def test_repeat_recursive(self):
         self.assertEqual(RLE.repeat_recursive('A', 5), 'AAAAA')
 
@@ -340,6 +693,25 @@ class TestICFPCompression(unittest.TestCase):
         main := B$ $myfunc I#
         ''')
         self.assertEqual(reduced, 'B$ L! U- v! I#')
+        # Definitions may come in any order, and a definition used twice is expanded once.
+        reduced = reduce_extended_icfp('''
+        main := B. ( B$ $twice $x ) ( S$x )
+        twice := L! B. v! v!
+        x := $y
+        y := S4%
+        ''')
+        self.assertEqual(reduced, 'B. B$ L! B. v! v! S4% S$x')
+        self.assertEqual(icfp2ascii(reduced), 'te' * 2 + decrypt('$x'))
+        with self.assertRaises(ValueError):
+            reduce_extended_icfp('main := $f\r\nf := B$ $g I!\r\ng := L! $f')
+        with self.assertRaises(ValueError):
+            reduce_extended_icfp('main := $undefined')
+
+    def test_expand_program(self):
+        # Large literals are copied once per use, not scanned once per definition.
+        header = f'CHARS := S{encrypt("LRUD")}\nN_CHARS := I{"~" * 10 ** 6}\n'
+        func = reduce_extended_icfp(header + program, 'basex_decode')
+        self.assertEqual(func.count('~' * 10 ** 6), 2)
 
     def test_lrud(self):
         self.assertEqual(encrypt('LRUD'), 'FLO>')
@@ -362,7 +734,14 @@ class TestICFPCompression(unittest.TestCase):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2 and sys.argv[1] == '--benchmark':
+        # python icfp_compression.py --benchmark [<solutions dir>]
+        # data/courses/lambdaman/solutions の回答の圧縮後の長さを並べる
+        names = ['raw'] + [name for name, _ in BENCHMARK_ENCODERS]
+        print('problem', *names)
+        for problem, lengths in benchmark(*sys.argv[2:3]).items():
+            print(problem, *(lengths[name] for name in names))
+    elif len(sys.argv) == 2:
         # python icfp_compression.py <sol>.txt
         # -> <sol>.base4.txt
         # -> <sol>.rle.txt
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+# CEK machine for ICFP.
+#
+# icfp_peria.compile rewrites the whole AST on every beta reduction.  This
+# module walks the program once, keeping variable bindings in environments and
+# pending work on an explicit continuation stack, so one reduction costs O(1)
+# instead of O(program size).
+#
+# It does not change the number of reductions.  Programs that are slow because
+# they take billions of steps (efficiency3 to efficiency11) stay out of reach;
+# see TestEfficiency.
+#
+# The program is executed in the compact form of icfp_compact: a node is an
+# index into its arrays, and an environment is a linked list of
+# (value, parent) tuples indexed by the de Bruijn index of a variable.
+#
+# With lazy=True, arguments are call-by-need: each one is wrapped in a
+# SharedThunk that is overwritten with its value the first time it is used.
+
+from pathlib import Path
+import unittest
+
+from icfp_peria import Boolean, Integer, String, Stats, BudgetExceeded, icfp2int, int2icfp, I_encode
+from icfp_rope import Rope, TEXT, concat, take, drop
+from icfp_compact import (CompactAST, LIT, VAR, LAM, IF, APPLY, LAZY_APPLY, STRICT_APPLY,
+                          UNARY, BINARY, UNARY_OPERATORS, BINARY_OPERATORS, ENCODED)
+import icfp_compact
+
+
+def icfp2ascii(icfp, lazy=False):
+    result = evaluate(icfp, lazy)
+    return result.value if type(result) is String else str(result)
+
+
+def evaluate(icfp, lazy=False, stats=None):
+    # |stats| is an icfp_peria.Stats to fill.
+    if stats is None:
+        return Machine(lazy).run(icfp_compact.parse(icfp))
+    with stats.phase('parse'):
+        ast = icfp_compact.parse(icfp)
+    return Machine(lazy, stats).run(ast)
+
+
+class Closure(object):
+    # |node| is the index of the lambda.
+    __slots__ = ('node', 'env')
+
+    def __init__(self, node, env):
+        self.node = node
+        self.env = env
+
+
+class Thunk(object):
+    # An unevaluated argument (call-by-name): evaluated every time it is used.
+    __slots__ = ('node', 'env')
+
+    def __init__(self, node, env):
+        self.node = node
+        self.env = env
+
+
+class SharedThunk(object):
+    # An argument evaluated at most once (call-by-need).  Once forced, |node|
+    # becomes -1, |env| is dropped and |value| holds the result.
+    __slots__ = ('node', 'env', 'value')
+
+    def __init__(self, node, env):
+        self.node = node
+        self.env = env
+        self.value = None
+
+
+# Continuation frames.  Each frame is a tuple whose first item is the kind.
+UNARY_K = 0     # (UNARY_K, operator)
+LEFT_K = 1      # (LEFT_K, operator, right node, env): evaluate the right operand next
+RIGHT_K = 2     # (RIGHT_K, operator, left value)
+IF_K = 3        # (IF_K, node, env)
+APPLY_K = 4     # (APPLY_K, argument node, env, call-by-need)
+STRICT_K = 5    # (STRICT_K, argument node, env): call-by-value, evaluate the function next
+CALL_K = 6      # (CALL_K, argument value)
+UPDATE_K = 7    # (UPDATE_K, shared thunk): memoize the value of the thunk
+
+# Operators that may be decided by one literal operand.
+ABSORBING = '*&|'
+
+
+class Machine(object):
+    def __init__(self, lazy=False, stats=None):
+        self.lazy = lazy
+        self.stats = stats
+        self.ast = None
+        # Number of shared thunks evaluated, and number of uses answered by a memoized value.
+        self.forced = 0
+        self.shared = 0
+
+    def run(self, ast):
+        # |ast| is a CompactAST or an icfp_peria node.
+        if type(ast) is not CompactAST:
+            ast = CompactAST.from_ast(ast)
+        self.ast = ast
+        stats = self.stats
+        if stats is None:
+            return self.reify(self.execute(0, None))
+        stats.peak_size = max(stats.peak_size, len(ast))
+        with stats.phase('evaluate'):
+            return self.reify(self.execute(0, None))
+
+    def reify(self, value):
+        t = type(value)
+        if t is bool:
+            return Boolean(value)
+        if t is int:
+            return Integer(value)
+        if t is str or t is Rope:
+            return String(str(value))
+        # A function.  Return its definition like the rewriter leaves a lambda as is.
+        return self.ast.node(value.node)
+
+    def literal(self, node):
+        # A literal still encoded is returned as is: it is not an absorbing element anyway.
+        ast = self.ast
+        return ast.literals[ast.arg[node]] if ast.kind[node] == LIT else None
+
+    def absorb(self, op, left, right):
+        # Same algebraic shortcuts as BinaryOperator.optimize: an operand that is
+        # a literal absorbing element decides the result without evaluating the other.
+        x, y = self.literal(left), self.literal(right)
+        if op == '*':
+            if (type(x) is int and x == 0) or (type(y) is int and y == 0):
+                return 0
+        elif op == '&':
+            if x is False or y is False:
+                return False
+        elif op == '|':
+            if x is True or y is True:
+                return True
+        return None
+
+    def bind(self, node, env, need):
+        # Creates the argument for an application without evaluating it.
+        ast = self.ast
+        code = ast.kind[node]
+        if code == LIT and type(ast.literals[ast.arg[node]]) not in ENCODED:
+            # A literal still encoded is bound as a thunk, so that it is decoded only when used.
+            return ast.literals[ast.arg[node]]
+        if code == LAM:
+            return Closure(node, env)
+        if code == VAR:
+            # Share the binding instead of chaining thunks.  A free variable is
+            # an error only when it is used.
+            k = ast.arg[node]
+            if k >= 0:
+                while k:
+                    env = env[1]
+                    k -= 1
+                return env[0]
+        if need:
+            return SharedThunk(node, env)
+        return Thunk(node, env)
+
+    def execute(self, node, env):
+        ast = self.ast
+        kind, right, arg, literals = ast.kind, ast.right, ast.arg, ast.literals
+        lazy = self.lazy
+        stats = self.stats
+        stack = []
+        value = None
+        while True:
+            # Evaluate |node| in |env| until it becomes a value.
+            while node >= 0:
+                code = kind[node]
+                if code == LIT:
+                    value = literals[arg[node]]
+                    if type(value) in ENCODED:
+                        value = ast.value(arg[node])
+                    node = -1
+                elif code == VAR:
+                    k = arg[node]
+                    if k < 0:
+                        raise ValueError(f'Unbound variable: x{right[node]}')
+                    value = env
+                    while k:
+                        value = value[1]
+                        k -= 1
+                    value = value[0]
+                    tv = type(value)
+                    if tv is Thunk:
+                        node, env = value.node, value.env
+                    elif tv is SharedThunk:
+                        if value.node < 0:
+                            self.shared += 1
+                            value = value.value
+                            node = -1
+                        else:
+                            self.forced += 1
+                            stack.append((UPDATE_K, value))
+                            node, env = value.node, value.env
+                    else:
+                        node = -1
+                elif code == LAM:
+                    value = Closure(node, env)
+                    node = -1
+                elif code == APPLY or code == LAZY_APPLY:
+                    stack.append((APPLY_K, right[node], env, lazy or code == LAZY_APPLY))
+                    node += 1
+                elif code >= BINARY:
+                    op = BINARY_OPERATORS[code - BINARY]
+                    if op in ABSORBING:
+                        shortcut = self.absorb(op, node + 1, right[node])
+                        if shortcut is not None:
+                            if stats is not None:
+                                stats.operators['B' + op] += 1
+                            value = shortcut
+                            node = -1
+                            continue
+                    stack.append((LEFT_K, op, right[node], env))
+                    node += 1
+                elif code >= UNARY:
+                    stack.append((UNARY_K, UNARY_OPERATORS[code - UNARY]))
+                    node += 1
+                elif code == IF:
+                    stack.append((IF_K, node, env))
+                    node += 1
+                elif code == STRICT_APPLY:
+                    stack.append((STRICT_K, right[node], env))
+                    node += 1
+                else:
+                    raise ValueError(f'Unknown opcode: {code}')
+
+            # Pass |value| to the innermost continuation.
+            if not stack:
+                return value
+            if stats is not None:
+                self.count(stack, value)
+            frame = stack.pop()
+            k = frame[0]
+            if k == APPLY_K:
+                closure = value
+                if type(closure) is not Closure:
+                    raise ValueError(f'Applying a non-function: {closure}')
+                env = (self.bind(frame[1], frame[2], frame[3]), closure.env)
+                node = closure.node + 1
+            elif k == UPDATE_K:
+                thunk = frame[1]
+                thunk.value = value
+                thunk.node = -1
+                thunk.env = None
+            elif k == LEFT_K:
+                stack.append((RIGHT_K, frame[1], value))
+                node, env = frame[2], frame[3]
+            elif k == RIGHT_K:
+                value = binary(frame[1], frame[2], value)
+            elif k == IF_K:
+                if type(value) is not bool:
+                    raise ValueError(f'Condition is not a boolean: {value}')
+                if_node = frame[1]
+                node = right[if_node] if value else arg[if_node]
+                env = frame[2]
+            elif k == UNARY_K:
+                value = unary(frame[1], value)
+            elif k == STRICT_K:
+                stack.append((CALL_K, value))
+                node, env = frame[1], frame[2]
+            elif k == CALL_K:
+                closure = frame[1]
+                if type(closure) is not Closure:
+                    raise ValueError(f'Applying a non-function: {closure}')
+                env = (value, closure.env)
+                node = closure.node + 1
+
+    def count(self, stack, value):
+        # Records the continuation |value| is passed to in self.stats.
+        stats = self.stats
+        stats.peak_depth = max(stats.peak_depth, len(stack))
+        frame = stack[-1]
+        k = frame[0]
+        if k == APPLY_K or k == CALL_K:
+            stats.reduction()
+        elif k == RIGHT_K:
+            stats.operators['B' + frame[1]] += 1
+        elif k == UNARY_K:
+            stats.operators['U' + frame[1]] += 1
+        elif k == IF_K and type(value) is bool:
+            stats.branches['then' if value else 'else'] += 1
+
+
+def unary(op, x):
+    if op == '-':
+        return -x
+    if op == '!':
+        return not x
+    if op == '#':
+        return icfp2int(str(x))
+    if op == '$':
+        return int2icfp(x)
+    raise ValueError(f'Unknown unary operator: {op}')
+
+
+def binary(op, x, y):
+    if op == '+':
+        return x + y
+    if op == '-':
+        return x - y
+    if op == '*':
+        return x * y
+    if op == '/':
+        q = abs(x) // abs(y)
+        return -q if (x < 0) != (y < 0) else q
+    if op == '%':
+        q = abs(x) // abs(y)
+        if (x < 0) != (y < 0):
+            q = -q
+        return x - q * y
+    if op == '<':
+        return x < y
+    if op == '>':
+        return x > y
+    if op == '=':
+        return (type(x) is type(y) or type(x) in TEXT and type(y) in TEXT) and x == y
+    if op == '|':
+        return x or y
+    if op == '&':
+        return x and y
+    if op == '.':
+        return concat(x, y)
+    if op == 'T':
+        return take(x, y)
+    if op == 'D':
+        return drop(x, y)
+    raise ValueError(f'Unknown binary operator: {op}')
+
+
+class TestMachine(unittest.TestCase):
+    def test_icfp2ascii(self):
+        data = [
+            ("T", "True"), # Boolean
+            ("F", "False"),
+            ("I/6", "1337"), # Integer
+            ("SB%,,/}Q/2,$_", "Hello World!"), # String
+            ("U- I$", "-3"), # Unary operator
+            ("U! T", "False"),
+            ("U# S4%34", "15818151"),
+            ("U$ I4%34", "test"),
+            ("B+ I# I$", "5"), # Binary operator
+            ("B- I$ I#", "1"),
+            ("B* I$ I#", "6"),
+            ("B/ U- I( I#", "-3"),
+            ("B% U- I( I#", "-1"),
+            ("B< I$ I#", "False"),
+            ("B> I$ I#", "True"),
+            ("B= I$ I#", "False"),
+            ("B| T F", "True"),
+            ("B& T F", "False"),
+            ("B. S4% S34", "test"),
+            ("BT I$ S4%34", "tes"),
+            ("BD I$ S4%34", "t"),
+            ("B$ L! B+ v! v! I#", "4"), # (v0 => v0 + v0)(2) == 4
+            ("B$ L# U- v# I%", "-4"),
+            ("B$ L! B+ v! B$ L# U- v# I$ I% ", "1"),
+            ("? T I! I#", "0"),
+            ("? F I! I#", "2"),
+        ]
+        for icfp, expect in data:
+            self.assertEqual(icfp2ascii(icfp), expect)
+            self.assertEqual(icfp2ascii(icfp, lazy=True), expect)
+
+    def test_lambda(self):
+        icfp = 'B$ B$ L# L$ v# B. SB%,,/ S}Q/2,$_ IK'
+        self.assertEqual(icfp2ascii(icfp), "Hello World!")
+
+    def test_icfp_eval(self):
+        icfp = 'B$ L# B$ L" B+ v" v" B* I$ I# v8'
+        self.assertEqual(icfp2ascii(icfp), "12")
+
+    def test_simple_language_test(self):
+        icfp = 'B$ B$ B$ B$ L$ L$ L$ L# v$ I" I# I$ I%'
+        self.assertEqual(icfp2ascii(icfp), "3")
+
+    def test_no_capture(self):
+        # (\x1. (\x2. (\x1. x2)) x1) 5 6 == 5.  The rewriter substitutes names and gets this wrong.
+        icfp = 'B$ B$ L" B$ L# L" v# v" I& I\''
+        self.assertEqual(icfp2ascii(icfp), "5")
+
+    def test_lazy_and_strict_application(self):
+        # The argument diverges but is never used.
+        omega = 'B$ L" B$ v" v" L" B$ v" v"'
+        self.assertEqual(icfp2ascii(f'B$ L# I$ {omega}'), "3")
+        self.assertEqual(icfp2ascii(f'B~ L# I$ {omega}'), "3")
+        self.assertEqual(icfp2ascii('B! L# B+ v# v# I$'), "6")
+
+    def test_call_by_need(self):
+        # (\x. x + x) (1 + 2): the argument is evaluated once and then shared.
+        icfp = 'B$ L# B+ v# v# B+ I" I#'
+        machine = Machine(lazy=True)
+        self.assertEqual(machine.run(icfp_compact.parse(icfp)).value, 6)
+        self.assertEqual((machine.forced, machine.shared), (1, 1))
+
+        # B~ shares its argument even in call-by-name mode.
+        machine = Machine()
+        icfp = 'B~ L# B+ v# v# B+ I" I#'
+        self.assertEqual(machine.run(icfp_compact.parse(icfp)).value, 6)
+        self.assertEqual((machine.forced, machine.shared), (1, 1))
+
+    def test_lazy_literals(self):
+        # A long literal in a dead branch, or passed but not used, is never decoded.
+        digits = '~' * 100
+        ast = icfp_compact.parse(f'? T I" B+ I{digits} B$ L" I# I{digits}')
+        self.assertEqual(Machine().run(ast).value, 1)
+        self.assertIsNotNone(ast.literals[2].encoded)
+        ast = icfp_compact.parse(f'B$ L" I# I{digits}')
+        self.assertEqual(Machine(lazy=True).run(ast).value, 2)
+        self.assertIsNotNone(ast.literals[1].encoded)
+        self.assertEqual(evaluate(f'B- I{digits} I"').value, 94 ** 100 - 2)
+
+    def test_deep_recursion(self):
+        # sum(1..100000) through the Y combinator does not hit the recursion limit.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% ? B= v% I! I! B+ v% B! v$ B- v% I"'
+        icfp = f'B$ B$ {y} {body} I{I_encode(100000)}'
+        self.assertEqual(icfp2ascii(icfp), str(100000 * 100001 // 2))
+
+    def test_long_string(self):
+        # A path of 20000 moves built one move at a time (R for even k, L for odd k), then
+        # cut with T and D.  Concatenation does not copy the path built so far.
+        n = 20000
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        body = 'L$ L% ? B= v% I! S B. B! v$ B- v% I" ? B= B% v% I# I! SL SF'
+        path = f'B$ B$ {y} {body} I{I_encode(n)}'
+        expected = ''.join('R' if k % 2 == 0 else 'L' for k in range(1, n + 1))
+        self.assertEqual(icfp2ascii(path), expected)
+        icfp = f'B. BT I& {path} BD I{I_encode(n - 5)} {path}'
+        self.assertEqual(icfp2ascii(icfp), expected[:5] + expected[-5:])
+        self.assertEqual(icfp2ascii(f'B= {path} B. {path} S'), 'True')
+
+    def test_stats(self):
+        # sum(4..1) through the Y combinator.  Call-by-name evaluates "n - 1" once per use.
+        y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+        icfp = f'B$ B$ {y} L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I" I%'
+        for lazy, subtractions in ((False, 16), (True, 4)):
+            stats = Stats()
+            self.assertEqual(evaluate(icfp, lazy, stats).value, 10)
+            self.assertEqual(stats.beta, 16)
+            self.assertEqual(stats.operators, {'B=': 5, 'B-': subtractions, 'B+': 4})
+            self.assertEqual(stats.branches, {'then': 1, 'else': 4})
+            self.assertEqual(stats.peak_size, len(icfp.split()))
+        with self.assertRaises(BudgetExceeded):
+            evaluate(icfp, stats=Stats(budget=15))
+
+
+class TestEnd2End(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    TEST_DATA_DIR = SCRIPT_DIR / 'test_data'
+
+    def test_language(self):
+        with open(self.TEST_DATA_DIR / 'language_test.icfp') as f:
+            icfp = f.read().strip()
+        result = evaluate(icfp)
+        self.assertTrue(type(result) is String)
+        self.assertEqual(result.value, "Self-check OK, send `solve language_test 4w3s0m3` to claim points for it")
+
+    def test_lambdaman6(self):
+        with open(self.TEST_DATA_DIR / 'lambdaman6_test.icfp') as f:
+            icfp = f.read().strip()
+        result = evaluate(icfp)
+        self.assertEqual(type(result), String)
+        self.assertEqual(result.value, 'L' + '.' * 199)
+
+
+class TestEfficiency(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    ROOT_DIR = SCRIPT_DIR.parent
+    PROBLEMS_DIR = ROOT_DIR / 'data' / 'courses' / 'efficiency' / 'problems'
+
+    def run_test(self, id, lazy=False):
+        filename = f'efficiency{id}.icfp'
+        with open(self.PROBLEMS_DIR / filename) as f:
+            icfp = f.read().strip()
+        result = evaluate(icfp, lazy)
+        self.assertEqual(type(result), Integer)
+        return result.value
+
+    # Call-by-name evaluates the argument 4^22 times.  Call-by-need does it 22 times.
+    def test_efficiency1(self):
+        value = self.run_test('1', lazy=True)
+        self.assertEqual(value, 4**22)
+
+    # "* 0" operation results in 0.
+    def test_efficiency2(self):
+        value = self.run_test('2')
+        self.assertEqual(value, 2134)
+
+    # The rest take too many reductions for any evaluator; see icfp_peria.TestEfficiency.
+    # efficiency3: 9,345,875,634 calls of 1 + f(n - 1).  icfp_peria's accelerator uses the closed form.
+    # efficiency4: naive Fibonacci, about 3.3 * 10^8 calls.  icfp_peria's hash-consing memoizes it.
+    # efficiency5: tries every x up to 2^31 - 1 with a primality test by trial division.
+    # efficiency6: trial division of the prime 433,494,437.
+    # efficiency7 to 11: brute force over 2^40, 2^50 and 9^80 assignments.  They need a SAT solver.
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,296 @@
 #!/usr/bin/env python3
 
-from collections import deque
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, nullcontext, redirect_stderr
 from pathlib import Path
+import array
 import copy
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import marshal
+import mmap
+import os
+import pickle
 import re
 import sys
+import tempfile
 import time
+import tracemalloc
 import unittest
-
-def icfp2ascii(icfp, verbose=False):
-    ast = compile(icfp, verbose)
+import unittest.mock
+import weakref
+
+# Base-94 integers are converted by icfp_codec.
+from icfp_codec import (mapping, asc2int, int2asc, icfp2int, int2icfp, I_decode, I_encode, decrypt, encrypt,
+                        SMALL_DIGITS)
+from icfp_rope import Rope, concat, take, drop
+
+try:
+    import numpy as np
+except ImportError:
+    # batch_apply() is not available.
+    np = None
+
+def icfp2ascii(icfp, verbose=False, trace=None):
+    ast = compile(icfp, verbose, trace=trace)
     return ast.value if type(ast) is String else str(ast)
 
 
-class Boolean(object):
+# The active HashCons table, or None.
+hashcons = None
+
+
+class HashCons(object):
+    '''
+    Opt-in hash-consing for the rewriter.  While a table is active (with HashCons() as table: ...),
+    structurally equal nodes are shared, and the results of optimize/evaluate/apply are memoized
+    per node.  As LambdaEvaluator nodes are shared, LambdaEvaluator.evaluate is memoized per
+    (lambda, argument) pair, i.e. it is a beta reduction cache.
+    The memo is an LRU table of at most |capacity| entries.  The node table keeps only live nodes.
+    '''
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.nodes = weakref.WeakValueDictionary()
+        self.memo = OrderedDict()
+        # Keys are 'node' for shared nodes, and method names like 'LambdaEvaluator.evaluate'.
+        self.hits = Counter()
+        self.misses = Counter()
+        # Ids of the nodes whose method is running through call(), so that the check at the start
+        # of the method lets it run.
+        self.pending = set()
+        self.previous = None
+
+    def __enter__(self):
+        global hashcons
+        self.previous = hashcons
+        hashcons = self
+        update_active_table()
+        return self
+
+    def __exit__(self, *_):
+        global hashcons
+        hashcons = self.previous
+        update_active_table()
+
+    def intern(self, cls, args):
+        # Operands are shared nodes, so they are keyed by identity.  Live nodes keep their
+        # operands alive, so the ids in the keys of live entries are never reused.
+        key = (cls,) + tuple(a if type(a) in (bool, int, str) else id(a) for a in args)
+        node = self.nodes.get(key)
+        if node is not None:
+            self.hits['node'] += 1
+            return node
+        self.misses['node'] += 1
+        node = object.__new__(cls)
+        self.nodes[key] = node
+        return node
+
+    def call(self, method, node, args):
+        name = method.__qualname__
+        if args and method.__name__ == 'apply':
+            key = (name, id(node), args[0], id(args[1]))
+        else:
+            # evaluate() does not use its argument.
+            key = (name, id(node))
+        entry = self.memo.get(key)
+        if entry is not None:
+            self.memo.move_to_end(key)
+            self.hits[name] += 1
+            return entry[0]
+        self.misses[name] += 1
+        self.pending.add(id(node))
+        try:
+            result = method(node, *args)
+        finally:
+            self.pending.discard(id(node))
+        # Keep the node and the arguments alive so that their ids stay valid.
+        self.memo[key] = (result, node, args)
+        if len(self.memo) > self.capacity:
+            self.memo.popitem(last=False)
+        return result
+
+
+# The active Incremental table, or None.
+incremental = None
+
+
+class Incremental(object):
+    '''
+    Opt-in incremental rewriting.  Nodes are never modified and evaluate() does not use its
+    argument, so a node for which evaluate() or optimize() returned the node itself is a fixed
+    point of that method forever.  While a table is active (with Incremental(): ...), such nodes
+    are recorded and skipped, so each rewriting step only re-examines the subtrees built since
+    the previous step and the path from the root to them, instead of the whole tree.
+    '''
+    def __init__(self):
+        self.fixed = {'evaluate': weakref.WeakSet(), 'optimize': weakref.WeakSet()}
+        # Number of calls skipped, and of calls run, by method name.
+        self.skipped = Counter()
+        self.runs = Counter()
+        # As HashCons.pending.
+        self.pending = set()
+        self.previous = None
+
+    def __enter__(self):
+        global incremental
+        self.previous = incremental
+        incremental = self
+        update_active_table()
+        return self
+
+    def __exit__(self, *_):
+        global incremental
+        incremental = self.previous
+        update_active_table()
+
+    def call(self, method, node, args):
+        # apply() uses its arguments, so only evaluate() and optimize() have fixed points.
+        name = method.__name__
+        fixed = self.fixed.get(name)
+        if fixed is not None and node in fixed:
+            self.skipped[name] += 1
+            return node
+        self.runs[name] += 1
+        self.pending.add(id(node))
+        try:
+            result = method(node, *args)
+        finally:
+            self.pending.discard(id(node))
+        if fixed is not None and result is node:
+            fixed.add(node)
+        return result
+
+
+# The table that the methods of the nodes route their calls to: the active HashCons, else the
+# active Incremental, or None.  Each of optimize, evaluate and apply starts with the check, so
+# that the default path pays only for it.
+active_table = None
+
+
+def update_active_table():
+    global active_table
+    active_table = hashcons if hashcons is not None else incremental
+
+
+# The active Stats, or None.
+stats = None
+
+# Rewriting steps between two measures of the tree by Stats.
+MEASURE_INTERVAL = 64
+
+# Beta reductions allowed by the contest server.
+SERVER_BETA_LIMIT = 10000000
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Stats(object):
+    '''
+    Instrumentation of an evaluation.  The rewriter counts while the object is active
+    (with Stats() as stats: compile(...)), and icfp_machine / icfp_closure take it as an argument.
+      beta         beta reductions
+      operators    operator applications by opcode ('B+', 'U-', ...)
+      branches     If branches taken ('then' / 'else')
+      steps        rewriting steps of the rewriter
+      peak_size    peak AST size (rewriter) or program size (machine)
+      peak_depth   peak AST depth (rewriter) or continuation stack depth (machine)
+      times        wall time in seconds per phase ('parse', 'evaluate', ...)
+    BudgetExceeded is raised as soon as |beta| exceeds |budget|.  Loops run natively by the
+    accelerator are not counted.  Measuring the tree takes a walk over all of it, so the rewriter
+    measures it every |measure_interval| steps and at the end only: its peaks are sampled.
+    '''
+    def __init__(self, budget=None, measure_interval=MEASURE_INTERVAL):
+        if measure_interval < 1:
+            raise ValueError(f'measure_interval must be positive: {measure_interval}')
+        self.budget = budget
+        self.measure_interval = measure_interval
+        self.beta = 0
+        self.operators = Counter()
+        self.branches = Counter()
+        self.steps = 0
+        self.peak_size = 0
+        self.peak_depth = 0
+        self.times = {}
+        self.previous = None
+
+    def __enter__(self):
+        global stats
+        self.previous = stats
+        stats = self
+        return self
+
+    def __exit__(self, *_):
+        global stats
+        stats = self.previous
+
+    def reduction(self):
+        self.beta += 1
+        if self.budget is not None and self.beta > self.budget:
+            raise BudgetExceeded(f'Beta reductions exceeded the budget of {self.budget}')
+
+    def measure(self, ast):
+        size, depth = measure(ast)
+        self.peak_size = max(self.peak_size, size)
+        self.peak_depth = max(self.peak_depth, depth)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'beta': self.beta,
+            'operators': dict(self.operators),
+            'branches': dict(self.branches),
+            'steps': self.steps,
+            'peak_size': self.peak_size,
+            'peak_depth': self.peak_depth,
+            'times': self.times,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+
+def measure(ast):
+    # Returns (number of nodes, depth) of |ast|.  Shared nodes are counted once.
+    height = {}
+    stack = [(ast, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in height:
+            continue
+        operands = children(node)
+        if operands and not expanded:
+            stack.append((node, True))
+            stack.extend((operand, False) for operand in operands if id(operand) not in height)
+            continue
+        height[id(node)] = 1 + max((height[id(operand)] for operand in operands), default=0)
+    return len(height), height[id(ast)]
+
+
+class Node(object):
+    __slots__ = ('__weakref__',)
+
+    def __new__(cls, *args):
+        # copy.copy() creates an object without arguments.
+        if hashcons is None or not args:
+            return object.__new__(cls)
+        return hashcons.intern(cls, args)
+
+
+class Boolean(Node):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -33,9 +310,37 @@ class Boolean(object):
         return self
 
 
-class Integer(object):
+class Literal(Node):
+    # Base of Integer and String.  A literal from lazy_literal() holds the body of its token
+    # in |encoded| and decodes its value on first use.
+    __slots__ = ('value', 'encoded')
+
     def __init__(self, value):
         self.value = value
+        self.encoded = None
+
+    def __getattr__(self, name):
+        if name != 'value':
+            raise AttributeError(name)
+        value = self.value = self.decode(self.encoded)
+        self.encoded = None
+        return value
+
+    def __copy__(self):
+        if self.encoded is None:
+            return type(self)(self.value)
+        return lazy_literal(type(self), self.encoded)
+
+    def __reduce__(self):
+        # Snapshots (Checkpoint) keep the literal encoded.
+        if self.encoded is None:
+            return type(self), (self.value,)
+        return lazy_literal, (type(self), self.encoded)
+
+
+class Integer(Literal):
+    __slots__ = ()
+    decode = staticmethod(asc2int)
 
     def __str__(self):
         return str(self.value)
@@ -53,9 +358,12 @@ class Integer(object):
         return self
 
 
-class String(object):
-    def __init__(self, value):
-        self.value = value
+class String(Literal):
+    __slots__ = ()
+
+    @staticmethod
+    def decode(encoded):
+        return decrypt(encoded).decode()
 
     def __str__(self):
         return f'"{self.value}"'
@@ -72,19 +380,24 @@ class String(object):
     def apply(self, _k, _v):
         return self
 
-class UnaryOperator(object):
+class UnaryOperator(Node):
+    __slots__ = ('operator', 'value')
+
     def __init__(self, operator, value):
         self.operator = operator
         self.value = value
 
     def __str__(self):
+        return to_str(self)
+
+    def parts(self):
         op = self.operator
         if op in ('-', '!'):
-            return f"{self.operator}{self.value}"
+            return (self.operator, self.value)
         if op == '#':
-            return f"STR2INT({self.value})"
+            return ('STR2INT(', self.value, ')')
         if op == '$':
-            return f"INT2STR({self.value})"
+            return ('INT2STR(', self.value, ')')
 
     def dump(self, level):
         op = self.operator
@@ -96,40 +409,56 @@ class UnaryOperator(object):
         self.value.dump(level + 1)
 
     def optimize(self):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(UnaryOperator.optimize, self, ())
         op = self.operator
         val = self.value.optimize()
+        result = None
         if op == '-' and type(val) is Integer:
-            return Integer(-val.value)
-        if op == '!' and type(val) is Boolean:
-            return Boolean(not val.value)
-        if op == '#' and type(val) is String:
-            return Integer(icfp2int(val.value))
-        if op == '$' and type(val) is Integer:
-            return String(int2icfp(val.value))
+            result = Integer(-val.value)
+        elif op == '!' and type(val) is Boolean:
+            result = Boolean(not val.value)
+        elif op == '#' and type(val) is String:
+            result = Integer(icfp2int(str(val.value)))
+        elif op == '$' and type(val) is Integer:
+            result = String(int2icfp(val.value))
+        if result is not None:
+            if stats is not None:
+                stats.operators['U' + op] += 1
+            return result
         # There can be lambdas under this node.
         return self
 
     def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(UnaryOperator.evaluate, self, (values,))
         value = self.value.evaluate(values).optimize()
         if value != self.value:
             return UnaryOperator(self.operator, value)
         return self
 
     def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(UnaryOperator.apply, self, (k, v))
         value = self.value.apply(k, v).optimize()
         if value != self.value:
             return UnaryOperator(self.operator, value)
         return self
 
 
-class BinaryOperator(object):
+class BinaryOperator(Node):
+    __slots__ = ('operator', 'left', 'right')
+
     def __init__(self, operator, left, right):
         self.operator = operator
         self.left = left
         self.right = right
 
     def __str__(self):
-        return f"({self.left} {self.operator} {self.right})"
+        return to_str(self)
+
+    def parts(self):
+        return ('(', self.left, f' {self.operator} ', self.right, ')')
 
     def dump(self, level):
         op = self.operator
@@ -138,88 +467,22 @@ class BinaryOperator(object):
         self.right.dump(level + 1)
 
     def optimize(self):
-        op = self.operator
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(BinaryOperator.optimize, self, ())
         x = self.left.optimize()
         y = self.right.optimize()
-        tx, ty = type(x), type(y)
-        if op == '+':
-            if tx is Integer and x.value == 0:
-                return y
-            if ty is Integer and y.value == 0:
-                return x
-            if tx is Integer and ty is Integer:
-                return Integer(x.value + y.value)
-        if op == '-':
-            if ty is Integer and y.value == 0:
-                return x
-            if tx is Integer and ty is Integer:
-                return Integer(x.value - y.value)
-        if op == '*':
-            if tx is Integer:
-                if x.value == 0:
-                    return Integer(0)
-                if x.value == 1:
-                    return y
-            if ty is Integer:
-                if y.value == 0:
-                    return Integer(0)
-                if y.value == 1:
-                    return x
-            if tx is Integer and ty is Integer:
-                return Integer(x.value * y.value)
-        if op == '/':
-            if tx is Integer and x.value == 0:
-                return Integer(0)
-            if ty is Integer and y.value == 1:
-                return x
-            if tx is Integer and ty is Integer:
-                q = abs(x.value) // abs(y.value)
-                if x.value * y.value < 0:
-                    q = -q
-                return Integer(q)
-        if op == '%':
-            if tx is Integer and x.value == 0:
-                return Integer(0)
-            if tx is Integer and ty is Integer:
-                x, y = x.value, y.value
-                q = abs(x) // abs(y)
-                if x * y < 0:
-                    q = -q
-                r = x - q * y
-                return Integer(r)
-        if op == '<' and tx is Integer and ty is Integer:
-            return Boolean(x.value < y.value)
-        if op == '>' and tx is Integer and ty is Integer:
-            return Boolean(x.value > y.value)
-        if op == '=':
-            if tx == ty and tx in (Integer, Boolean, String):
-                return Boolean(x.value == y.value)
-        if op == '|':
-            if tx is Boolean and x.value:
-                return Boolean(True)
-            if ty is Boolean and y.value:
-                return Boolean(True)
-            if tx is Boolean and ty is Boolean:
-                return Boolean(x.value or y.value)
-        if op == '&':
-            if tx is Boolean and not x.value:
-                return Boolean(False)
-            if ty is Boolean and not y.value:
-                return Boolean(False)
-            if tx is Boolean and ty is Boolean:
-                return Boolean(x.value and y.value)
-        if op == '.' and tx is String and ty is String:
-            return String(x.value + y.value)
-        if op == 'T' and tx is Integer and ty is String:
-            return String(y.value[:x.value])
-        if op == 'D' and tx is Integer and ty is String:
-            return String(y.value[x.value:])
-
+        result = fold(self.operator, x, y)
+        if result is not None:
+            if stats is not None:
+                stats.operators['B' + self.operator] += 1
+            return result
         if x != self.left or y != self.right:
             return BinaryOperator(self.operator, x, y)
         return self
 
     def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(BinaryOperator.evaluate, self, (values,))
         left = self.left.evaluate(values).optimize()
         right = self.right.evaluate(values).optimize()
         if left != self.left or right != self.right:
@@ -227,6 +490,8 @@ class BinaryOperator(object):
         return self
 
     def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(BinaryOperator.apply, self, (k, v))
         left = self.left.apply(k, v).optimize()
         right = self.right.apply(k, v).optimize()
         if left != self.left or right != self.right:
@@ -234,14 +499,97 @@ class BinaryOperator(object):
         return self
 
 
-class If(object):
+def fold(op, x, y):
+    # Returns the value of |x| <op> |y|, or None if it cannot be decided yet.
+    tx, ty = type(x), type(y)
+    if op == '+':
+        if tx is Integer and x.value == 0:
+            return y
+        if ty is Integer and y.value == 0:
+            return x
+        if tx is Integer and ty is Integer:
+            return Integer(x.value + y.value)
+    if op == '-':
+        if ty is Integer and y.value == 0:
+            return x
+        if tx is Integer and ty is Integer:
+            return Integer(x.value - y.value)
+    if op == '*':
+        if tx is Integer:
+            if x.value == 0:
+                return Integer(0)
+            if x.value == 1:
+                return y
+        if ty is Integer:
+            if y.value == 0:
+                return Integer(0)
+            if y.value == 1:
+                return x
+        if tx is Integer and ty is Integer:
+            return Integer(x.value * y.value)
+    if op == '/':
+        if tx is Integer and x.value == 0:
+            return Integer(0)
+        if ty is Integer and y.value == 1:
+            return x
+        if tx is Integer and ty is Integer:
+            q = abs(x.value) // abs(y.value)
+            if x.value * y.value < 0:
+                q = -q
+            return Integer(q)
+    if op == '%':
+        if tx is Integer and x.value == 0:
+            return Integer(0)
+        if tx is Integer and ty is Integer:
+            x, y = x.value, y.value
+            q = abs(x) // abs(y)
+            if x * y < 0:
+                q = -q
+            r = x - q * y
+            return Integer(r)
+    if op == '<' and tx is Integer and ty is Integer:
+        return Boolean(x.value < y.value)
+    if op == '>' and tx is Integer and ty is Integer:
+        return Boolean(x.value > y.value)
+    if op == '=':
+        if tx == ty and tx in (Integer, Boolean, String):
+            return Boolean(x.value == y.value)
+    if op == '|':
+        if tx is Boolean and x.value:
+            return Boolean(True)
+        if ty is Boolean and y.value:
+            return Boolean(True)
+        if tx is Boolean and ty is Boolean:
+            return Boolean(x.value or y.value)
+    if op == '&':
+        if tx is Boolean and not x.value:
+            return Boolean(False)
+        if ty is Boolean and not y.value:
+            return Boolean(False)
+        if tx is Boolean and ty is Boolean:
+            return Boolean(x.value and y.value)
+    if op == '.' and tx is String and ty is String:
+        return String(concat(x.value, y.value))
+    if op == 'T' and tx is Integer and ty is String:
+        return String(take(x.value, y.value))
+    if op == 'D' and tx is Integer and ty is String:
+        return String(drop(x.value, y.value))
+    return None
+
+
+class If(Node):
+    __slots__ = ('condition', 'true_branch', 'false_branch')
+
     def __init__(self, condition, true_branch, false_branch):
         self.condition = condition
         self.true_branch = true_branch
         self.false_branch = false_branch
 
     def __str__(self):
-        return f"\nIF {self.condition}:\nTHEN: {self.true_branch}\nELSE: {self.false_branch}"
+        return to_str(self)
+
+    def parts(self):
+        return ('\nIF ', self.condition, ':\nTHEN: ', self.true_branch, '\nELSE: ', self.false_branch)
 
     def dump(self, level):
         dump(level, "IF")
@@ -252,8 +600,12 @@ class If(object):
         self.false_branch.dump(level + 1)
 
     def optimize(self):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(If.optimize, self, ())
         c = self.condition.optimize()
         if type(c) is Boolean:
+            if stats is not None:
+                stats.branches['then' if c.value else 'else'] += 1
             # Do not optimize branches until the condition is evaluated.
             if c.value:
                 return self.true_branch.optimize()
@@ -262,8 +614,12 @@ class If(object):
         return self
 
     def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(If.evaluate, self, (values,))
         condition = self.condition.evaluate(values).optimize()
         if type(condition) is Boolean:
+            if stats is not None:
+                stats.branches['then' if condition.value else 'else'] += 1
             if condition.value:
                 return self.true_branch.evaluate(values)
             else:
@@ -274,8 +630,12 @@ class If(object):
         return self
 
     def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(If.apply, self, (k, v))
         condition = self.condition.apply(k, v).optimize()
         if type(condition) is Boolean:
+            if stats is not None:
+                stats.branches['then' if condition.value else 'else'] += 1
             if condition.value:
                 return self.true_branch.apply(k, v).optimize()
             else:
@@ -289,11 +649,13 @@ class If(object):
 
 
 class LambdaEvaluator(BinaryOperator):
+    __slots__ = ()
+
     def __init__(self, left, right):
         super().__init__('$', left, right)
 
-    def __str__(self):
-        return f"(lambda {self.left} : {self.right})"
+    def parts(self):
+        return ('(lambda ', self.left, ' : ', self.right, ')')
 
     def dump(self, level):
         dump(level, "EVAL")
@@ -302,15 +664,21 @@ class LambdaEvaluator(BinaryOperator):
         self.right.dump(level + 1)
 
     def optimize(self):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LambdaEvaluator.optimize, self, ())
         x = self.left.optimize()
         y = self.right.optimize()
         if x != self.left or y != self.right:
-            return LambdaEvaluator(x, y)
+            return type(self)(x, y)
         return self
 
     def evaluate(self, _):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LambdaEvaluator.evaluate, self, (_,))
         left = self.left
         if type(left) is Lambda:
+            if stats is not None:
+                stats.reduction()
             key = left.parameter
             value = self.right
             # dump(0, f"Match x{key} = {value}")
@@ -318,42 +686,71 @@ class LambdaEvaluator(BinaryOperator):
 
         left = left.evaluate(self.right).optimize()
         if left != self.left:
-            return LambdaEvaluator(left, self.right)
+            return type(self)(left, self.right)
         return self
 
     def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LambdaEvaluator.apply, self, (k, v))
         left = self.left.apply(k, v).optimize()
         right = self.right.apply(k, v).optimize()
         if left != self.left or right != self.right:
-            return LambdaEvaluator(left, right)
+            return type(self)(left, right)
         return self
 
 
-class Lambda(object):
+class StrictEvaluator(LambdaEvaluator):
+    # Made by accelerate_loops().  When the lambda surely uses its parameter, the argument is
+    # evaluated before the beta reduction, so that it is not copied unevaluated into every use.
+    __slots__ = ()
+
+    def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(StrictEvaluator.evaluate, self, (values,))
+        left, right = self.left, self.right
+        if type(left) is Lambda and not is_value(right) and is_strict(left.definition, left.parameter):
+            right = right.evaluate(None).optimize()
+            if right != self.right:
+                return StrictEvaluator(left, right)
+        return super().evaluate(values)
+
+
+class Lambda(Node):
+    __slots__ = ('parameter', 'definition')
+
     def __init__(self, parameter, definition):
         self.parameter = parameter
         self.definition = definition
 
     def __str__(self):
-        return f"Lambda (x{self.parameter}) {self.definition}"
+        return to_str(self)
+
+    def parts(self):
+        return (f'Lambda (x{self.parameter}) ', self.definition)
 
     def dump(self, level):
         dump(level, "Lambda x{}".format(self.parameter))
         self.definition.dump(level + 1)
 
     def optimize(self):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(Lambda.optimize, self, ())
         definition = self.definition.optimize()
         if definition != self.definition:
             return Lambda(self.parameter, definition)
         return self
 
     def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(Lambda.evaluate, self, (values,))
         definition = self.definition.evaluate(values).optimize()
         if definition != self.definition:
             return Lambda(self.parameter, definition)
         return self
 
     def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(Lambda.apply, self, (k, v))
         if self.parameter == k:
             return self
         definition = self.definition.apply(k, v).optimize()
@@ -362,7 +759,9 @@ class Lambda(object):
         return self
 
 
-class Variable(object):
+class Variable(Node):
+    __slots__ = ('parameter',)
+
     def __init__(self, parameter):
         self.parameter = parameter
 
@@ -380,133 +779,1188 @@ class Variable(object):
 
     def apply(self, k, v):
         if self.parameter == k:
-            return copy.copy(v)
+            # Shared nodes are never modified, so they need not be copied.
+            return v if hashcons is not None else copy.copy(v)
         return self
 
 
+def to_str(node):
+    # Same as the recursive f-strings, but with an explicit stack for deep trees.
+    result = []
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if type(item) is str:
+            result.append(item)
+        elif hasattr(item, 'parts'):
+            stack.extend(reversed(item.parts()))
+        else:
+            result.append(str(item))
+    return ''.join(result)
+
+
 def dump(level, message):
     print("| " * level + message, file=sys.stderr)
 
 
-def compile(icfp, verbose=False, sleep_time=0):
+def tokenize(icfp):
     icfp = re.sub(r'\s+', ' ', icfp).strip()
-    tokens = deque(icfp.split(' '))
-    ast = parse(tokens)
+    return deque(icfp.split(' '))
+
+
+def evaluate(icfp, lazy=True):
+    # Evaluates with the CEK machine, which neither rewrites the AST nor recurses in Python.
+    import icfp_machine
+    return icfp_machine.evaluate(icfp, lazy)
+
+
+class NotVectorizable(Exception):
+    pass
+
+
+# int64 results are used only while every operand is smaller than this.  Otherwise Python ints are used.
+INT64_SAFE = 2**62
+
+
+def batch_apply(fn, values):
+    '''
+    Applies a one-parameter lambda (an AST or ICFP source) to every element of |values| at once.
+    Arithmetic, comparison, boolean and If are evaluated element-wise with NumPy, in int64 while
+    it cannot overflow and in object arrays of Python ints otherwise.  Bodies using anything else
+    (strings, applications, ...) are evaluated per element with the CEK machine; an error of any
+    element (e.g. a division by zero) is then raised for the whole batch, and so is ValueError for
+    an element that does not evaluate to a literal (e.g. to a lambda).
+    '''
+    if np is None:
+        raise ImportError('batch_apply() requires numpy')
+    if type(fn) is str:
+        fn = parse(tokenize(fn))
+    if type(fn) is not Lambda:
+        raise ValueError(f'Not a lambda: {fn}')
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu' and widen(values)[0].dtype != object:
+        values = values.astype(np.int64)
+    elif values.dtype.kind != 'b':
+        values = values.astype(object)
+    try:
+        result = vectorize(fn.definition, fn.parameter, values)
+    except (NotVectorizable, ZeroDivisionError):
+        import icfp_machine
+        machine = icfp_machine.Machine(lazy=True)
+        result = []
+        for x in values.flat:
+            argument = Boolean(bool(x)) if values.dtype.kind == 'b' else Integer(int(x))
+            value = machine.run(LambdaEvaluator(fn, argument))
+            if type(value) not in (Boolean, Integer, String):
+                raise ValueError(f'Not a literal for {argument}: {value}')
+            result.append(value.value)
+        return np.array(result, dtype=object).reshape(values.shape)
+    if np.ndim(result) == 0:
+        return np.full(values.shape, result, dtype=object if type(result) is int and abs(result) >= INT64_SAFE else None)
+    return result
+
+
+def vectorize(node, parameter, x):
+    t = type(node)
+    if t is Integer or t is Boolean:
+        return node.value
+    if t is Variable and node.parameter == parameter:
+        return x
+    if t is UnaryOperator:
+        value = vectorize(node.value, parameter, x)
+        if node.operator == '-':
+            return -widen(value)[0]
+        if node.operator == '!':
+            return np.logical_not(value)
+    elif t is If:
+        condition = vectorize(node.condition, parameter, x)
+        if np.ndim(condition) == 0:
+            return vectorize(node.true_branch if condition else node.false_branch, parameter, x)
+        true_branch, false_branch = widen(vectorize(node.true_branch, parameter, x),
+                                          vectorize(node.false_branch, parameter, x))
+        return np.where(condition, true_branch, false_branch)
+    elif t is BinaryOperator:
+        return vectorize_binary(node.operator, vectorize(node.left, parameter, x), vectorize(node.right, parameter, x))
+    raise NotVectorizable(str(node))
+
+
+def is_boolean(value):
+    return type(value) is bool or (isinstance(value, np.ndarray) and value.dtype == bool)
+
+
+def widen(*values, limit=INT64_SAFE):
+    # Converts int64 operands to object arrays unless every operand is smaller than |limit|.
+    # NumPy scalars become Python ints (or bools), which do not wrap around.
+    values = tuple(v.item() if isinstance(v, np.generic) else v for v in values)
+
+    def small(v):
+        if isinstance(v, np.ndarray):
+            if v.dtype == object:
+                return False
+            return v.size == 0 or is_boolean(v) or float(np.max(np.abs(v.astype(float)))) < limit
+        return is_boolean(v) or abs(v) < limit
+    if all(small(v) for v in values):
+        return values
+    return tuple(v.astype(object) if isinstance(v, np.ndarray) else v for v in values)
+
+
+def vectorize_binary(op, x, y):
+    if op in '+-*/%<>':
+        if is_boolean(x) or is_boolean(y):
+            raise NotVectorizable(op)
+        x, y = widen(x, y)
+        if op == '+':
+            return x + y
+        if op == '-':
+            return x - y
+        if op == '*':
+            x, y = widen(x, y, limit=2**31)
+            return x * y
+        if op == '<':
+            return x < y
+        if op == '>':
+            return x > y
+        if np.any(np.asarray(y) == 0):
+            raise NotVectorizable('division by zero')
+        q = abs(x) // abs(y)
+        if np.ndim(x) == 0 and np.ndim(y) == 0:
+            q = -q if (x < 0) != (y < 0) else q
+            return q if op == '/' else x - q * y
+        q = np.where((np.asarray(x) < 0) != (np.asarray(y) < 0), -q, q)
+        if op == '/':
+            return q
+        return x - q * y
+    if op == '=':
+        if is_boolean(x) != is_boolean(y):
+            return False
+        return np.equal(*widen(x, y))
+    if op in '|&':
+        if not (is_boolean(x) and is_boolean(y)):
+            raise NotVectorizable(op)
+        return np.logical_or(x, y) if op == '|' else np.logical_and(x, y)
+    raise NotVectorizable(op)
+
+
+# Recursion-pattern accelerator.
+#
+# accelerate_loops() finds "fixpoint-over-counter" shapes, i.e. a fixpoint combinator (Y, Z or
+# the self-application form) applied to a generator
+#
+#   \self. \a1 ... \am. ? condition base step
+#
+# where |step| calls self with every parameter unchanged except one counter, which is moved by
+# a constant (counter - d or counter + d), optionally combined with a term: term + self(...),
+# self(...) * term, term . self(...), and so on.  Such a recursion is replaced by a LoopCall
+# node, which computes the result in a Python loop once the arguments are values, and in closed
+# form when the term is a constant (+ and * of integers, . of strings).  Other applications
+# become StrictEvaluator nodes, which evaluate the argument first when the lambda is strict.
+
+# Deeper bodies are not analyzed by is_strict().
+STRICTNESS_DEPTH = 100
+
+
+def is_value(node):
+    return type(node) in (Boolean, Integer, String, Lambda, Variable)
+
+
+def is_variable(node, parameter):
+    return type(node) is Variable and node.parameter == parameter
+
+
+def is_application(node):
+    return isinstance(node, LambdaEvaluator) or (type(node) is BinaryOperator and node.operator in ('~', '!'))
+
+
+def is_strict(node, parameter, depth=0):
+    # True if evaluating |node| surely evaluates the variable |parameter|.
+    if depth > STRICTNESS_DEPTH:
+        return False
+    depth += 1
+    t = type(node)
+    if t is Variable:
+        return node.parameter == parameter
+    if t is UnaryOperator:
+        return is_strict(node.value, parameter, depth)
+    if t is If:
+        return is_strict(node.condition, parameter, depth) or (
+            is_strict(node.true_branch, parameter, depth) and is_strict(node.false_branch, parameter, depth))
+    if is_application(node):
+        if node.operator == '!' and is_strict(node.right, parameter, depth):
+            return True
+        return is_strict(node.left, parameter, depth)
+    if t is BinaryOperator:
+        # optimize() skips the other operand of "0 * x", "F & x", "0 / x" and so on.
+        if node.operator in '*/%&|' and (type(node.left) in (Integer, Boolean) or type(node.right) in (Integer, Boolean)):
+            return False
+        return is_strict(node.left, parameter, depth) or is_strict(node.right, parameter, depth)
+    return False
+
+
+def children(node):
+    t = type(node)
+    if t is UnaryOperator:
+        return (node.value,)
+    if isinstance(node, BinaryOperator):
+        return (node.left, node.right)
+    if t is If:
+        return (node.condition, node.true_branch, node.false_branch)
+    if t is Lambda:
+        return (node.definition,)
+    if t is LoopCall:
+        return node.arguments
+    return ()
+
+
+def free_variables(node):
+    result = set()
+    stack = [(node, frozenset())]
+    while stack:
+        node, bound = stack.pop()
+        t = type(node)
+        if t is Variable:
+            if node.parameter not in bound:
+                result.add(node.parameter)
+            continue
+        if t is Lambda:
+            bound = bound | {node.parameter}
+        elif t is LoopCall:
+            result |= node.loop.free - bound
+        stack.extend((child, bound) for child in children(node))
+    return result
+
+
+def is_fixpoint(node):
+    # Y = \f. (\x. f (x x)) (\x. f (x x)), \f. (\z. z z) (\x. f (x x)), and the Z combinator,
+    # where x x is eta-expanded to \y. x x y.
+    if type(node) is not Lambda or not is_application(node.definition):
+        return False
+    f = node.parameter
+    left, right = node.definition.left, node.definition.right
+    if not is_fixpoint_half(right, f):
+        return False
+    return is_fixpoint_half(left, f) or (
+        type(left) is Lambda and is_self_application(left.definition, left.parameter))
+
+
+def is_fixpoint_half(node, f):
+    # \x. f (x x)
+    return (type(node) is Lambda and node.parameter != f and is_application(node.definition)
+            and is_variable(node.definition.left, f)
+            and is_self_application(node.definition.right, node.parameter))
+
+
+def is_self_application(node, x):
+    # x x or \y. x x y
+    if type(node) is Lambda:
+        y, node = node.parameter, node.definition
+        if y == x or not is_application(node) or not is_variable(node.right, y):
+            return False
+        node = node.left
+    return is_application(node) and is_variable(node.left, x) and is_variable(node.right, x)
+
+
+class Loop(object):
+    '''
+    A recursive function recognized by accelerate_loops().  f(a1, ..., am) is |base| when
+    |condition| is |stop|, and otherwise |term| <operator> f(..., counter - step, ...) (or the
+    mirrored order when |term_left| is False, or just the call when |operator| is None).
+    '''
+    __slots__ = ('self_parameter', 'parameters', 'counter', 'step', 'condition', 'stop',
+                 'base', 'operator', 'term', 'term_left', 'free')
+
+    def __init__(self, self_parameter, parameters, counter, step, condition, stop, base, operator, term, term_left):
+        self.self_parameter = self_parameter
+        self.parameters = parameters
+        self.counter = counter
+        self.step = step
+        self.condition = condition
+        self.stop = stop
+        self.base = base
+        self.operator = operator
+        self.term = term
+        self.term_left = term_left
+        free = free_variables(condition) | free_variables(base)
+        if term is not None:
+            free |= free_variables(term)
+        self.free = free - set(parameters)
+
+    @staticmethod
+    def match(generator):
+        if type(generator) is not Lambda:
+            return None
+        self_parameter = generator.parameter
+        parameters = []
+        body = generator.definition
+        while type(body) is Lambda:
+            parameters.append(body.parameter)
+            body = body.definition
+        if not parameters or type(body) is not If or len(set(parameters)) < len(parameters) or self_parameter in parameters:
+            return None
+        for stop, base, step in ((True, body.true_branch, body.false_branch), (False, body.false_branch, body.true_branch)):
+            if self_parameter in free_variables(body.condition) | free_variables(base):
+                continue
+            call = Loop.match_call(step, self_parameter, parameters)
+            if call is not None:
+                return Loop(self_parameter, tuple(parameters), *call, body.condition, stop, base, None, None, True)
+            if type(step) is not BinaryOperator or step.operator not in '+*.':
+                continue
+            for term_left, term, call in ((True, step.left, step.right), (False, step.right, step.left)):
+                call = Loop.match_call(call, self_parameter, parameters)
+                if call is not None and self_parameter not in free_variables(term):
+                    return Loop(self_parameter, tuple(parameters), *call, body.condition, stop, base,
+                                step.operator, term, term_left)
+        return None
+
+    @staticmethod
+    def match_call(node, self_parameter, parameters):
+        # self a1 ... (counter - d) ... am: returns (index of the counter, d).
+        arguments = []
+        while is_application(node) and len(arguments) < len(parameters):
+            arguments.append(node.right)
+            node = node.left
+        if not is_variable(node, self_parameter) or len(arguments) != len(parameters):
+            return None
+        result = None
+        for i, (parameter, argument) in enumerate(zip(parameters, reversed(arguments))):
+            if is_variable(argument, parameter):
+                continue
+            if result is not None or type(argument) is not BinaryOperator or argument.operator not in '+-':
+                return None
+            x, y = argument.left, argument.right
+            if argument.operator == '+' and type(x) is Integer:
+                x, y = y, x
+            if not is_variable(x, parameter) or type(y) is not Integer:
+                return None
+            result = (i, y.value if argument.operator == '-' else -y.value)
+        return result
+
+    def function(self):
+        # \a1. ... \am. LoopCall(a1, ..., am)
+        node = LoopCall(self, tuple(Variable(p) for p in self.parameters))
+        for parameter in reversed(self.parameters):
+            node = Lambda(parameter, node)
+        return node
+
+    def apply(self, k, v):
+        if k == self.self_parameter or k in self.parameters or k not in self.free:
+            return self
+        term = None if self.term is None else self.term.apply(k, v).optimize()
+        return Loop(self.self_parameter, self.parameters, self.counter, self.step,
+                    self.condition.apply(k, v).optimize(), self.stop, self.base.apply(k, v).optimize(),
+                    self.operator, term, self.term_left)
+
+    def at(self, node, arguments, n):
+        # Evaluates |node| with the parameters bound to |arguments| and the counter to |n|.
+        for i, (parameter, argument) in enumerate(zip(self.parameters, arguments)):
+            node = node.apply(parameter, Integer(n) if i == self.counter else argument)
+        return reduce(node)
+
+    def iterations(self, arguments, n):
+        # Number of recursive calls from f(counter = n), or None if it does not terminate.
+        c, d = self.condition, self.step
+        if self.stop and type(c) is BinaryOperator and c.operator in '=<>':
+            counter = self.parameters[self.counter]
+            op, limit = c.operator, None
+            if is_variable(c.left, counter) and type(c.right) is Integer:
+                limit = c.right.value
+            elif is_variable(c.right, counter) and type(c.left) is Integer:
+                op, limit = {'=': '=', '<': '>', '>': '<'}[op], c.left.value
+            if limit is not None:
+                if op == '=':
+                    if n == limit:
+                        return 0
+                    if d == 0 or (n - limit) % d != 0 or (n - limit) // d < 0:
+                        return None
+                    return (n - limit) // d
+                if op == '<':
+                    if n < limit:
+                        return 0
+                    return (n - limit) // d + 1 if d > 0 else None
+                if n > limit:
+                    return 0
+                return (limit - n) // -d + 1 if d < 0 else None
+        k = 0
+        while True:
+            c = self.at(self.condition, arguments, n)
+            if type(c) is not Boolean:
+                return None
+            if c.value == self.stop:
+                return k
+            k += 1
+            n -= d
+
+    def run(self, arguments):
+        # Returns the result as a node, or None if it cannot be computed (yet).
+        n = arguments[self.counter]
+        if type(n) is not Integer or self.free:
+            return None
+        n = n.value
+        k = self.iterations(arguments, n)
+        if k is None:
+            return None
+        result = self.at(self.base, arguments, n - k * self.step)
+        if self.operator is None or k == 0:
+            return result
+        op, term_left = self.operator, self.term_left
+        counter = self.parameters[self.counter]
+        if counter not in free_variables(self.term):
+            term = self.at(self.term, arguments, n)
+            x, y = type(term), type(result)
+            if op == '+' and x is Integer and y is Integer:
+                return Integer(result.value + k * term.value)
+            if op == '*' and x is Integer and y is Integer:
+                return Integer(result.value * term.value ** k)
+            if op == '.' and x is String and y is String:
+                term, result = str(term.value), str(result.value)
+                return String(term * k + result if term_left else result + term * k)
+        elif op == '+' and is_variable(self.term, counter) and type(result) is Integer:
+            # n + (n - d) + ... + (n - (k - 1) d)
+            return Integer(result.value + k * n - self.step * k * (k - 1) // 2)
+        for i in range(k - 1, -1, -1):
+            term = self.at(self.term, arguments, n - i * self.step)
+            result = (BinaryOperator(op, term, result) if term_left else BinaryOperator(op, result, term)).optimize()
+            if type(result) not in (Integer, String):
+                return None
+        return result
+
+
+class LoopCall(Node):
+    __slots__ = ('loop', 'arguments')
+
+    def __init__(self, loop, arguments):
+        self.loop = loop
+        self.arguments = arguments
+
+    def __str__(self):
+        return to_str(self)
+
+    def parts(self):
+        parts = [f'loop{self.loop.self_parameter}(']
+        for argument in self.arguments:
+            parts.extend((argument, ', '))
+        parts[-1] = ')'
+        return tuple(parts)
+
+    def dump(self, level):
+        dump(level, f'LOOP x{self.loop.self_parameter}')
+        for argument in self.arguments:
+            argument.dump(level + 1)
+
+    def update(self, loop, arguments):
+        if all(type(a) in (Boolean, Integer, String, Lambda) for a in arguments):
+            result = loop.run(arguments)
+            if result is not None:
+                return result
+        if loop is not self.loop or any(a != b for a, b in zip(arguments, self.arguments)):
+            return LoopCall(loop, arguments)
+        return self
+
+    def optimize(self):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LoopCall.optimize, self, ())
+        return self.update(self.loop, tuple(a.optimize() for a in self.arguments))
+
+    def evaluate(self, values):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LoopCall.evaluate, self, (values,))
+        return self.update(self.loop, tuple(a.evaluate(values).optimize() for a in self.arguments))
+
+    def apply(self, k, v):
+        if active_table is not None and id(self) not in active_table.pending:
+            return active_table.call(LoopCall.apply, self, (k, v))
+        return self.update(self.loop.apply(k, v), tuple(a.apply(k, v).optimize() for a in self.arguments))
+
+
+def accelerate_loops(ast):
+    # Rebuilds |ast| in post-order with an explicit stack.
+    results = []
+    stack = [(ast, False)]
+    while stack:
+        node, expanded = stack.pop()
+        operands = children(node)
+        if operands and not expanded:
+            stack.append((node, True))
+            stack.extend((operand, False) for operand in reversed(operands))
+            continue
+        if operands:
+            operands = results[-len(operands):]
+            del results[-len(operands):]
+        results.append(accelerate_node(node, operands))
+    return results[0]
+
+
+def accelerate_node(node, operands):
+    t = type(node)
+    if t is UnaryOperator:
+        return UnaryOperator(node.operator, *operands)
+    if t is If:
+        return If(*operands)
+    if t is Lambda:
+        return Lambda(node.parameter, *operands)
+    if isinstance(node, LambdaEvaluator):
+        fn, argument = operands
+        loop = Loop.match(argument) if is_fixpoint(fn) else None
+        if loop is not None:
+            return loop.function()
+        return StrictEvaluator(fn, argument)
+    if t is BinaryOperator:
+        return BinaryOperator(node.operator, *operands)
+    return node
+
+
+# Seconds between snapshots of Checkpoint.
+CHECKPOINT_INTERVAL = 60
+# Format of the snapshots.
+CHECKPOINT_VERSION = 2
+
+
+class Checkpoint(object):
+    '''
+    Snapshots of a rewriting in progress, so that a long evaluation survives a crash, Ctrl-C or the
+    step limit of reduce(), and can be moved to another machine.  reduce() calls step() with each
+    new AST, which saves it when |interval| seconds have passed since the previous snapshot.  The
+    last AST is also saved when the evaluation ends or is interrupted.  A snapshot is a gzipped
+    pickle of the AST, the number of steps, the active Stats and the options of compile(); resume()
+    continues from it.  Only load snapshots you wrote: unpickling runs arbitrary code.
+    '''
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL, options=None, steps=0):
+        self.path = Path(path)
+        self.interval = interval
+        self.options = options or {}
+        self.steps = steps
+        self.last = time.monotonic()
+
+    def step(self, ast):
+        self.steps += 1
+        if time.monotonic() - self.last >= self.interval:
+            self.save(ast)
+
+    def save(self, ast):
+        # The AST is serialized without recursion, so that deep trees can be saved too.
+        loops = []
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'ast': serialize(ast, loops),
+            'loops': loops,
+            'steps': self.steps,
+            'stats': stats,
+            'options': self.options,
+        }
+        # Replace the previous snapshot only once the new one is complete.
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with gzip.open(temporary, 'wb', compresslevel=1) as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except BaseException:
+            temporary.unlink(missing_ok=True)
+            raise
+        self.last = time.monotonic()
+
+    @staticmethod
+    def load(path, interval=CHECKPOINT_INTERVAL):
+        # Returns (Checkpoint, AST, Stats or None).
+        with gzip.open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f'Unknown checkpoint version in {path}: {state.get("version")}')
+        checkpoint = Checkpoint(path, interval, state['options'], state['steps'])
+        return checkpoint, deserialize(state['ast'], state['loops']), state['stats']
+
+
+def compile(icfp, verbose=False, sleep_time=0, hashcons=False, accelerate=False, stats=None, incremental=False,
+            checkpoint=None, interval=CHECKPOINT_INTERVAL, trace=None):
+    '''
+    verbose: print every tree in full.  A Trace as |trace| is the cheap alternative.
+    icfp: the program as a str, bytes, memoryview or mmap, a path to its file (parsed through the
+      AST cache of parse_file()), or an AST.
+    checkpoint: a path to save snapshots of the evaluation to every |interval| seconds (see
+      Checkpoint).  resume(path) continues from the last one.
+    '''
+    if checkpoint is not None and type(checkpoint) is not Checkpoint:
+        options = {'hashcons': hashcons, 'incremental': incremental}
+        checkpoint = Checkpoint(checkpoint, interval, options)
+    if stats is not None:
+        with stats:
+            return compile(icfp, verbose, sleep_time, hashcons, accelerate, incremental=incremental,
+                           checkpoint=checkpoint, trace=trace)
+    if hashcons:
+        # The memo of HashCons covers Incremental.
+        with HashCons():
+            return compile(icfp, verbose, sleep_time, accelerate=accelerate, checkpoint=checkpoint, trace=trace)
+    if incremental:
+        with Incremental():
+            return compile(icfp, verbose, sleep_time, accelerate=accelerate, checkpoint=checkpoint, trace=trace)
+    with phase('parse'):
+        if isinstance(icfp, Node):
+            ast = icfp
+        elif isinstance(icfp, os.PathLike):
+            ast = parse_file(icfp)
+        else:
+            ast = parse_source(icfp)
+    if accelerate:
+        with phase('accelerate'):
+            ast = accelerate_loops(ast)
     if verbose:
         dump(0, "Input")
+    with phase('evaluate'):
+        ast = reduce(ast, verbose, sleep_time, checkpoint, trace)
+    return flatten(ast)
+
+
+def resume(path, verbose=False, sleep_time=0, interval=CHECKPOINT_INTERVAL, stats=None, trace=None):
+    '''
+    Continues the evaluation saved at |path| by compile(checkpoint=path), and keeps saving snapshots
+    there.  The counts continue in the saved Stats, or in |stats| if given.
+    '''
+    checkpoint, ast, saved_stats = Checkpoint.load(path, interval)
+    options = checkpoint.options
+    if stats is None:
+        stats = saved_stats
+    with stats if stats is not None else nullcontext():
+        # The memo of HashCons covers Incremental.
+        with HashCons() if options.get('hashcons') else Incremental() if options.get('incremental') else nullcontext():
+            with phase('evaluate'):
+                ast = reduce(ast, verbose, sleep_time, checkpoint, trace)
+    return flatten(ast)
+
+
+def flatten(ast):
+    if type(ast) is String and type(ast.value) is Rope:
+        # String values are ropes (icfp_rope) while evaluating.
+        return String(str(ast.value))
+    return ast
 
-    count = 0
-    while True:
-        if verbose:
-            # ast.dump(0)
-            dump(0, f'{ast}\n')
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+
+def phase(name):
+    # Times the phase in the active Stats.
+    return stats.phase(name) if stats is not None else nullcontext()
+
+
+# Rewriting steps of one call of reduce().
+MAX_STEPS = 1000000
+
+
+def reduce(ast, verbose=False, sleep_time=0, checkpoint=None, trace=None):
+    # |checkpoint| is a Checkpoint to save the AST to.  The last AST is saved however the loop ends.
+    # |trace| is a Trace to record the steps in.
+    try:
+        for step in iter_steps(ast):
+            ast = step.ast
+            if step.number and checkpoint is not None:
+                checkpoint.step(ast)
+            if trace is not None:
+                trace.add(step)
+            if verbose:
+                # ast.dump(0)
+                dump(0, f'{ast}\n')
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+    except BaseException:
+        # Keep the AST reached so far, but report why the evaluation stopped rather than a
+        # failure to save it.
+        if checkpoint is not None:
+            try:
+                checkpoint.save(ast)
+            except Exception as e:
+                print(f'Cannot save the checkpoint {checkpoint.path}: {e!r}', file=sys.stderr)
+        raise
+    finally:
+        if trace is not None:
+            trace.end()
+    if checkpoint is not None:
+        checkpoint.save(ast)
+    return ast
+
+
+def iter_steps(ast, max_steps=MAX_STEPS):
+    '''
+    Rewrites |ast| one step at a time, and yields a Step for each tree from |ast| itself (step 0)
+    to the result.  Nothing is printed or measured unless the caller asks the Step, so iterating
+    costs the same as reduce().  Stops after |max_steps| rewrites.
+    '''
+    start = time.perf_counter()
+    number = 0
+    yield Step(number, ast, 0)
+    while number < max_steps:
+        if stats is not None:
+            stats.steps += 1
+            if number % stats.measure_interval == 0:
+                stats.measure(ast)
         next = ast.evaluate(None).optimize()
         if next == ast:
             break
         ast = next
-        if type(ast) is String or count > 1000000:
+        number += 1
+        yield Step(number, ast, time.perf_counter() - start)
+        if type(ast) is String:
             break
-        count += 1
-    return ast
+    if stats is not None and number % stats.measure_interval != 0:
+        stats.measure(ast)
+
+
+class Step(object):
+    # A tree of a rewriting from iter_steps(): |number| rewrites and |seconds| after the start.
+    __slots__ = ('number', 'ast', 'seconds')
+
+    def __init__(self, number, ast, seconds):
+        self.number = number
+        self.ast = ast
+        self.seconds = seconds
+
+    def as_dict(self):
+        # Computed on each call, in time linear in the number of distinct nodes.
+        size, depth = measure(self.ast)
+        return {
+            'step': self.number,
+            'seconds': round(self.seconds, 6),
+            'size': size,
+            'depth': depth,
+            'redexes': redexes(self.ast),
+            'root': type(self.ast).__name__,
+        }
+
+
+def redexes(ast):
+    # Number of applications of a lambda in |ast|.  Shared nodes are counted once.
+    seen = set()
+    count = 0
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if is_application(node) and type(node.left) is Lambda:
+            count += 1
+        stack.extend(children(node))
+    return count
+
+
+# Steps between two records of a Trace by default.
+TRACE_SAMPLE = 100
+
+
+class Trace(object):
+    '''
+    A bounded trace of a rewriting, for compile(trace=...).  Every |sample|-th step, and the last
+    one, is written to |out| as a JSON line of Step.as_dict() instead of the whole tree:
+      {"depth": 9, "redexes": 2, "root": "LambdaEvaluator", "seconds": 0.0012, "size": 31, "step": 3}
+    The trees of the last |capacity| steps are kept in |recent| (a ring buffer), and print_recent()
+    prints them in full, e.g. after an error.
+    '''
+    def __init__(self, out=None, sample=TRACE_SAMPLE, capacity=8):
+        if sample < 1:
+            raise ValueError(f'sample must be positive: {sample}')
+        self.out = out
+        self.sample = sample
+        self.recent = deque(maxlen=capacity)
+        self.written = None
+
+    def add(self, step):
+        self.recent.append(step)
+        if self.out is not None and step.number % self.sample == 0:
+            self.write(step)
+
+    def end(self):
+        if self.recent and self.recent[-1] is not self.written and self.out is not None:
+            self.write(self.recent[-1])
+
+    def write(self, step):
+        self.out.write(json.dumps(step.as_dict(), sort_keys=True) + '\n')
+        self.written = step
+
+    def print_recent(self, file=None):
+        for step in self.recent:
+            print(f'step {step.number}: {step.ast}', file=sys.stderr if file is None else file)
+
+
+# Number of operands of each indicator.
+ARITY = {'U': 1, 'B': 2, 'L': 1, '?': 3}
 
 def parse(tokens):
-    token = tokens.popleft()
-    indicator, body = token[0], token[1:]
+    # |tokens| are token strings such as the deque from tokenize().
+    return build(decode(tokens))
+
+
+def parse_source(source):
+    '''
+    Parses a str, bytes, memoryview or mmap in one pass.  The buffer is copied and split
+    PARSE_CHUNK bytes at a time (cut at whitespace), so there is no token list or copy of the whole
+    program (a str is encoded once), and nodes are built as tokens are found.  Pending operators
+    are kept on an explicit stack as [indicator code, operator or parameter, operands].
+    '''
+    data = source.encode() if type(source) is str else source
+    size = len(data)
+    stack = []
+    position = 0
+    while position < size:
+        match = SPACE.search(data, position + PARSE_CHUNK)
+        end = size if match is None else match.end()
+        chunk = bytes(data[position:end])
+        position = end
+        for token in chunk.split():
+            c = token[0]
+            n = len(token)
+            if c == 66 or c == 85:                  # B, U
+                stack.append([c, OPERATORS[token[1]] if n == 2 else token[1:].decode(), []])
+                continue
+            if c == 76:                             # L
+                stack.append([c, token[1] - 33 if n == 2 else decode_integer(token, 0, n), []])
+                continue
+            if c == 63:                             # ?
+                stack.append([c, None, []])
+                continue
+            if c == 118:                            # v
+                node = Variable(token[1] - 33 if n == 2 else decode_integer(token, 0, n))
+            elif c == 73:                           # I
+                if n > LAZY_LITERAL:
+                    node = lazy_literal(Integer, token[1:])
+                else:
+                    node = Integer(token[1] - 33 if n == 2 else decode_integer(token, 0, n))
+            elif c == 83:                           # S
+                if n > LAZY_LITERAL:
+                    node = lazy_literal(String, token[1:])
+                else:
+                    node = String(decrypt(token[1:]).decode())
+            elif c == 84 or c == 70:                # T, F
+                node = Boolean(c == 84)
+            else:
+                node = parse_leaf(INDICATORS[c], token[1:].decode())
+            while stack:
+                c, value, operands = stack[-1]
+                operands.append(node)
+                if c == 66:
+                    if len(operands) < 2:
+                        break
+                    node = LambdaEvaluator(*operands) if value == '$' else BinaryOperator(value, *operands)
+                elif c == 76:
+                    node = Lambda(value, node)
+                elif c == 85:
+                    node = UnaryOperator(value, node)
+                else:
+                    if len(operands) < 3:
+                        break
+                    node = If(*operands)
+                stack.pop()
+            else:
+                return node
+    raise ValueError('Unexpected end of the program')
+
+
+# Tokens are separated by any whitespace.
+TOKEN = re.compile(rb'\S+')
+SPACE = re.compile(rb'\s')
+
+# Bytes of the buffer split at a time by parse_source().
+PARSE_CHUNK = 1 << 13
+
+# I and S literals with longer bodies are decoded on first use.
+LAZY_LITERAL = 64
+
+
+def lazy_literal(cls, encoded):
+    # An Integer or String node holding the body |encoded| (bytes) instead of its value.
+    node = object.__new__(cls)
+    node.encoded = encoded
+    if hashcons is not None:
+        # Shared nodes are keyed by their value, so it is decoded now.
+        return cls(node.value)
+    return node
+
+# Single characters by code, to avoid chr() per token.
+INDICATORS = OPERATORS = tuple(chr(c) for c in range(256))
+
+
+def scan(source, lazy=False):
+    '''
+    Yields (indicator, value) for each token of |source|, a str, bytes, memoryview or mmap, with one
+    cursor over the buffer.  Bodies are decoded straight from the buffer: |value| is an int for I, v
+    and L, a str for S, the operator for U and B, and None for T, F and ?.  With |lazy|, I and S
+    bodies longer than LAZY_LITERAL are not decoded: |value| is a node of lazy_literal() instead.
+    '''
+    data = source.encode() if type(source) is str else source
+    for match in TOKEN.finditer(data):
+        start, end = match.span()
+        c = data[start]
+        if lazy and (c == 73 or c == 83) and end - start > LAZY_LITERAL:
+            yield INDICATORS[c], lazy_literal(Integer if c == 73 else String, bytes(data[start + 1:end]))
+        elif c == 73 or c == 118 or c == 76:    # I, v, L
+            yield INDICATORS[c], data[start + 1] - 33 if end - start == 2 else decode_integer(data, start, end)
+        elif c == 66 or c == 85:                # B, U
+            yield INDICATORS[c], OPERATORS[data[start + 1]] if end - start == 2 else bytes(data[start + 1:end]).decode()
+        elif c == 83:                           # S
+            yield 'S', decrypt(bytes(data[start + 1:end])).decode()
+        else:
+            yield INDICATORS[c], None if end - start == 1 else bytes(data[start + 1:end]).decode()
+
+
+def decode_integer(data, start, end):
+    # Decodes the body of the token data[start:end] as a base-94 number.
+    if end - start > SMALL_DIGITS:
+        return asc2int(bytes(data[start + 1:end]))
+    value = 0
+    for i in range(start + 1, end):
+        value = value * 94 + data[i] - 33
+    return value
+
+
+def decode(tokens):
+    # Same as scan() for token strings.
+    for token in tokens:
+        indicator, body = token[0], token[1:]
+        if indicator in ('I', 'v', 'L'):
+            yield indicator, asc2int(body)
+        elif indicator == 'S':
+            yield indicator, decrypt(body)
+        elif indicator in ('T', 'F', '?'):
+            yield indicator, None
+        else:
+            yield indicator, body
+
+
+def build(pairs):
+    # Nodes waiting for their operands are kept on an explicit stack, so that
+    # deeply nested programs do not hit the recursion limit.
+    stack = []
+    for indicator, value in pairs:
+        arity = ARITY.get(indicator)
+        if arity:
+            stack.append((indicator, value, [], arity))
+            continue
+        node = parse_leaf(indicator, value)
+        while stack:
+            indicator, value, operands, arity = stack[-1]
+            operands.append(node)
+            if len(operands) < arity:
+                break
+            stack.pop()
+            node = parse_node(indicator, value, operands)
+        else:
+            return node
+    raise ValueError('Unexpected end of the program')
+
+
+def parse_leaf(indicator, value):
     if indicator == 'T':
         return Boolean(True)
     if indicator == 'F':
         return Boolean(False)
     if indicator == 'I':
-        return Integer(asc2int(body))
+        return Integer(value)
     if indicator == 'S':
-        return String(decrypt(body))
-    if indicator == 'U':
-        operand = parse(tokens)
-        return UnaryOperator(body, operand)
-    if indicator == 'B':
-        left = parse(tokens)
-        right = parse(tokens)
-        if body == '$':
-            return LambdaEvaluator(left, right)
-        return BinaryOperator(body, left, right)
-    if indicator == 'L':
-        param = asc2int(body)
-        definition = parse(tokens)
-        return Lambda(param, definition)
+        return String(value)
     if indicator == 'v':
-        param = asc2int(body)
-        return Variable(param)
-    if indicator == '?':
-        c = parse(tokens)
-        t = parse(tokens)
-        f = parse(tokens)
-        return If(c, t, f)
-    print("Unknown indicator [{}]: {}".format(indicator, body), file=sys.stderr)
+        return Variable(value)
+    print("Unknown indicator [{}]: {}".format(indicator, value), file=sys.stderr)
     return None
 
 
-def asc2int(body):
-    value = 0
-    for c in body:
-        value = value * 94 + ord(c) - 33
-    return value
-
-
-def int2asc(value):
-    result = []
-    while value > 0:
-        result.append(chr(value % 94 + 33))
-        value //= 94
-    return ''.join(reversed(result))
-
+def parse_node(indicator, value, operands):
+    if indicator == 'U':
+        return UnaryOperator(value, operands[0])
+    if indicator == 'B':
+        left, right = operands
+        if value == '$':
+            return LambdaEvaluator(left, right)
+        return BinaryOperator(value, left, right)
+    if indicator == 'L':
+        return Lambda(value, operands[0])
+    c, t, f = operands
+    return If(c, t, f)
+
+
+# Parsed ASTs are cached next to their source as <source>c, e.g. efficiency7.icfpc.
+AST_SUFFIX = 'c'
+AST_VERSION = 1
+
+# Directory of the AST caches instead, or None.  The tests use a temporary one.
+ast_cache_dir = None
+
+
+def ast_cache_path(path):
+    # The AST cache of the source |path|.
+    if ast_cache_dir is None:
+        return path.with_name(path.name + AST_SUFFIX)
+    # Sources of the same name in different directories get different caches.
+    digest = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:16]
+    return Path(ast_cache_dir) / f'{path.name}.{digest}{AST_SUFFIX}'
+
+
+def serialize(ast, loops=None):
+    '''
+    The AST as a marshal of flat arrays, in postfix order: |kinds| has one byte per node (its
+    indicator, or 'i' / 's' for a literal kept encoded), and |operators|, |numbers| and |literals|
+    hold the operators of B and U, the parameters of L and v and the values of I, and the bodies
+    and texts of S, in the order of the nodes using them.  deserialize() builds the nodes without
+    tokenizing.  Shared nodes are written once per use.
+    Nodes of accelerate_loops() are written only when |loops| is a list: a StrictEvaluator as '$',
+    and a LoopCall as 'l' with the index of its Loop, which is appended to |loops|.
+    '''
+    kinds = bytearray()
+    operators = []
+    numbers = []
+    literals = []
+    stack = [(ast, False)]
+    while stack:
+        node, expanded = stack.pop()
+        t = type(node)
+        if not expanded and t is not Boolean and t is not Integer and t is not String and t is not Variable:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children(node)))
+            continue
+        if t is Boolean:
+            kinds.append(84 if node.value else 70)
+        elif t is Integer or t is String:
+            encoded = Literal.encoded.__get__(node)
+            if encoded is not None:
+                kinds.append(105 if t is Integer else 115)     # i, s
+                literals.append(encoded)
+            elif t is Integer:
+                kinds.append(73)
+                numbers.append(node.value)
+            else:
+                kinds.append(83)
+                literals.append(str(node.value))
+        elif t is Variable:
+            kinds.append(118)
+            numbers.append(node.parameter)
+        elif t is Lambda:
+            kinds.append(76)
+            numbers.append(node.parameter)
+        elif t is UnaryOperator:
+            kinds.append(85)
+            operators.append(node.operator)
+        elif t is If:
+            kinds.append(63)
+        elif t is StrictEvaluator and loops is not None:
+            kinds.append(36)
+        elif t is LoopCall and loops is not None:
+            kinds.append(108)
+            numbers.append(len(loops))
+            loops.append(node.loop)
+        elif isinstance(node, BinaryOperator):
+            # Without |loops|, a StrictEvaluator is written as B$.
+            kinds.append(66)
+            operators.append(node.operator)
+        else:
+            raise ValueError(f'Cannot serialize {t.__name__}')
+    # Single-character operators and parameters below 2 ** 32, the usual case, are packed.
+    if all(len(op) == 1 for op in operators):
+        operators = ''.join(operators)
+    if all(0 <= n < 1 << 32 for n in numbers):
+        numbers = array.array('I', numbers).tobytes()
+    return marshal.dumps((AST_VERSION, bytes(kinds), operators, numbers, literals))
+
+
+def deserialize(data, loops=None):
+    # The AST of serialize() from bytes, or a memoryview or mmap of them.  |loops| is the list
+    # passed to serialize().
+    version, kinds, operators, numbers, literals = marshal.loads(data)
+    if version != AST_VERSION:
+        raise ValueError(f'Unknown AST version: {version}')
+    operators = iter(operators)
+    numbers = iter(memoryview(numbers).cast('I') if type(numbers) is bytes else numbers)
+    literals = iter(literals)
+    stack = []
+    for c in kinds:
+        if c == 66:                             # B
+            right = stack.pop()
+            op = next(operators)
+            stack[-1] = LambdaEvaluator(stack[-1], right) if op == '$' else BinaryOperator(op, stack[-1], right)
+        elif c == 118:                          # v
+            stack.append(Variable(next(numbers)))
+        elif c == 76:                           # L
+            stack[-1] = Lambda(next(numbers), stack[-1])
+        elif c == 73:                           # I
+            stack.append(Integer(next(numbers)))
+        elif c == 85:                           # U
+            stack[-1] = UnaryOperator(next(operators), stack[-1])
+        elif c == 63:                           # ?
+            false_branch = stack.pop()
+            true_branch = stack.pop()
+            stack[-1] = If(stack[-1], true_branch, false_branch)
+        elif c == 83:                           # S
+            stack.append(String(next(literals)))
+        elif c == 105 or c == 115:              # i, s
+            stack.append(lazy_literal(Integer if c == 105 else String, next(literals)))
+        elif c == 36:                           # $ (StrictEvaluator)
+            right = stack.pop()
+            stack[-1] = StrictEvaluator(stack[-1], right)
+        elif c == 108:                          # l (LoopCall)
+            loop = loops[next(numbers)]
+            n = len(loop.parameters)
+            arguments = tuple(stack[-n:])
+            del stack[-n:]
+            stack.append(LoopCall(loop, arguments))
+        else:                                   # T, F
+            stack.append(Boolean(c == 84))
+    if len(stack) != 1:
+        raise ValueError('Malformed AST')
+    return stack[0]
+
+
+def parse_file(path):
+    '''
+    Parses the program in the file |path| through its AST cache, |path| + AST_SUFFIX (or a file in
+    ast_cache_dir if set).  The cache is used while it records the size and mtime of the source, and is rewritten otherwise.  Both files
+    are memory-mapped, so a cached program is neither read into a str nor tokenized.
+    '''
+    path = Path(path)
+    cache = ast_cache_path(path)
+    source = path.stat()
+    header = marshal.dumps((source.st_size, source.st_mtime_ns))
+    try:
+        with open(cache, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(header)] == header:
+                # Released explicitly, as a traceback would keep them and the mmap could not be closed.
+                with memoryview(data) as view, view[len(header):] as payload:
+                    return deserialize(payload)
+    except (OSError, ValueError, EOFError, TypeError):
+        # Missing, empty or corrupt.
+        pass
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        ast = parse_source(data)
+    # Replace the previous cache only once the new one is complete.
+    temporary = cache.with_name(cache.name + '.tmp')
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(header)
+            f.write(serialize(ast))
+        os.replace(temporary, cache)
+    except OSError:
+        # A read-only directory only loses the cache.
+        pass
+    return ast
 
-mapping = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!\"#$%&'()*+,-./:;<=>?@[\\]^_`|~ \n"
-crypt_map = {}
 
-def decrypt(s):
-    return ''.join(mapping[ord(c) - 33] for c in s)
+@contextmanager
+def ast_cache_in(directory):
+    # Sets ast_cache_dir within the block.
+    global ast_cache_dir
+    previous = ast_cache_dir
+    ast_cache_dir = directory
+    try:
+        yield
+    finally:
+        ast_cache_dir = previous
 
-def encrypt(s):
-    global crypt_map
-    if len(crypt_map) == 0:
-        for i in range(len(mapping)):
-            crypt_map[mapping[i]] = i
 
-    return ''.join(chr(crypt_map[c] + 33) for c in s)
+# The unit tests keep their AST caches here, not next to the problems in data/ and test_data/.
+test_cache = None
 
-def icfp2int(icfp):
-    global crypt_map
-    if len(crypt_map) == 0:
-        for i in range(len(mapping)):
-            crypt_map[mapping[i]] = i
 
-    value = 0
-    for c in icfp:
-        value = value * 94 + crypt_map[c]
-    return value
+def setUpModule():
+    global test_cache, ast_cache_dir
+    test_cache = tempfile.TemporaryDirectory()
+    ast_cache_dir = test_cache.name
 
-def int2icfp(value):
-    result = []
-    while value > 0:
-        result.append(mapping[value % 94])
-        value //= 94
-    return ''.join(reversed(result))
 
-def I_decode(icfp):
-    value = 0
-    for c in icfp:
-        value = value * 94 + ord(c) - 33
-    return value
+def tearDownModule():
+    global ast_cache_dir
+    ast_cache_dir = None
+    test_cache.cleanup()
 
-def I_encode(value):
-    result = []
-    while True:
-        result.append(chr(value % 94 + 33))
-        value //= 94
-        if value == 0: break
-    return ''.join(reversed(result))
 
 class TestICFP(unittest.TestCase):
     def test_I_code(self):
@@ -549,6 +2003,18 @@ class TestICFP(unittest.TestCase):
         actual = icfp2ascii(icfp)
         self.assertEqual(actual, "Hello World!")
 
+    def test_long_string(self):
+        # Long strings are ropes while evaluating and a str in the result.
+        a, b = 'L' * 3000, 'R' * 3000
+        s = f'B. S{encrypt(a)} S{encrypt(b)}'
+        ast = compile(f'B. BT I# {s} BD I{I_encode(5990)} {s}')
+        self.assertIs(type(ast.value), str)
+        self.assertEqual(ast.value, 'LL' + 'R' * 10)
+        self.assertIs(type(compile(s).value), str)
+        self.assertEqual(compile(s).value, a + b)
+        self.assertEqual(icfp2ascii(f'B= {s} S{encrypt(a + b)}'), 'True')
+        self.assertEqual(compile(f'U# {s}').value, icfp2int(a + b))
+
     def test_icfp_eval(self):
         icfp = 'B$ L# B$ L" B+ v" v" B* I$ I# v8'
         actual = icfp2ascii(icfp)
@@ -563,6 +2029,429 @@ class TestICFP(unittest.TestCase):
         x = 2 + 311 * 124753942619
         s = int2icfp(x)
 
+    def test_str(self):
+        ast = parse(tokenize('B$ L# ? B< v# I# U- v# B. S4% S34 B$ L" v" I"'))
+        self.assertEqual(str(ast), '(lambda Lambda (x2) \nIF (x2 < 2):\nTHEN: -x2\nELSE: ("te" . "st") : (lambda Lambda (x1) x1 : 1))')
+
+    def test_deep_program(self):
+        # 1 + (1 + (1 + ...)) nested 200000 times.
+        depth = 200000
+        icfp = 'B+ I" ' * depth + 'I!'
+        ast = parse(tokenize(icfp))
+        self.assertEqual(len(str(ast)), len('(1 + ') * depth + len('0') + len(')') * depth)
+        self.assertEqual(evaluate(icfp).value, depth)
+
+class TestParser(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    PROBLEMS_DIR = SCRIPT_DIR.parent / 'data' / 'courses' / 'efficiency' / 'problems'
+
+    def test_sources(self):
+        icfp = 'B$ L# ? B< v# I# U- v#\nB. S4%  S34 BT I"/6 T'
+        expected = str(parse(tokenize(icfp)))
+        self.assertEqual(str(parse_source(icfp)), expected)
+        self.assertEqual(str(parse_source(icfp.encode())), expected)
+        self.assertEqual(str(parse_source(memoryview(icfp.encode()))), expected)
+        self.assertEqual(list(scan(icfp))[:4], [('B', '$'), ('L', 2), ('?', None), ('B', '<')])
+        self.assertEqual(list(scan(icfp))[-5:], [('S', 'te'), ('S', 'st'), ('B', 'T'), ('I', 1 * 94**2 + 14 * 94 + 21), ('T', None)])
+        with self.assertRaises(ValueError):
+            parse_source('B+ I"')
+
+    def test_lazy_literals(self):
+        # Long literals are decoded when the program uses them, and not at all in a dead branch.
+        digits = '~' * 10 ** 6
+        text = 'Hello World! ' * 10
+        ast = parse_source(f'? B= I" I# I{digits} B. S{encrypt(text)} S{encrypt(text)}')
+        dead, used = ast.true_branch, ast.false_branch
+        self.assertIsNotNone(dead.encoded)
+        self.assertEqual(reduce(ast).value, text * 2)
+        self.assertIsNotNone(dead.encoded)
+        self.assertIsNone(used.left.encoded)
+        self.assertIsNotNone(copy.copy(dead).encoded)
+        self.assertEqual(str(parse_source(f'I{digits[:100]}')), str(I_decode(digits[:100])))
+        self.assertEqual(parse_source(f'S{encrypt(text)}').value, text)
+
+    def test_mmap(self):
+        import mmap
+        path = self.PROBLEMS_DIR / 'efficiency7.icfp'
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ast = parse_source(data)
+        self.assertEqual(str(ast), str(parse(tokenize(path.read_text()))))
+
+    def test_ast_cache(self):
+        for path in sorted(self.PROBLEMS_DIR.glob('*.icfp')):
+            ast = parse_source(path.read_bytes())
+            self.assertEqual(str(deserialize(serialize(ast))), str(ast))
+        digits = '~' * 100
+        icfp = f'B. B$ L" U$ B+ v" I{digits} I" B$ L#  ? v# S{encrypt("x" * 100)} S4% B< I{I_encode(2**40)} I-'
+        with tempfile.TemporaryDirectory() as directory, ast_cache_in(None):
+            path = Path(directory) / 'test.icfp'
+            path.write_text(icfp)
+            expected = str(parse_source(icfp))
+            self.assertEqual(str(parse_file(path)), expected)
+            cache = Path(directory) / 'test.icfpc'
+            self.assertTrue(cache.exists())
+            ast = parse_file(path)
+            self.assertIsNotNone(ast.right.left.definition.true_branch.encoded)
+            self.assertEqual(str(ast), expected)
+            self.assertEqual(compile(path).value, compile(icfp).value)
+            self.assertEqual(compile(ast).value, compile(icfp).value)
+            # A changed source, or a corrupt cache, is parsed again.
+            path.write_text('B+ I# I$')
+            self.assertEqual(compile(path).value, 5)
+            cache.write_bytes(cache.read_bytes()[:-3])
+            self.assertEqual(compile(path).value, 5)
+            # With ast_cache_dir, the cache is written there instead.
+            cache.unlink()
+            with tempfile.TemporaryDirectory() as cache_dir, ast_cache_in(cache_dir):
+                self.assertEqual(compile(path).value, 5)
+                self.assertEqual([cache.name[:9] for cache in Path(cache_dir).iterdir()], ['test.icfp'])
+                self.assertEqual(str(parse_file(path)), str(parse_source('B+ I# I$')))
+            self.assertFalse(cache.exists())
+
+    def test_chunks(self):
+        # Same trees as tokenize() and parse() across chunk boundaries, with any whitespace.
+        for path in sorted(self.PROBLEMS_DIR.glob('*.icfp')):
+            source = path.read_bytes()
+            self.assertEqual(str(parse_source(source)), str(parse(tokenize(source.decode()))))
+        icfp = 'B.\n S4%  \t' * 3000 + 'S' + '4' * (PARSE_CHUNK + 5)
+        self.assertGreater(len(icfp), 4 * PARSE_CHUNK)
+        self.assertEqual(str(parse_source(icfp)), str(parse(tokenize(icfp))))
+
+    def test_memory(self):
+        # A balanced program of 2^16 leaves: parse_source() keeps only a chunk of tokens alive at a
+        # time, while tokenize() holds all of them.
+        def balanced(depth):
+            return 'I" ' if depth == 0 else 'B+ ' + balanced(depth - 1) * 2
+        icfp = balanced(16)
+
+        def overhead(f):
+            # Peak memory beyond the result.
+            tracemalloc.start()
+            try:
+                ast = f()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            return peak - current
+
+        source = icfp.encode()
+        one_pass = overhead(lambda: parse_source(source))
+        tokens = overhead(lambda: parse(tokenize(icfp)))
+        self.assertLess(one_pass * 20, tokens)
+
+
+class TestHashCons(unittest.TestCase):
+    def test_shared_nodes(self):
+        with HashCons() as table:
+            x = parse(tokenize('B+ B* I# I$ B* I# I$'))
+            self.assertIs(x.left, x.right)
+            self.assertEqual(table.hits['node'], 3)
+            self.assertIs(Integer(3), Integer(3))
+            self.assertIsNot(Integer(1), Boolean(True))
+        self.assertIsNot(Integer(3), Integer(3))
+
+    def test_memoized_beta_reduction(self):
+        # (\f. f 3 + f 3) (\x. x * x): the second "f 3" is taken from the memo.
+        with HashCons() as table:
+            ast = compile('B$ L" B+ B$ v" I$ B$ v" I$ L# B* v# v#')
+        self.assertEqual(ast.value, 18)
+        self.assertGreater(table.hits['LambdaEvaluator.evaluate'], 0)
+
+    def test_plain_methods(self):
+        # The classes are left as they are.  The methods check the active table themselves, also
+        # those of a class defined after the table became active.
+        plain = LambdaEvaluator.evaluate
+        with HashCons() as table:
+            class Evaluator(LambdaEvaluator):
+                __slots__ = ()
+            self.assertIs(LambdaEvaluator.evaluate, plain)
+            with Incremental():
+                self.assertIs(active_table, table)
+            ast = reduce(Evaluator(parse_source('L" B* v" v"'), Integer(3)))
+        self.assertEqual(ast.value, 9)
+        self.assertEqual(table.misses['LambdaEvaluator.evaluate'], 1)
+        self.assertIsNone(active_table)
+
+    def test_capacity(self):
+        with HashCons(capacity=8) as table:
+            ast = compile('B$ L" B+ B$ v" I$ B$ v" I$ L# B* v# v#')
+        self.assertEqual(ast.value, 18)
+        self.assertLessEqual(len(table.memo), 8)
+
+
+class TestIncremental(unittest.TestCase):
+    SCRIPT_DIR = Path(__file__).parent
+    TEST_DATA_DIR = SCRIPT_DIR / 'test_data'
+    PROBLEMS_DIR = SCRIPT_DIR.parent / 'data' / 'courses' / 'efficiency' / 'problems'
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read().strip()
+
+    def test_same_steps(self):
+        # Every rewriting step gives the same tree as the whole-tree pass.
+        icfp = self.read(self.PROBLEMS_DIR / 'efficiency7.icfp')
+        plain = incremental = parse(tokenize(icfp))
+        table = Incremental()
+        for _ in range(20):
+            plain = plain.evaluate(None).optimize()
+            with table:
+                incremental = incremental.evaluate(None).optimize()
+            self.assertEqual(str(incremental), str(plain))
+        self.assertGreater(table.skipped['optimize'], 0)
+
+    def test_scales(self):
+        # The first 200 steps of lambdaman6_test and 10 of efficiency7, counted in calls of
+        # evaluate/optimize/apply.  The whole-tree pass makes 17 and 99 times as many.  Counting routes every call through the table and runs it, as
+        # the whole-tree pass does.
+        class Counting(Incremental):
+            def call(self, method, node, args):
+                self.runs[method.__name__] += 1
+                self.pending.add(id(node))
+                try:
+                    return method(node, *args)
+                finally:
+                    self.pending.discard(id(node))
+
+        def runs(icfp, table, n):
+            ast = parse(tokenize(icfp))
+            with table:
+                for _ in range(n):
+                    next = ast.evaluate(None).optimize()
+                    if next == ast:
+                        break
+                    ast = next
+            return str(ast), sum(table.runs.values())
+
+        for path, n in ((self.TEST_DATA_DIR / 'lambdaman6_test.icfp', 200),
+                        (self.PROBLEMS_DIR / 'efficiency7.icfp', 10)):
+            icfp = self.read(path)
+            plain, plain_runs = runs(icfp, Counting(), n)
+            incremental, incremental_runs = runs(icfp, Incremental(), n)
+            self.assertEqual(incremental, plain)
+            self.assertLess(incremental_runs * 10, plain_runs)
+
+
+class TestStats(unittest.TestCase):
+    # sum(4..1) through the Y combinator.
+    ICFP = 'B$ B$ L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v# L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I" I%'
+
+    def test_counts(self):
+        stats = Stats()
+        self.assertEqual(compile(self.ICFP, stats=stats).value, 10)
+        self.assertEqual(stats.beta, 16)
+        self.assertEqual(stats.operators, {'B=': 5, 'B-': 4, 'B+': 4})
+        self.assertEqual(stats.branches, {'then': 1, 'else': 4})
+        self.assertEqual(measure(parse(tokenize(self.ICFP))), (31, 9))
+        self.assertGreaterEqual(stats.peak_size, 31)
+        # The 17 steps are measured at the first step and at the end only, or at every step.
+        self.assertEqual(stats.steps, 17)
+        every = Stats(measure_interval=1)
+        compile(self.ICFP, stats=every)
+        self.assertGreaterEqual(every.peak_size, stats.peak_size)
+        with self.assertRaises(ValueError):
+            Stats(measure_interval=0)
+        self.assertEqual(set(stats.times), {'parse', 'evaluate'})
+        self.assertIsNone(globals()['stats'])
+
+    def test_json(self):
+        stats = Stats()
+        compile('B$ L# B+ v# v# I#', stats=stats)
+        data = json.loads(stats.to_json())
+        self.assertEqual(data['beta'], 1)
+        self.assertEqual(data['operators'], {'B+': 1})
+
+    def test_budget(self):
+        with self.assertRaises(BudgetExceeded):
+            compile(self.ICFP, stats=Stats(budget=15))
+        self.assertEqual(compile(self.ICFP, stats=Stats(budget=16)).value, 10)
+
+
+class TestCheckpoint(unittest.TestCase):
+    # sum(30..1) through the Y combinator, in 94 rewrites.
+    ICFP = 'B$ B$ L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v# L$ L% ? B= v% I! I! B+ v% B$ v$ B- v% I" I?'
+
+    def test_resume_after_crash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'sum.checkpoint'
+            with self.assertRaises(BudgetExceeded):
+                compile(self.ICFP, stats=Stats(budget=60), checkpoint=path, interval=0)
+            stats = Stats()
+            self.assertEqual(resume(path, stats=stats).value, 465)
+            self.assertLess(stats.steps, 60)
+            # The last snapshot holds the result.
+            self.assertEqual(resume(path).value, 465)
+            self.assertEqual(Checkpoint.load(path)[0].steps, 94)
+
+    def test_interval(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'checkpoint'
+            checkpoint = Checkpoint(path, interval=3600)
+            checkpoint.step(Integer(1))
+            self.assertFalse(path.exists())
+            checkpoint.interval = 0
+            checkpoint.step(Integer(2))
+            checkpoint, ast, saved_stats = Checkpoint.load(path)
+            self.assertEqual((checkpoint.steps, ast.value, saved_stats), (2, 2, None))
+
+    def test_options(self):
+        # The options of compile() are restored, and long literals stay encoded.
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'checkpoint'
+            self.assertEqual(compile(self.ICFP, hashcons=True, checkpoint=path).value, 465)
+            self.assertEqual(Checkpoint.load(path)[0].options, {'hashcons': True, 'incremental': False})
+            Checkpoint(path).save(parse_source('I' + '~' * 100))
+            self.assertIsNotNone(Checkpoint.load(path)[1].encoded)
+
+    def test_deep(self):
+        # The rewriter runs out of stack on this program, but the snapshot of it is still saved.
+        icfp = 'B+ I" ' * 2000 + 'I!'
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'checkpoint'
+            with self.assertRaises(RecursionError):
+                compile(icfp, checkpoint=path)
+            self.assertEqual(os.listdir(directory), ['checkpoint'])
+            self.assertEqual(serialize(Checkpoint.load(path)[1]), serialize(parse_source(icfp)))
+
+    def test_accelerated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'checkpoint'
+            ast = accelerate_loops(parse_source(self.ICFP))
+            Checkpoint(path).save(ast)
+            self.assertEqual(str(Checkpoint.load(path)[1]), str(ast))
+            self.assertEqual(resume(path).value, 465)
+
+    def test_save_fails(self):
+        # The error that stopped the evaluation is raised, not the one of the last snapshot, and
+        # no partial snapshot is left.
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'checkpoint'
+            with unittest.mock.patch.object(pickle, 'dump', side_effect=RecursionError):
+                with self.assertRaises(BudgetExceeded), redirect_stderr(io.StringIO()):
+                    compile(self.ICFP, stats=Stats(budget=60), checkpoint=path, interval=3600)
+                self.assertEqual(os.listdir(directory), [])
+                with self.assertRaises(RecursionError):
+                    compile(self.ICFP, checkpoint=path, interval=3600)
+                self.assertEqual(os.listdir(directory), [])
+
+
+class TestTrace(unittest.TestCase):
+    # sum(30..1) through the Y combinator, in 94 rewrites.
+    ICFP = TestCheckpoint.ICFP
+
+    def test_iter_steps(self):
+        steps = iter_steps(parse_source(self.ICFP))
+        self.assertEqual([step.number for step in itertools.islice(steps, 3)], [0, 1, 2])
+        last = deque(steps, maxlen=1)[0]
+        self.assertEqual((last.number, last.ast.value), (94, 465))
+        self.assertEqual(Step(0, parse_source('B$ L" v" I!'), 0).as_dict()['redexes'], 1)
+        steps = list(iter_steps(parse_source(self.ICFP), max_steps=10))
+        self.assertEqual(steps[-1].number, 10)
+
+    def test_sampled(self):
+        out = io.StringIO()
+        trace = Trace(out, sample=10, capacity=4)
+        self.assertEqual(compile(self.ICFP, trace=trace).value, 465)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record['step'] for record in records], list(range(0, 100, 10)) + [94])
+        self.assertEqual(records[0]['size'], len(self.ICFP.split()))
+        for sample in (0, -1):
+            with self.assertRaises(ValueError):
+                Trace(out, sample=sample)
+        self.assertEqual(records[-1]['root'], 'Integer')
+        self.assertEqual([step.number for step in trace.recent], [91, 92, 93, 94])
+        recent = io.StringIO()
+        trace.print_recent(recent)
+        self.assertTrue(recent.getvalue().endswith('step 94: 465\n'))
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestBatchApply(unittest.TestCase):
+    def test_arithmetic(self):
+        # x < 2 ? x * x : x + 1
+        actual = batch_apply('L! ? B< v! I# B* v! v! B+ v! I"', np.arange(-3, 5))
+        self.assertEqual(actual.tolist(), [9, 4, 1, 0, 1, 3, 4, 5])
+
+    def test_division(self):
+        actual = batch_apply('L! B/ v! I$', np.array([-7, -6, 5, 7]))
+        self.assertEqual(actual.tolist(), [-2, -2, 1, 2])
+        actual = batch_apply('L! B% v! I$', np.array([-7, -6, 5, 7]))
+        self.assertEqual(actual.tolist(), [-1, 0, 2, 1])
+
+    def test_boolean(self):
+        actual = batch_apply('L! B& B> v! I! U! B= v! I$', np.arange(5))
+        self.assertEqual(actual.tolist(), [False, True, True, False, True])
+
+    def test_big_integers(self):
+        import icfp_machine
+        actual = batch_apply('L! B* v! v!', np.array([2**40, 3]))
+        self.assertEqual(actual.tolist(), [2**80, 9])
+        actual = batch_apply('L! B+ v! v!', np.array([2**70], dtype=object))
+        self.assertEqual(actual.tolist(), [2**71])
+        # Products of constants folded to scalars, and of scalars and arrays, above 2**31.
+        for fn in ('L! B* B% I"1#$yu I"XmjD%E I"XmjD%E', 'L! B* B% I"1#$yu I"XmjD%E B+ v! I"XmjD%E',
+                   'L! B* ? B< v! I! I"XmjD%E I$ B/ I"1#$yu v!'):
+            values = np.array([1, 3, -2, 2**20])
+            actual = batch_apply(fn, values)
+            expected = [icfp_machine.evaluate(f'B$ {fn} I{I_encode(int(x))}' if x >= 0 else
+                                              f'B$ {fn} U- I{I_encode(-int(x))}').value for x in values]
+            self.assertEqual(actual.tolist(), expected)
+
+    def test_fallback(self):
+        # Strings are evaluated per element.
+        actual = batch_apply('L! U$ v!', np.array([1, 2, 3]))
+        self.assertEqual(actual.tolist(), ['b', 'c', 'd'])
+        # The division by zero is in the branch not taken.
+        actual = batch_apply('L! ? B= v! I! I! B/ I+ v!', np.array([0, 5]))
+        self.assertEqual(actual.tolist(), [0, 2])
+        # An element raising makes the whole batch raise.
+        with self.assertRaises(ZeroDivisionError):
+            batch_apply('L! B% v! v!', np.array([0, 1]))
+        # Booleans stay booleans.
+        actual = batch_apply(f'L! ? v! S{encrypt("yes")} S{encrypt("no")}', np.array([True, False]))
+        self.assertEqual(actual.tolist(), ['yes', 'no'])
+        with self.assertRaises(ValueError):
+            batch_apply('L! L" v!', [1, 2])
+
+
+class TestAccelerate(unittest.TestCase):
+    Y = 'L" B$ L# B$ v" B$ v# v# L# B$ v" B$ v# v#'
+    Z = 'L" B$ L# B$ v# v# L# B$ v" L$ B$ B$ v# v# v$'
+
+    def test_fixpoint(self):
+        self.assertTrue(is_fixpoint(parse(tokenize(self.Y))))
+        self.assertTrue(is_fixpoint(parse(tokenize(self.Z))))
+        self.assertTrue(is_fixpoint(parse(tokenize('L" B$ L# B! v# v# L# B$ v" B$ v# v#'))))
+        self.assertFalse(is_fixpoint(parse(tokenize('L" B$ L# B$ v" B$ v# v# L# B$ v" v#'))))
+
+    def test_closed_form(self):
+        # f(n) = n == 0 ? 1 : 1 + f(n - 1), with n = 10^12.
+        icfp = f'B$ B$ {self.Y} L$ L% ? B= v% I! I" B+ I" B$ v$ B- v% I" I{int2asc(10**12)}'
+        ast = accelerate_loops(parse(tokenize(icfp)))
+        self.assertIn('loop', str(ast))
+        self.assertEqual(reduce(ast).value, 10**12 + 1)
+        # repeat(c, m) = m == 0 ? "" : c . repeat(c, m - 1)
+        icfp = f'B$ B$ B$ {self.Z} L( L) L* ? B= I! v* S B. v) B$ B$ v( v) B- v* I" SB%,,/ I$'
+        self.assertEqual(compile(icfp, accelerate=True).value, 'HelloHelloHello')
+
+    def test_native_loop(self):
+        # factorial(n) = n == 0 ? 1 : n * factorial(n - 1)
+        icfp = f'B$ B$ {self.Y} L( L* ? B= I! v* I" B* v* B$ v( B- v* I" I+'
+        self.assertEqual(compile(icfp, accelerate=True).value, 3628800)
+        # The term refers to x10, which is bound outside the loop.
+        icfp = f'B$ L+ B$ B$ {self.Y} L( L* ? B< v* I" I! B+ v+ B$ v( B- v* I" I+ I%'
+        self.assertEqual(compile(icfp, accelerate=True).value, 40)
+
+    def test_strict_argument(self):
+        # (\f. f (f (f 1))) (\x. (x + x) + (x + x)): x is evaluated once per call.
+        icfp = 'B$ L! B$ v! B$ v! B$ v! I" L! B+ B+ v! v! B+ v! v!'
+        ast = accelerate_loops(parse(tokenize(icfp)))
+        self.assertIs(type(ast), StrictEvaluator)
+        self.assertEqual(reduce(ast).value, 4**3)
+        self.assertFalse(is_strict(parse(tokenize('B* I! v!')), 1))
+        self.assertTrue(is_strict(parse(tokenize('? v" U- v! B+ v! I"')), 1))
+
+
 class TestEnd2End(unittest.TestCase):
     SCRIPT_DIR = Path(__file__).parent
     TEST_DATA_DIR = SCRIPT_DIR / 'test_data'
@@ -586,17 +2475,18 @@ class TestEfficiency(unittest.TestCase):
     ROOT_DIR = SCRIPT_DIR.parent
     PROBLEMS_DIR = ROOT_DIR / 'data' / 'courses' / 'efficiency' / 'problems'
 
-    def run_test(self, id, verbose=False, sleep_time=0):
-        filename = f'efficiency{id}.icfp'
-        with open(self.PROBLEMS_DIR / filename) as f:
-            icfp = f.read().strip()
-        ast = compile(icfp, verbose, sleep_time)
+    def run_test(self, id, verbose=False, sleep_time=0, hashcons=False, accelerate=False):
+        # Parsed through the AST cache.
+        ast = compile(self.PROBLEMS_DIR / f'efficiency{id}.icfp', verbose, sleep_time, hashcons, accelerate)
         self.assertEqual(type(ast), Integer)
         return ast.value
 
     # Eval from the leaf node.
-    def dis_test_efficiency1(self):
-        value = self.run_test('1')
+    # Hash-consing shares the 4 copies of the argument, and the accelerator evaluates it first.
+    def test_efficiency1(self):
+        value = self.run_test('1', hashcons=True)
+        self.assertEqual(value, 4**22)
+        value = self.run_test('1', accelerate=True)
         self.assertEqual(value, 4**22)
 
     # "* 0" operation results in 0.
@@ -605,13 +2495,14 @@ class TestEfficiency(unittest.TestCase):
         self.assertEqual(value, 2134)
 
     # Optimize the recursive call that produces too many "+1" operation.
-    def dis_test_efficiency3(self):
-        value = self.run_test('3')
+    # The accelerator computes 1 + f(n - 1) in closed form.
+    def test_efficiency3(self):
+        value = self.run_test('3', accelerate=True)
         self.assertEqual(value, 9345875634)
 
     # Fibonacci number. Memo-ization is required.
-    def dis_test_efficiency4(self):
-        value = self.run_test('4')
+    def test_efficiency4(self):
+        value = self.run_test('4', hashcons=True)
         self.assertEqual(value, 165580141)
 
     # It outputs (2^k)-1 for x<(2^k)-1, where k is 2,3,5,7,13,17, and 31.
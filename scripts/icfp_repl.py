@@ -21,7 +21,7 @@ def trim_message(s):
     s = s.replace('\n\nYou scored some points for using the echo service!\n', '')
     return s
 
-def repl(verbose=False):
+def repl(verbose=False, trace_sample=icfp_peria.TRACE_SAMPLE):
     while True:
         print(colorama.Back.GREEN + colorama.Fore.WHITE + '!encstr <string>, !decstr <S-body>, !encint <int>, !decint <I-body>, !remB <boolean expr to evaluate on the remote server>, !remS, !remI as well.' + colorama.Style.RESET_ALL)
         print(colorama.Back.BLUE + colorama.Fore.WHITE + '> ', end='')
@@ -67,7 +67,7 @@ def repl(verbose=False):
         else:
             # local evaluation
             try:
-                response = icfp.icfp2ascii(command, verbose)
+                response = icfp.icfp2ascii(command, verbose, trace_sample=trace_sample)
                 print_system(f'COMMAND LENGTH = {len(command)}, RESPONSE LENGTH = {len(response)}')
             except:
                 print('ERROR.')
@@ -79,6 +79,7 @@ if __name__ == '__main__':
     colorama.init(autoreset=False)
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true', default=False)
+    parser.add_argument('--trace-sample', type=icfp.positive_int, default=icfp_peria.TRACE_SAMPLE, help='With -v, trace every N-th rewriting step (default: %(default)s).')
     args = parser.parse_args()
-    repl(args.verbose)
+    repl(args.verbose, args.trace_sample)
 
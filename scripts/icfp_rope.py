@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Rope strings for the ICFP evaluators.
+#
+# Decoders build their output one character at a time (B. acc S>), so with
+# str values a result of n characters costs O(n^2) copying.  Here a string
+# value is either a str, or a Rope: a balanced (AVL) concatenation tree whose
+# leaves are str of at most LEAF characters.  concat(), take() and drop() cost
+# O(log n) and share subtrees with their operands.  str(rope) flattens a rope
+# in linear time; the evaluators do it only for a final result, U# and =.
+#
+# Values of at most LEAF characters are always plain str, so short strings
+# behave exactly as before.
+
+import random
+import unittest
+import unittest.mock
+
+# Longer leaves make the trees lower (appending one character costs a path
+# copy from the root) at the cost of copying up to LEAF characters.
+LEAF = 4096
+
+
+class Rope(object):
+    __slots__ = ('left', 'right', 'length', 'height', 'flat')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        if type(left) is str:
+            length, h = len(left), 0
+        else:
+            length, h = left.length, left.height
+        if type(right) is str:
+            self.length = length + len(right)
+            self.height = h + 1
+        else:
+            self.length = length + right.length
+            self.height = max(h, right.height) + 1
+        self.flat = None
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        if self.flat is None:
+            parts = []
+            stack = [self]
+            while stack:
+                s = stack.pop()
+                if type(s) is str:
+                    parts.append(s)
+                elif s.flat is not None:
+                    parts.append(s.flat)
+                else:
+                    stack.append(s.right)
+                    stack.append(s.left)
+            self.flat = ''.join(parts)
+        return self.flat
+
+    def __eq__(self, other):
+        if type(other) is str or type(other) is Rope:
+            return self.length == len(other) and str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return f'Rope({str(self)!r})'
+
+
+# Types of string values.
+TEXT = (str, Rope)
+
+
+def height(s):
+    return s.height if type(s) is Rope else 0
+
+
+def small(s):
+    # Ropes of at most LEAF characters are flattened.
+    return str(s) if type(s) is Rope and s.length <= LEAF else s
+
+
+def concat(x, y):
+    if not x:
+        return y
+    if not y:
+        return x
+    if type(x) is str and type(y) is str:
+        return x + y if len(x) + len(y) <= LEAF else Rope(x, y)
+    # A short piece is merged into the nearest leaf, so that appending one
+    # character at a time does not make one leaf per character.
+    if type(y) is str and len(y) < LEAF:
+        spine = []
+        while type(x) is Rope:
+            spine.append(x.left)
+            x = x.right
+        t = x + y if len(x) + len(y) <= LEAF else Rope(x, y)
+        for left in reversed(spine):
+            t = Rope(left, t) if height(t) <= height(left) + 1 else balance(left, t)
+        return t
+    if type(x) is str and len(x) < LEAF:
+        spine = []
+        while type(y) is Rope:
+            spine.append(y.right)
+            y = y.left
+        t = x + y if len(x) + len(y) <= LEAF else Rope(x, y)
+        for right in reversed(spine):
+            t = Rope(t, right) if height(t) <= height(right) + 1 else balance(t, right)
+        return t
+    return join(x, y)
+
+
+def join(x, y):
+    # Balanced concatenation of two balanced ropes, in O(|height(x) - height(y)|).
+    hx, hy = height(x), height(y)
+    if hx > hy + 1:
+        return balance(x.left, join(x.right, y))
+    if hy > hx + 1:
+        return balance(join(x, y.left), y.right)
+    return Rope(x, y)
+
+
+def balance(x, y):
+    # Rope(x, y) rotated so that it is balanced.  The heights differ by at most 2.
+    hx, hy = height(x), height(y)
+    if hx > hy + 1:
+        if height(x.left) < height(x.right):
+            x = Rope(Rope(x.left, x.right.left), x.right.right)
+        return Rope(x.left, Rope(x.right, y))
+    if hy > hx + 1:
+        if height(y.right) < height(y.left):
+            y = Rope(y.left.left, Rope(y.left.right, y.right))
+        return Rope(Rope(x, y.left), y.right)
+    return Rope(x, y)
+
+
+def take(n, s):
+    # s[:n]
+    if type(s) is str:
+        return s[:n]
+    if n < 0:
+        n = max(s.length + n, 0)
+    return small(prefix(n, s))
+
+
+def prefix(n, s):
+    if n >= len(s):
+        return s
+    if type(s) is str:
+        return s[:n]
+    left = s.left
+    if n <= len(left):
+        return prefix(n, left)
+    return concat(left, prefix(n - len(left), s.right))
+
+
+def drop(n, s):
+    # s[n:]
+    if type(s) is str:
+        return s[n:]
+    if n < 0:
+        n = max(s.length + n, 0)
+    return small(suffix(n, s))
+
+
+def suffix(n, s):
+    if n <= 0:
+        return s
+    if type(s) is str:
+        return s[n:]
+    left = s.left
+    if n >= len(left):
+        return suffix(n - len(left), s.right)
+    return concat(suffix(n, left), s.right)
+
+
+class TestRope(unittest.TestCase):
+    def assertBalanced(self, s):
+        if type(s) is str:
+            return
+        self.assertLessEqual(abs(height(s.left) - height(s.right)), 1)
+        self.assertEqual(s.height, max(height(s.left), height(s.right)) + 1)
+        self.assertEqual(s.length, len(s.left) + len(s.right))
+        self.assertBalanced(s.left)
+        self.assertBalanced(s.right)
+
+    def test_small(self):
+        self.assertEqual(concat('te', 'st'), 'test')
+        self.assertIs(type(concat('a' * LEAF, 'b')), Rope)
+        self.assertIs(type(take(3, concat('a' * LEAF, 'b'))), str)
+        self.assertEqual(take(3, 'test'), 'tes')
+        self.assertEqual(drop(3, 'test'), 't')
+
+    def test_same_as_str(self):
+        rng = random.Random(0)
+        half = LEAF * 3 // 4
+        values = [('', ''), (concat('x' * half, 'y' * half), 'x' * half + 'y' * half), ('z' * LEAF * 2, 'z' * LEAF * 2)]
+        for _ in range(3000):
+            (a, sa), (b, sb) = rng.choice(values), rng.choice(values)
+            op = rng.randrange(4)
+            if op == 0:
+                value, expected = concat(a, b), sa + sb
+            elif op == 1:
+                c = ''.join(rng.choice('LRUD') for _ in range(rng.randrange(1, LEAF // 8)))
+                value, expected = (concat(a, c), sa + c) if rng.random() < 0.5 else (concat(c, a), c + sa)
+            else:
+                n = rng.randrange(-len(sa) - 2, len(sa) + 3)
+                value, expected = (take(n, a), sa[:n]) if op == 2 else (drop(n, a), sa[n:])
+            self.assertEqual(len(value), len(expected))
+            self.assertEqual(value, expected)
+            self.assertBalanced(value)
+            if len(expected) < LEAF * 40:
+                values.append((value, expected))
+
+    def test_equal(self):
+        s = concat('a' * LEAF, 'b')
+        self.assertEqual(s, 'a' * LEAF + 'b')
+        self.assertEqual('a' * LEAF + 'b', s)
+        self.assertEqual(s, concat('a', drop(1, s)))
+        self.assertNotEqual(s, 'a' * LEAF + 'c')
+        self.assertNotEqual(s, 1)
+        self.assertEqual(hash(s), hash(str(s)))
+
+    def test_linear(self):
+        # 200000 one-character appends and prepends, then a take and a drop from the middle.
+        # Each concatenation copies at most one path of the tree, not the string so far.
+        n = 2 * 10 ** 5
+        built = []
+        init = Rope.__init__
+
+        def counting_init(self, left, right):
+            built.append(1)
+            init(self, left, right)
+
+        s = ''
+        with unittest.mock.patch.object(Rope, '__init__', counting_init):
+            for i in range(n // 2):
+                s = concat(s, 'R')
+                s = concat('L', s)
+        self.assertEqual(len(s), n)
+        self.assertLess(height(s), 30)
+        self.assertLessEqual(len(built), n * (height(s) + 1))
+        self.assertEqual(drop(n // 2 - 1, take(n // 2 + 1, s)), 'LR')
+        self.assertEqual(str(s), 'L' * (n // 2) + 'R' * (n // 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Search for the shortest program that prints a lambdaman or spaceship solution.
+#
+# Every encoder family is tried with all its parameters: the raw S literal,
+# BaseX in the radix of the moves, RLE with each run_bits, LZ77 with each
+# length_bits, and repetition of the shortest period of the path with each
+# number of recursions and copies.
+# The candidates are encoded in a process pool, and ranked by an estimate of
+# their length: the decoder and the bit length of the encoded integer, without
+# converting it to base 94, which is the slow part for long paths.  Only the
+# |top| candidates are built into programs and evaluated under a budget of beta
+# reductions.  The shortest program that prints exactly "solve <problem>
+# <path>" wins.
+#
+#   python icfp_search.py solution.txt [--problem lambdaman6] [-o output.txt]
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import math
+import os
+import random
+import re
+import sys
+import unittest
+
+import icfp_backends
+import icfp_compression
+import icfp_peria
+from icfp_codec import I_encode, encrypt
+
+# Encoders by the kind of problem: (RLE, BaseX, LZ77).
+ENCODERS = {
+    'lambdaman': (icfp_compression.lambdaman_rle, icfp_compression.lambdaman_base4, icfp_compression.lambdaman_lz),
+    'spaceship': (icfp_compression.spaceship_rle, icfp_compression.spaceship_base9, icfp_compression.spaceship_lz),
+}
+# Number of candidates built and evaluated.
+TOP = 8
+# Beta reductions allowed to a candidate (the contest stops at 10^7).
+BUDGET = 10 ** 7
+# Longest period of a path tried by the repeat family, and its ranges of recursions and copies
+# (those of optimize_lambdaman6.generate_shortest_for_repeat).
+MAX_PERIOD = 64
+RECURSIONS = range(1, 10)
+MULTIPLY = range(2, 20)
+
+PROBLEM = re.compile(r'(lambdaman|spaceship)(\d+)')
+
+
+class Candidate(object):
+    '''
+    A program of |family| with |params|.  |prefix| + 'I' + I_encode(|value|) is the program when
+    |value| is not None, |prefix| itself otherwise.  |estimate| is its length, exact or off by one.
+    '''
+    __slots__ = ('family', 'params', 'estimate', 'prefix', 'value')
+
+    def __init__(self, family, params, prefix, value=None):
+        self.family = family
+        self.params = params
+        self.prefix = prefix
+        self.value = value
+        self.estimate = len(prefix) if value is None else len(prefix) + 1 + digits(value)
+
+    def program(self):
+        if self.value is None:
+            return self.prefix
+        return f'{self.prefix}I{I_encode(self.value)}'
+
+    def __repr__(self):
+        return f'Candidate({self.family}, {self.params}, estimate={self.estimate})'
+
+
+def digits(value):
+    # Number of base-94 digits of |value|, from its bit length.
+    return max(1, math.ceil(value.bit_length() / math.log2(94)))
+
+
+def period(path):
+    # The shortest unit with path == unit * k, if it is at most MAX_PERIOD long.
+    for p in range(1, min(MAX_PERIOD, len(path) // 2) + 1):
+        if len(path) % p == 0 and path == path[:p] * (len(path) // p):
+            return path[:p]
+    return None
+
+
+def enumerate_params(problem, path):
+    # Returns (family, params) of every candidate.
+    rle, _, _ = ENCODERS[PROBLEM.fullmatch(problem).group(1)]
+    tasks = [('raw', ())]
+    if path:
+        tasks.append(('basex', ()))
+        # Same range as RLE.rle_encode_optimal.
+        max_run_length = max(run_length for run_length, _ in rle.runs(path))
+        max_run_bits = 2
+        while max_run_length >= 2**max_run_bits:
+            max_run_bits += 1
+        tasks.extend(('rle', (run_bits,)) for run_bits in range(2, max_run_bits + 1))
+        # Same range as LZ77.lz_encode_optimal.
+        tasks.extend(('lz', (length_bits,)) for length_bits in range(3, max(4, len(path).bit_length() + 1)))
+    unit = period(path)
+    if unit is not None:
+        # unit * (initial * multiply ** recursions + rest) == path
+        k = len(path) // len(unit)
+        for recursions in RECURSIONS:
+            for multiply in MULTIPLY:
+                if multiply ** recursions <= k:
+                    initial, rest = divmod(k, multiply ** recursions)
+                    tasks.append(('repeat', (len(unit), recursions, multiply, initial, rest)))
+    return tasks
+
+
+def encode(task):
+    # Encodes |path| with one family and its parameters.  Run in a worker process.
+    problem, path, family, params = task
+    rle, basex, lz = ENCODERS[PROBLEM.fullmatch(problem).group(1)]
+    preamble = encrypt(f'solve {problem} ')
+    if family == 'raw':
+        return Candidate(family, params, f'S{encrypt(f"solve {problem} {path}")}')
+    if family == 'basex':
+        return Candidate(family, params, f'B. S{preamble} B$ B$ {basex.decoder()} I{I_encode(len(path))} ',
+                         basex.decode(path))
+    if family == 'rle':
+        run_bits, num_runs, value = rle.pack_runs(rle.runs(path), params[0])
+        return Candidate(family, params, f'B. S{preamble} B$ B$ {rle.decoder(run_bits)} I{I_encode(num_runs)} ',
+                         value)
+    if family == 'lz':
+        offset_bits, length_bits, value = lz.lz_encode(path, params[0])
+        return Candidate(family, params, f'B. S{preamble} B! B! {lz.decoder(offset_bits, length_bits)} S ', value)
+    if family == 'repeat':
+        # Same as optimize_lambdaman6.generate_shortest_for_repeat: f = Lx B. vx vx .. applied
+        # |recursions| times to |initial| copies of the unit, then |rest| more copies.
+        size, recursions, multiply, initial, rest = params
+        unit = encrypt(path[:size])
+        body = 'B$ vf ' * recursions + 'S' + unit * initial + ' Lx ' + 'B. ' * (multiply - 1) + 'vx ' * multiply
+        program = f'B$ Lf {body}'.rstrip()
+        if rest:
+            program = f'B. {program} S{unit * rest}'
+        return Candidate(family, params, f'B. S{preamble} {program}')
+    raise ValueError(f'Unknown family: {family}')
+
+
+def verify(task):
+    # Builds the program of a candidate and evaluates it.  Returns the program, or None if its
+    # output is not |expected| or it exceeds |budget|.  Run in a worker process.
+    candidate, expected, budget, backend = task
+    program = candidate.program()
+    try:
+        result = icfp_backends.evaluate(program, backend, stats=icfp_peria.Stats(budget))
+    except Exception as e:
+        print(f'{candidate}: {e!r}', file=sys.stderr)
+        return None
+    if type(result) is not icfp_peria.String or str(result.value) != expected:
+        return None
+    return program
+
+
+def search(problem, path, top=TOP, budget=BUDGET, jobs=None, backend=None, verbose=False):
+    '''
+    Returns the shortest verified program for the solution |path| of |problem| (e.g. 'lambdaman6'),
+    and its Candidate.  |jobs| is the number of worker processes (default: one per CPU); with 1,
+    everything runs in this process.
+    '''
+    tasks = [(problem, path, family, params) for family, params in enumerate_params(problem, path)]
+    expected = f'solve {problem} {path}'
+    # Resolved here, so that the workers do not probe the backends each.
+    backend = icfp_backends.resolve(backend)
+    if jobs == 1:
+        candidates = sorted(map(encode, tasks), key=lambda c: c.estimate)
+        programs = list(map(verify, [(c, expected, budget, backend) for c in candidates[:top]]))
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            candidates = sorted(executor.map(encode, tasks), key=lambda c: c.estimate)
+            programs = list(executor.map(verify, [(c, expected, budget, backend) for c in candidates[:top]]))
+    best = None
+    for candidate, program in zip(candidates, programs):
+        if verbose:
+            status = 'FAILED' if program is None else len(program)
+            print(f'{candidate.family} {candidate.params}: estimate={candidate.estimate} length={status}')
+        if program is not None and (best is None or len(program) < len(best[0])):
+            best = program, candidate
+    if best is None:
+        raise ValueError(f'No candidate printed the solution of {problem}')
+    return best
+
+
+def read_solution(filename, problem=None):
+    # Returns (problem, path) of a file "solve <problem> <path>", or of a bare path of |problem|.
+    text = Path(filename).read_text().strip()
+    mo = re.fullmatch(r'solve\s+(\S+)\s+(\S*)', text)
+    if mo is not None:
+        return mo.groups()
+    if problem is None:
+        mo = PROBLEM.search(os.path.basename(filename))
+        if mo is None:
+            raise ValueError(f'Cannot tell the problem of {filename}; use --problem')
+        problem = mo.group(0)
+    return problem, text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('solution', help='A file of "solve lambdaman6 RRDD..", or of a bare path.')
+    parser.add_argument('--problem', help='The problem of a bare path, e.g. lambdaman6.')
+    parser.add_argument('-o', '--output', help='Where to write the shortest program (default: <solution>.best.txt).')
+    parser.add_argument('--top', type=int, default=TOP, help='Number of candidates to build and evaluate.')
+    parser.add_argument('--budget', type=int, default=BUDGET, help='Beta reductions allowed to a candidate.')
+    parser.add_argument('--jobs', type=int, default=None, help='Worker processes (default: one per CPU).')
+    parser.add_argument('--backend', default=None, help='Evaluator of icfp_backends (default: auto).')
+    args = parser.parse_args()
+
+    problem, path = read_solution(args.solution, args.problem)
+    program, candidate = search(problem, path, args.top, args.budget, args.jobs, args.backend, verbose=True)
+    output = args.output or os.path.splitext(args.solution)[0] + '.best.txt'
+    with open(output, 'w') as f:
+        f.write(program)
+    print(f'{problem}: {candidate.family} {candidate.params} length={len(program)} -> {output}')
+
+
+class TestSearch(unittest.TestCase):
+    def assertPrints(self, program, text):
+        self.assertEqual(icfp_backends.evaluate(program, 'machine').value, text)
+
+    def test_lambdaman(self):
+        path = 'RRRRDDDDLLLLUUUU' * 20 + 'RRDDLU' * 30
+        program, candidate = search('lambdaman4', path, jobs=1)
+        self.assertPrints(program, f'solve lambdaman4 {path}')
+        self.assertLess(len(program), len(encode(('lambdaman4', path, 'raw', ())).program()))
+
+    def test_lz(self):
+        # Sweeps repeated out of order: no period, short runs, but long repeated substrings.
+        rng = random.Random(1)
+        sweeps = [''.join(rng.choice('LRUD') * rng.randint(1, 3) for _ in range(10)) for _ in range(4)]
+        path = ''.join(rng.choice(sweeps) for _ in range(100))
+        program, candidate = search('lambdaman9', path, jobs=1)
+        self.assertEqual(candidate.family, 'lz')
+        self.assertPrints(program, f'solve lambdaman9 {path}')
+
+    def test_repeat(self):
+        path = 'R' * 199
+        params = enumerate_params('lambdaman6', path)
+        self.assertIn(('repeat', (1, 2, 5, 7, 24)), params)
+        self.assertIn(('repeat', (1, 7, 2, 1, 71)), params)
+        program, candidate = search('lambdaman6', path, jobs=1)
+        self.assertEqual(candidate.family, 'repeat')
+        self.assertPrints(program, f'solve lambdaman6 {path}')
+        self.assertIsNone(period('RRL'))
+        self.assertEqual(period('RLRLRL'), 'RL')
+
+    def test_spaceship(self):
+        rng = random.Random(0)
+        path = ''.join(rng.choice('123456789') * rng.randint(1, 4) for _ in range(100))
+        program, candidate = search('spaceship7', path, top=TOP, jobs=2)
+        self.assertPrints(program, f'solve spaceship7 {path}')
+        # The estimates are within one character.
+        for family, params in enumerate_params('spaceship7', path):
+            candidate = encode(('spaceship7', path, family, params))
+            self.assertLessEqual(abs(len(candidate.program()) - candidate.estimate), 1)
+
+    def test_budget(self):
+        candidate = encode(('lambdaman6', 'R' * 200, 'repeat', (1, 2, 5, 8, 0)))
+        expected = 'solve lambdaman6 ' + 'R' * 200
+        self.assertIsNotNone(verify((candidate, expected, BUDGET, 'machine')))
+        # Three beta reductions.
+        self.assertIsNone(verify((candidate, expected, 2, 'machine')))
+        self.assertIsNone(verify((candidate, expected + 'R', BUDGET, 'machine')))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and not sys.argv[1].startswith('Test'):
+        main()
+    else:
+        unittest.main()
@@ -1,23 +1,25 @@
 #!/usr/bin/env python3
 
-from collections import deque
 import os
 import requests
 import unittest
 
+from icfp_codec import asc2int, int2asc, icfp2int, int2icfp, decrypt, encrypt
+from icfp_peria import scan
+
 # https://boundvariable.space/communicate
 URL_DOMAIN = "boundvariable.space"
 TOKEN = os.environ["SANMA_TOKEN"]
 HEADERS = {"Authorization": f"Bearer {TOKEN}"}
 
 def communicate(ascii_command, verbose=False):
-    icfp_command = 'S' + encrypt(ascii_command)
+    icfp_command = b'S' + encrypt(ascii_command.encode())
     response = requests.post(f"https://{URL_DOMAIN}/communicate",
                             data=icfp_command,
                             headers=HEADERS)
-    response = response.text
+    response = response.content
     if verbose:
-        print("ICFP response: ", response)
+        print("ICFP response: ", response.decode())
     return icfp2ascii(response)
 
 class Boolean(object):
@@ -194,92 +196,42 @@ class LambdaUse(object):
 
 
 def icfp2ascii(response):
-    tokens = deque(response.split(' '))
-    ast = parse(tokens)
+    ast = parse(scan(response))
     ast = ast.evaluate()
     return str(ast.evaluate())
 
-def parse(tokens):
-    token = tokens.popleft()
-    indicator, body = token[0], token[1:]
+def parse(pairs):
+    # |pairs| is an iterator of (indicator, decoded value) from icfp_peria.scan().
+    indicator, value = next(pairs)
     if indicator == 'T':
         return Boolean(True)
     if indicator == 'F':
         return Boolean(False)
     if indicator == 'I':
-        return Integer(asc2int(body))
+        return Integer(value)
     if indicator == 'S':
-        return String(decrypt(body))
+        return String(value)
     if indicator == 'U':
-        operand = parse(tokens)
-        return UnaryOperator(body, operand)
+        operand = parse(pairs)
+        return UnaryOperator(value, operand)
     if indicator == 'B':
-        left = parse(tokens)
-        right = parse(tokens)
-        return BinaryOperator(body, left, right)
+        left = parse(pairs)
+        right = parse(pairs)
+        return BinaryOperator(value, left, right)
     if indicator == 'L':
-        param = asc2int(body)
-        definition = parse(tokens)
-        return LambdaArg(param, definition)
+        definition = parse(pairs)
+        return LambdaArg(value, definition)
     if indicator == 'v':
-        param = asc2int(body)
-        return LambdaUse(param)
+        return LambdaUse(value)
     if indicator == '?':
-        c = parse(tokens)
-        t = parse(tokens)
-        f = parse(tokens)
+        c = parse(pairs)
+        t = parse(pairs)
+        f = parse(pairs)
         return If(c, t, f)
-    print("Unknown indicator [{}]: {}".format(indicator, body))
+    print("Unknown indicator [{}]: {}".format(indicator, value))
     return None
 
 
-def asc2int(body):
-    value = 0
-    for c in body:
-        value = value * 94 + ord(c) - 33
-    return value
-
-
-def int2asc(value):
-    result = []
-    while value > 0:
-        result.append(chr(value % 94 + 33))
-        value //= 94
-    return ''.join(reversed(result))
-
-
-mapping = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!\"#$%&'()*+,-./:;<=>?@[\\]^_`|~ \n"
-crypt_map = {}
-
-def decrypt(s):
-    return ''.join(mapping[ord(c) - 33] for c in s)
-
-def encrypt(s):
-    global crypt_map
-    if len(crypt_map) == 0:
-        for i in range(len(mapping)):
-            crypt_map[mapping[i]] = i
-
-    return ''.join(chr(crypt_map[c] + 33) for c in s)
-
-def icfp2int(icfp):
-    global crypt_map
-    if len(crypt_map) == 0:
-        for i in range(len(mapping)):
-            crypt_map[mapping[i]] = i
-
-    value = 0
-    for c in icfp:
-        value = value * 94 + crypt_map[c]
-    return value
-
-def int2icfp(value):
-    result = []
-    while value > 0:
-        result.append(mapping[value % 94])
-        value //= 94
-    return ''.join(reversed(result))
-
 class TestICFP(unittest.TestCase):
     def test_icfp2ascii(self):
         data = [
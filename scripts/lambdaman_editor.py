@@ -4,7 +4,7 @@ import sys
 import tty
 import termios
 import colorama
-from icfp_peria import encrypt, I_encode
+from icfp_codec import encrypt, I_encode
 import icfp_compression
 
 def clear_screen():
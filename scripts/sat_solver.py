@@ -4,6 +4,8 @@ import re
 import z3
 import sys
 
+from icfp_codec import int2asc
+
 def efficient8():
     solver = z3.Solver()
 
@@ -167,12 +169,7 @@ def efficient9():
         value = value * 9 + v
     print()
     print(value)
-    n = value
-    icfp = ''
-    while n > 0:
-        icfp = chr(n % 94 + 33) + icfp
-        n //= 94
-    print(icfp)
+    print(int2asc(value))
 
 def main():
     # efficient8()